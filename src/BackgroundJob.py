@@ -0,0 +1,102 @@
+import threading
+import queue
+import time
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class BackgroundJob:
+    """
+    runs a backup or restore in a worker thread so the gui stays responsive
+    the job gets a ui_caller that turns every call into an event on a queue, the gui polls the queue with after()
+    and replays the events on its own ui_caller, progress updates are coalesced to one per frame
+    cancel() makes the job's next ui_caller call raise JobCancelled
+
+    the job must not touch tkinter, and anything thread bound (sqlite connections) must be created inside it
+
+    Usage: BackgroundJob(widget, job(ui_caller) -> result, widget ui_caller, on_done(result), on_error(exception)).start()
+    """
+
+    FRAME_MS = 50  # gui refresh interval, 20 fps
+
+    def __init__(self, widget, job, ui_caller, on_done, on_error):
+        self.widget = widget
+        self.job = job
+        self.ui_caller = ui_caller
+        self.on_done = on_done
+        self.on_error = on_error
+
+        self.events = queue.SimpleQueue()  # ("call", (args, func, kwargs)) | ("done", result) | ("error", exception)
+        self.cancelled = threading.Event()
+        self.maximum = None
+        self.last_progress = 0.0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        self.widget.after(self.FRAME_MS, self.poll)
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def publish(self, *args, func="ui_print", **kwargs):
+        """
+        ui_caller handed to the job, runs in the worker thread
+        progress values arriving faster than the frame rate are dropped, except the last one
+        """
+        if self.cancelled.is_set():
+            raise JobCancelled()
+
+        if func == "set_progress_config":
+            if "maximum" in kwargs:
+                self.maximum = kwargs["maximum"]
+            elif kwargs.get("value") != self.maximum:
+                now = time.monotonic()
+                if now - self.last_progress < self.FRAME_MS / 1000:
+                    return
+                self.last_progress = now
+
+        self.events.put(("call", (args, func, kwargs)))
+
+    def run(self):
+        try:
+            self.events.put(("done", self.job(self.publish)))
+        except BaseException as e:  # handed to the gui thread, JobCancelled included
+            self.events.put(("error", e))
+
+    def poll(self):
+        """
+        runs in the gui thread, replays queued events, only the latest progress config is applied
+        """
+        progress = {}
+        finished = None
+        while finished is None:
+            try:
+                kind, payload = self.events.get_nowait()
+            except queue.Empty:
+                break
+
+            if kind != "call":
+                finished = kind, payload
+                continue
+
+            args, func, kwargs = payload
+            if func == "set_progress_config":
+                progress.update(kwargs)
+                continue
+            if progress:  # keep progress in order with the other events
+                self.ui_caller(func="set_progress_config", **progress)
+                progress = {}
+            self.ui_caller(*args, func=func, **kwargs)
+
+        if progress:
+            self.ui_caller(func="set_progress_config", **progress)
+
+        if finished is None:
+            self.widget.after(self.FRAME_MS, self.poll)
+        elif finished[0] == "done":
+            self.on_done(finished[1])
+        else:
+            self.on_error(finished[1])
@@ -1,12 +1,24 @@
 from FileItter import FileItter
-from collections import defaultdict
+from DupeFinder import DupeFinder
+from Repository import Repository
+from Compression import Compressor, write_compressed, set_compress_level
+from Chunker import Chunker
+from HashEngine import HashEngine
+from Manifest import write_manifest, ALIASES_ENTRY
+from RunReport import RunReport
+from Volumes import VolumeWriter, INDEX_ENTRY, entry_bound, volume_capacity, discard
+from concurrent.futures import ThreadPoolExecutor
+from FileItter import ordered_map, inode_key
+from collections import defaultdict, Counter
+from contextlib import contextmanager
+import time
+import json
+import zlib
 import os.path as op
 import pathlib
 from crypto import Crypto
-import json
 import zipfile
 import os
-import tempfile
 import datetime
 import shutil
 
@@ -14,144 +26,689 @@ import shutil
 class Backup:
     """
     main backup class runs and controls backup procedure
-    backups reduced in file count by 84% and size by 64%
+    backups reduced in file count by 84% and size by 64%, Benchmark measures it on a generated tree
 
     Usage: Backup(target path, backup path, password to encrypt with)
+    optional: workers -> number of hashing threads/processes (defaults to cpu count)
+              use_processes -> hash in a process pool instead of threads, faster for many small files
+              prefilter -> only fully hash files that could be duplicates (same size and same partial hash)
+              hash_cache -> HashCache from ConfigMGR.get_hash_cache, unchanged files are not re-hashed
+              incremental -> backup path is a Repository, only new blobs and a snapshot config are written
+              single_pass -> nothing is hashed up front, files are hashed while packed so each is read once
+                             and a file that turns out to be a duplicate is dropped before it is written
+              spool_size -> files up to this size are read into memory and hashed/compressed by worker threads,
+                            bigger ones are hashed then streamed (read twice) so memory use stays bounded
+              compression -> codec from Compression.CODECS, chosen per file, incompressible files are stored
+              compression_level -> level passed to the codec, None for its default
+              chunking -> files bigger than 4 * chunk_size are split into content defined chunks (see Chunker)
+                          and each unique chunk is stored once, so a large file that changed a little
+                          only adds the changed chunks, mainly useful with incremental
+              chunk_size -> average chunk size in bytes
+              hash_algorithm -> one of HashEngine.ALGORITHMS, recorded in the config, hash_cache must use the same
+              catalog -> Catalog from ConfigMGR.get_catalog, the finished backup and its files are recorded in it
+              profile -> name of a stage (walk, hash, pack, manifest) to run under cProfile, see RunReport
+              volume_size -> split the archive into data volumes of at most this many bytes (see Volumes),
+                             the archive itself becomes a small index volume, files too big for a volume
+                             are stored in pieces
+
+    the archive is zipped and encrypted in a single stream straight into the backup folder, nothing is staged
+    in a temp folder and the file only gets its final name once it is complete
+    archives use the segmented container (see crypto.SegmentWriter) so Restore can read them with random access
     """
 
-    def __init__(self, target_path: str, backup_path: str, password: str):
+    def __init__(self, target_path: str, backup_path: str, password: str,
+                 workers: int = None, use_processes: bool = False, prefilter: bool = True, hash_cache=None,
+                 incremental: bool = False, single_pass: bool = False, spool_size: int = 16 * 1024 * 1024,
+                 compression: str = "deflate", compression_level: int = None,
+                 chunking: bool = False, chunk_size: int = 1024 * 1024, hash_algorithm: str = "md5", catalog=None,
+                 profile: str = None, volume_size: int = None):
         if not op.isdir(target_path):
             raise Exception()
+        if volume_size is not None and incremental:
+            raise ValueError("volume_size splits archives, incremental backups are stored as separate blobs")
+        if volume_size is not None and chunking and entry_bound(chunk_size * 4) > volume_capacity(volume_size) // 2:
+            raise ValueError("volume_size must be at least twice the biggest chunk (4 * chunk_size)")
 
-        self.crypto = Crypto(password)
+        self.hash_engine = HashEngine(hash_algorithm)
+        if hash_cache is not None and hash_cache.algorithm != hash_algorithm:
+            raise ValueError(f"hash cache uses {hash_cache.algorithm}, not {hash_algorithm}")
 
         self.file_iterator = FileItter(target_path)
-        self.files = self.file_iterator.itter_files(target_path)
-        self.directories = self.file_iterator.itter_directories()
-
-        self.temp_folder = tempfile.TemporaryDirectory()
+        self.files = []  # FileRecords of every file, filled by backup_directory_tree
 
         self.backup_path = backup_path
         self.target_path = target_path
-        self.temp_path = self.temp_folder.name
 
-        pathlib.Path(backup_path).mkdir(parents=True, exist_ok=True)  # creates backup folder
+        self.workers = workers or os.cpu_count() or 1
+        self.crypto = Crypto(password, self.workers)
+        self.use_processes = use_processes
+        self.prefilter = prefilter
+        self.hash_cache = hash_cache
+        self.catalog = catalog
+        self.incremental = incremental
+        self.single_pass = single_pass
+        self.spool_size = spool_size
+        self.compressor = Compressor(compression, compression_level)
+        self.chunker = Chunker(chunk_size) if chunking else None
+        self.chunk_stats = {"stored": 0, "reused": 0}
+        self.unhashed = []  # groups of paths known to be unique, hashed while being packed
+        self.volume_size = volume_size
+        self.volumes = None  # VolumeWriter of a split archive, opened by backup_archive
+        self.aliases = {}  # hash -> entry name of files stored before their hash was known, see write_unhashed
+        self.streamed = 0  # files written by write_unhashed, numbers their entries
+        self.shared_sizes = set()  # sizes of more than one file, such unhashed files are hashed before they are written
 
-        self.backup_zip = zipfile.ZipFile(self.temp_path + "\\backup.zip",
-                                          mode='w', compression=zipfile.ZIP_STORED, allowZip64=True)
+        pathlib.Path(backup_path).mkdir(parents=True, exist_ok=True)  # creates backup folder
 
-        self.backup_zip_path = self.backup_zip.filename
+        self.backup_zip = None  # opened over the encrypted stream by backup()
 
-        self.main_config_dict = dict()
+        self.main_config_dict = {"hash_algorithm": hash_algorithm}
+        self.stats = {}  # filled in by backup from generate_stats, compression_stats and chunking_stats
+        self.report = RunReport(profile)  # per stage measurements, also handed to ui_caller(func="report")
 
     def backup(self, ui_caller=print):
         """
         main backup function
         """
+        start = time.time()
+        dest = self.backup_incremental(ui_caller) if self.incremental else self.backup_archive(ui_caller)
+        self.stats["seconds"] = time.time() - start
+        self.stats["report"] = self.report.as_dict()
+        ui_caller(func="report", report=self.stats["report"])
+
+        if self.catalog is not None:
+            self.catalog_backup(dest)
+        return dest
 
+    def backup_archive(self, ui_caller):
+        """
+        backs up into a single new archive in the backup path
+        """
         ui_caller("Starting:")
-        ui_caller("Step 1 of 6: Building directory tree")
-        self.backup_directory_tree()
+        ui_caller("Step 1 of 4: Building directory tree")
+        with self.report.stage("walk"):
+            self.backup_directory_tree()
+
+        ui_caller("Step 2 of 4: Building file tree")
+        with self.report.stage("hash"):
+            self.backup_file_tree(ui_caller)
+
+        dest = op.join(self.backup_path, datetime.datetime.now().strftime("%Y-%m-%d %H-%M-%S") + " backup.zip.locked")
+        writer = self.crypto.open_segment_writer(dest + ".part")  # renamed when complete, a failed backup never looks valid
+        if self.volume_size is not None:
+            self.volumes = VolumeWriter(dest, self.crypto, self.volume_size, self.workers)
+        index = None
+
+        try:
+            self.backup_zip = zipfile.ZipFile(writer, mode='w', compression=zipfile.ZIP_STORED, allowZip64=True)
+
+            ui_caller(f"Step 3 of 4: Packing and encrypting data to: {dest}")
+            with self.report.stage("pack"):
+                self.store_target_files(self.main_config_dict, ui_caller)
+                if self.volumes is not None:
+                    index = self.volumes.close()
+                    self.report.add(bytes_written=self.volumes.bytes_written,
+                                    encrypt_seconds=self.volumes.crypto_seconds, volumes=len(index["volumes"]))
+                else:
+                    self.report.add(bytes_written=writer.tell(), encrypt_seconds=writer.crypto_seconds)
+
+            ui_caller("Step 4 of 4: Storing file trees")
+            with self.report.stage("manifest"):
+                packed = writer.tell(), writer.crypto_seconds
+                self.store_config_files()
+                if index is not None:
+                    self.store_volume_index(index)
+
+                self.backup_zip.close()  # closing backup zip
+                writer.close()
+                self.report.add(bytes_written=writer.tell() - packed[0],
+                                encrypt_seconds=writer.crypto_seconds - packed[1])
+        except BaseException:
+            writer.abort()
+            if self.backup_zip is not None:
+                discard(self.backup_zip)
+                self.backup_zip = None
+            if self.volumes is not None:
+                self.volumes.abort()
+            raise
+
+        os.replace(dest + ".part", dest)
 
-        ui_caller("Step 2 of 6: Building file tree")
-        self.backup_file_tree(ui_caller)
+        ui_caller("Done!")
 
-        ui_caller("Step 3 of 6: Packing Data")
-        self.store_target_files(self.main_config_dict, ui_caller)
+        self.stats = dict(self.generate_stats(self.main_config_dict["file_tree"], ui_caller),
+                          compression=self.compression_stats(ui_caller), chunks=self.chunking_stats(ui_caller))
+        if index is not None:
+            self.stats["volumes"] = len(index["volumes"])
+            ui_caller(f"Volumes: {len(index['volumes'])} of up to {self.volume_size / 1e6:.1f} MB")
 
-        ui_caller("Step 4 of 6: Storing file trees")
-        self.store_config_files()
+        return dest
 
-        self.backup_zip.close()  # closing backup zip
+    def backup_incremental(self, ui_caller):
+        """
+        backs up into the content addressed repository in the backup path
+        blobs already in the repository from earlier snapshots are not written again
+        """
+        repository = Repository(self.backup_path, self.crypto)
 
-        ui_caller("Step 5 of 6: Encrypting files")
-        self.backup_zip_path = self.crypto.encrypt_file(self.backup_zip.filename)
+        ui_caller("Starting:")
+        ui_caller("Step 1 of 4: Building directory tree")
+        with self.report.stage("walk"):
+            self.backup_directory_tree()
 
-        dest = self.backup_path + "/" + datetime.datetime.now().strftime("%Y-%m-%d %H-%M-%S") \
-               + " " + pathlib.Path(self.backup_zip_path).name  # potential path merging issue on Linux
+        ui_caller("Step 2 of 4: Building file tree")
+        with self.report.stage("hash"):
+            self.backup_file_tree(ui_caller)
+            self.hash_unhashed()  # the repository is looked up by hash so every hash is needed up front
 
-        if op.exists(dest):  # checks if file already exists
-            os.remove(dest)
+        ui_caller("Step 3 of 4: Storing new data in repository")
+        with self.report.stage("pack"):
+            new_blobs = self.store_repository_files(repository, ui_caller)
 
-        ui_caller(f"Step 6 of 6: Copying backup to target location: {dest}")
-        shutil.copy(self.backup_zip_path, dest)
-        self.temp_folder.cleanup()  # cleanup temp folder
+        ui_caller("Step 4 of 4: Storing snapshot")
+        with self.report.stage("manifest"):
+            dest = repository.put_snapshot(datetime.datetime.now().strftime("%Y-%m-%d %H-%M-%S"),
+                                           self.main_config_dict)
+            self.report.add(bytes_written=op.getsize(dest))
 
-        ui_caller("Done!")
+        ui_caller(f"Done! Snapshot: {dest}")
 
-        self.generate_stats(self.main_config_dict["file_tree"], ui_caller)
+        self.stats = dict(self.generate_stats(self.main_config_dict["file_tree"], ui_caller), new_blobs=new_blobs)
+        ui_caller(f"New unique files stored: {new_blobs}")
+        self.stats["chunks"] = self.chunking_stats(ui_caller)
 
         return dest
 
+    def catalog_backup(self, dest: str):
+        """
+        records the finished backup and the size of every file in it in the catalog
+        """
+        sizes = {record.path.replace(self.target_path, ""): record.st_size for record in self.files}
+        self.catalog.add_backup(dest, self.target_path, self.main_config_dict, sizes, self.stats,
+                                self.stats["seconds"], self.incremental)
+
     def backup_file_tree(self, ui_caller):
         """
         builds a dict with hash of file as a key and a list of files with that has as the value
         {"hash":["list", "of", "files", "with", "the", "has"]}
+        with prefilter files that cannot have a duplicate go to self.unhashed and are added by store_target_files
+        with single_pass every file without a cached hash goes to self.unhashed, only hard links are grouped
         """
         paths_dict = defaultdict(list)
-        files = list(self.files)
+        files = self.files
 
         if not files:  # checks if folder has files
             raise OSError("Specified folder is Empty")
 
-        ui_caller(func="start_progress_bar")
-        ui_caller(func="set_progress_config", maximum=len(files))
-
-        for index, file_path in enumerate(files):
-            paths_dict[self.file_iterator.hash_file(file_path)].append(file_path.replace(self.target_path, ""))
-
-            ui_caller(func="set_progress_config", value=index)
+        cache_before = self.cache_counts()
+        self.report.add(files=len(files))
+
+        total = sum(record.st_size for record in files)
+        ui_caller(func="start_progress_bar")  # progress is in bytes so the eta follows the reading left
+        ui_caller(func="set_progress_config", maximum=total)
+
+        if self.single_pass:
+            self.unhashed = self.group_hard_links(files, paths_dict)
+            ui_caller(func="set_progress_config", value=total)
+        elif self.prefilter:
+            finder = DupeFinder(self.workers, self.use_processes, self.hash_cache, self.hash_engine, self.report)
+            groups = finder.find(files, progress=lambda resolved: ui_caller(func="set_progress_config", value=resolved))
+
+            for hash_, group in groups:
+                group = [file_path.replace(self.target_path, "") for file_path in group]
+                if hash_ is None:  # unique, hash is worked out while packing so it is only read once
+                    self.unhashed.append(group)
+                else:
+                    paths_dict[hash_].extend(group)
+        else:
+            hashed = self.file_iterator.hash_files(files, self.workers, self.use_processes, cache=self.hash_cache,
+                                                   engine=self.hash_engine, report=self.report)
+
+            done = 0
+            # results arrive in scan order so tree is deterministic
+            for record, (file_path, hash_) in zip(files, hashed):
+                paths_dict[hash_].append(file_path.replace(self.target_path, ""))
+
+                done += record.st_size
+                ui_caller(func="set_progress_config", value=done)
 
         ui_caller(func="stop_progress_bar")
 
         self.main_config_dict["file_tree"] = dict(paths_dict)
+        self.count_cache(cache_before)
+
+    def cache_counts(self) -> tuple:
+        """
+        (hits, misses) of the hash cache so far
+        """
+        return (self.hash_cache.hits, self.hash_cache.misses) if self.hash_cache is not None else (0, 0)
+
+    def count_cache(self, before: tuple):
+        """
+        adds the cache hits and misses since before to the running stage of the report
+        """
+        hits, misses = self.cache_counts()
+        self.report.add(cache_hits=hits - before[0], cache_misses=misses - before[1])
+
+    def group_hard_links(self, files: list, paths_dict: dict) -> list:
+        """
+        groups FileRecords by (device, inode) without reading them, files with a cached hash go straight to paths_dict
+        returns the groups that still need hashing in scan order
+        """
+        inodes = {}
+        for stat in files:
+            file_path = stat.path
+            key = inode_key(stat, file_path)
+            if key not in inodes:
+                hash_ = self.hash_cache.get(file_path, stat) if self.hash_cache is not None else None
+                inodes[key] = paths_dict[hash_] if hash_ else []
+                if not hash_:
+                    self.unhashed.append(inodes[key])
+            inodes[key].append(file_path.replace(self.target_path, ""))
+        return self.unhashed
+
+    def hash_unhashed(self):
+        """
+        hashes the groups the prefilter left unhashed and adds them to the file tree
+        """
+        heads = {self.target_path + paths[0]: paths for paths in self.unhashed}
+        cache_before = self.cache_counts()
+        hashed = self.file_iterator.hash_files(list(heads), self.workers, self.use_processes, cache=self.hash_cache,
+                                               engine=self.hash_engine, report=self.report)
+
+        for file_path, hash_ in hashed:
+            self.main_config_dict["file_tree"].setdefault(hash_, []).extend(heads[file_path])
+
+        self.unhashed = []
+        self.count_cache(cache_before)
 
     def backup_directory_tree(self):
         """
-        builds directory tree in the backup path using path lib
-        parents=True -> will make all parents as necessary
-        exists=True -> if the folder exists it will ignore
+        walks the target once, builds the directory tree and keeps a FileRecord of every file for backup_file_tree
         """
-        self.main_config_dict["directory_tree"] = [i.replace(self.target_path, "") for i in self.directories]
+        directories = []
+        for record in self.file_iterator.walk():
+            if record.is_dir:
+                directories.append(record.path.replace(self.target_path, ""))
+            else:
+                self.files.append(record)
+        self.main_config_dict["directory_tree"] = directories
+        self.report.add(files=len(self.files), directories=len(directories))
 
     def store_target_files(self, config_dict: dict, ui_caller):
         """
-        creates zip file in backup location
+        streams duplicates.zip into the backup zip
         adds a single entry of each duplicate file to the zip
         renames the file to its hash
-        if the file has only one copy it is copied straight to the backup folder
+        files are read, hashed if needed and compressed by a thread pool, entries are written in order
+        unhashed files too big to spool are hashed while they are written, so every file is read once here,
+        unless another file has the same size and it might be a duplicate that shouldn't be stored twice
+        """
+        jobs = list(config_dict['file_tree'].items()) + [(None, paths) for paths in self.unhashed]
+        sizes = {record.path: record.st_size for record in self.files}
+        counts = Counter(sizes.get(self.target_path + paths[0]) for _, paths in jobs)
+        self.shared_sizes = {size for size, count in counts.items() if count > 1}
+        cache_before = self.cache_counts()
+
+        ui_caller(func="start_progress_bar")  # progress is in bytes so it moves with the work left
+        ui_caller(func="set_progress_config", maximum=sum(sizes.get(self.target_path + paths[0], 0)
+                                                          for _, paths in jobs))
+        done = 0
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor, self.open_duplicates() as zip_file:
+            packed = ordered_map(executor, self.pack_file, jobs, self.workers * 2)
+            for (hash_, paths), (stat, file_hash, data) in packed:
+                done += stat.st_size
+                ui_caller(func="set_progress_config", value=done)
+                self.report.add(files=1, bytes_read=stat.st_size)
+
+                streamed = None
+                if file_hash is None:  # written before its hash is known, a duplicate is then stored twice
+                    file_hash, *streamed = self.write_unhashed(zip_file, self.target_path + paths[0], stat)
+
+                if hash_ is None:  # unhashed group, might turn out to be a duplicate of a stored file
+                    duplicate = file_hash in config_dict['file_tree']
+                    config_dict['file_tree'].setdefault(file_hash, []).extend(paths)
+
+                    if self.hash_cache is not None:
+                        self.hash_cache.put(self.target_path + paths[0], stat, file_hash)
+                    if duplicate:
+                        continue
+
+                if streamed is not None:
+                    chunk_hashes, name = streamed
+                    if chunk_hashes is not None:
+                        config_dict.setdefault('chunks', {})[file_hash] = chunk_hashes
+                    else:
+                        self.aliases[file_hash] = name
+                    continue
+
+                zinfo = zipfile.ZipInfo.from_file(self.target_path + paths[0], file_hash + ".duplicate")
+                if self.is_chunked(stat):
+                    config_dict.setdefault('chunks', {})[file_hash] = \
+                        self.write_chunks(zip_file, self.target_path + paths[0], zinfo.date_time)
+                elif self.is_split(stat):
+                    config_dict.setdefault('chunks', {})[file_hash] = \
+                        self.write_pieces(self.target_path + paths[0], zinfo.date_time)
+                elif data is None:
+                    self.write_file(self.entry_zip(zip_file, zinfo.filename, entry_bound(stat.st_size)),
+                                    self.target_path + paths[0], zinfo)
+                else:
+                    zinfo.compress_type, crc, size, data, seconds = data
+                    write_compressed(self.entry_zip(zip_file, zinfo.filename, len(data)), zinfo, data, crc, size)
+                    self.compressor.record(zinfo.compress_type, size, len(data), seconds)
+
+        ui_caller(func="stop_progress_bar")
+
+        if self.hash_cache is not None:
+            self.hash_cache.commit()
+        self.count_cache(cache_before)
+
+    @contextmanager
+    def open_duplicates(self):
+        """
+        yields the zip entries are written to, duplicates.zip streamed into the backup zip
+        split archives yield None, entry_zip picks a volume for each entry instead
+        """
+        if self.volumes is not None:
+            yield None
+            return
+        with self.backup_zip.open("duplicates.zip", mode="w", force_zip64=True) as member:
+            zip_file = zipfile.ZipFile(member, mode='w', compression=zipfile.ZIP_STORED, allowZip64=True)
+            try:
+                yield zip_file
+            except BaseException:  # the backup is aborted, its directory isn't worth writing
+                member.close()
+                discard(zip_file)
+                raise
+            zip_file.close()
+
+    def entry_zip(self, zip_file, name: str, size: int):
         """
-        zip_file = zipfile.ZipFile(self.temp_path + "\\duplicates.zip",
-                                   mode='w', compression=zipfile.ZIP_STORED, allowZip64=True)
-        files = config_dict['file_tree'].items()
+        zip to write an entry of at most size stored bytes to, the volume it fits in for split archives
+        """
+        return zip_file if self.volumes is None else self.volumes.reserve(name, size)
 
-        ui_caller(func="start_progress_bar")
-        ui_caller(func="set_progress_config", maximum=len(files))
+    def has_entry(self, zip_file, name: str) -> bool:
+        """
+        True if an entry was already written, in any volume for split archives
+        """
+        return name in (zip_file.NameToInfo if self.volumes is None else self.volumes.entries)
 
-        for index, kv in enumerate(files):
-            #  kv -> (key, value) -> (str, list) -> (hash, list of paths with same hash)
-            ui_caller(func="set_progress_config", value=index)
+    def pack_file(self, job) -> tuple:
+        """
+        runs in a worker thread, job -> (hash or None, paths)
+        returns (stat, hash, (compress type, crc, size, compressed data, seconds spent compressing))
+        files over spool_size are not read here, data is None and the writer streams them instead,
+        their hash stays None if it isn't known yet and no other file has their size, it is then worked out as they
+        are written (see write_unhashed)
+        stat is taken before reading so a change during the read is caught by the hash cache
+        """
+        hash_, paths = job
+        path = self.target_path + paths[0]
+        stat = os.stat(path)
+
+        if stat.st_size > self.spool_size or self.is_chunked(stat) or self.is_split(stat):
+            if hash_ is None and stat.st_size in self.shared_sizes:
+                hash_ = self.hash_engine.hash_file(path)
+            return stat, hash_, None
+
+        read_start = time.perf_counter()
+        with open(path, "rb") as f:
+            data = f.read()
+
+        compress_type = self.compressor.choose(path, data)
+        start = time.perf_counter()
+        compressed = self.compressor.compress(data, compress_type)
+        seconds = time.perf_counter() - start  # the codec's own cost, hashing is not charged to it
+        hash_ = hash_ or self.hash_engine.hash_bytes(data)
+        self.report.file(paths[0], time.perf_counter() - read_start, stat.st_size)
+        return stat, hash_, (compress_type, zlib.crc32(data), len(data), compressed, seconds)
+
+    def is_chunked(self, stat: os.stat_result) -> bool:
+        return self.chunker is not None and stat.st_size > self.chunker.max_size
+
+    def is_split(self, stat: os.stat_result) -> bool:
+        """
+        True if a file might not fit in an empty volume, it is then stored in pieces by write_pieces
+        """
+        return self.volumes is not None and stat.st_size > self.volumes.max_entry
 
-            path = kv[-1][0]  # choose first path
-            zip_file.write(self.target_path + path, arcname=kv[0] + ".duplicate")
+    def write_unhashed(self, zip_file, path: str, stat: os.stat_result) -> tuple:
+        """
+        writes a file too big to spool whose hash isn't known yet, hashing it on the way so it is only read once
+        returns (hash, chunk hashes or None, entry name or None)
+        chunked and split files are stored as usual, a whole file goes in an entry named by a counter as its name
+        is written before its data, self.aliases maps the hash to it and is stored next to the manifest
+        """
+        file_digest = self.hash_engine.new()
+        zinfo = zipfile.ZipInfo.from_file(path, f"{self.streamed}.stream")
+        self.streamed += 1
+        if self.is_chunked(stat):
+            chunk_hashes = self.write_chunks(zip_file, path, zinfo.date_time, file_digest)
+            return file_digest.hexdigest(), chunk_hashes, None
+        if self.is_split(stat):
+            piece_hashes = self.write_pieces(path, zinfo.date_time, file_digest)
+            return file_digest.hexdigest(), piece_hashes, None
+        self.write_file(self.entry_zip(zip_file, zinfo.filename, entry_bound(stat.st_size)), path, zinfo, file_digest)
+        return file_digest.hexdigest(), None, zinfo.filename
+
+    def write_chunks(self, zip_file, path: str, date_time: tuple, file_digest=None) -> list:
+        """
+        splits a file into chunks and writes the ones not already in the zip as hash.chunk entries
+        returns the chunk hashes in file order, Restore joins them back together
+        file_digest -> hash object updated with the whole file, for files that aren't hashed yet
+        """
+        chunk_hashes = []
+        file_start = time.perf_counter()
+        with open(path, "rb") as src:
+            for chunk in self.chunker.chunks(src):
+                if file_digest is not None:
+                    file_digest.update(chunk)
+                chunk_hash = self.hash_engine.hash_bytes(chunk)
+                chunk_hashes.append(chunk_hash)
+                if self.has_entry(zip_file, chunk_hash + ".chunk"):
+                    self.chunk_stats["reused"] += 1
+                    continue
+
+                zinfo = zipfile.ZipInfo(chunk_hash + ".chunk", date_time)
+                zinfo.compress_type = self.compressor.choose(path, chunk)
+                start = time.perf_counter()
+                compressed = self.compressor.compress(chunk, zinfo.compress_type)
+                self.compressor.record(zinfo.compress_type, len(chunk), len(compressed), time.perf_counter() - start)
+                write_compressed(self.entry_zip(zip_file, zinfo.filename, len(compressed)), zinfo, compressed,
+                                 zlib.crc32(chunk), len(chunk))
+                self.chunk_stats["stored"] += 1
+        self.report.file(path.replace(self.target_path, ""), time.perf_counter() - file_start, op.getsize(path))
+        return chunk_hashes
+
+    def write_pieces(self, path: str, date_time: tuple, file_digest=None) -> list:
+        """
+        stores a file too big for a volume as pieces that each fill the rest of the open volume
+        pieces are hash.chunk entries listed in the config like chunks, so Restore joins them back the same way
+        each piece is read twice, once to hash it and once to write it
+        file_digest -> hash object updated with the whole file, for files that aren't hashed yet
+        """
+        name = self.hash_engine.empty + ".chunk"  # every piece name has the same length
+        piece_hashes = []
+        file_start = time.perf_counter()
+        with open(path, "rb") as src:
+            while True:
+                size = self.volumes.room(name)
+                if size < self.volumes.max_entry // 16:  # too little left to be worth a piece
+                    self.volumes.next_volume()
+                    size = self.volumes.room(name)
+
+                start = src.tell()
+                digest = self.hash_engine.new()
+                length = 0
+                while length < size:
+                    data = src.read(min(1024 * 1024, size - length))
+                    if not data:
+                        break
+                    digest.update(data)
+                    if file_digest is not None:
+                        file_digest.update(data)
+                    length += len(data)
+                if not length:
+                    break
+
+                piece_hash = digest.hexdigest()
+                piece_hashes.append(piece_hash)
+                if self.has_entry(None, piece_hash + ".chunk"):
+                    continue
+
+                piece_start = time.perf_counter()
+                src.seek(start)
+                zinfo = zipfile.ZipInfo(piece_hash + ".chunk", date_time)
+                zinfo.file_size = length
+                head = src.read(min(Compressor.PROBE_SIZE, length))
+                zinfo.compress_type = self.compressor.choose(path, head)
+                set_compress_level(zinfo, self.compressor.level)
+
+                with self.volumes.reserve(zinfo.filename, entry_bound(length)).open(zinfo, mode="w") as dest:
+                    dest.write(head)
+                    remaining = length - len(head)
+                    while remaining:
+                        data = src.read(min(1024 * 1024, remaining))
+                        if not data:
+                            raise OSError(f"{path} changed while it was backed up")
+                        dest.write(data)
+                        remaining -= len(data)
+
+                self.compressor.record(zinfo.compress_type, zinfo.file_size, zinfo.compress_size,
+                                       time.perf_counter() - piece_start)
+        self.report.file(path.replace(self.target_path, ""), time.perf_counter() - file_start, op.getsize(path))
+        return piece_hashes
+
+    def put_chunks(self, repository, hash_: str, path: str) -> list:
+        """
+        puts the chunks of a file into the repository, chunks from earlier snapshots are not written again
+        OSError if the file no longer hashes to hash_, its chunk list is then not stored
+        """
+        chunk_hashes = repository.get_chunk_list(hash_)
+        if chunk_hashes is not None:  # unchanged since an earlier snapshot, not even read
+            self.chunk_stats["reused"] += len(chunk_hashes)
+            return chunk_hashes
+
+        chunk_hashes = []
+        file_digest = self.hash_engine.new()
+        with open(path, "rb") as src:
+            for chunk in self.chunker.chunks(src):
+                file_digest.update(chunk)
+                chunk_hash = self.hash_engine.hash_bytes(chunk)
+                chunk_hashes.append(chunk_hash)
+                if repository.put_blob_data(chunk_hash, chunk):
+                    self.chunk_stats["stored"] += 1
+                    self.report.add(bytes_written=op.getsize(repository.blob_file(chunk_hash)))
+                else:
+                    self.chunk_stats["reused"] += 1
+
+        if file_digest.hexdigest() != hash_:  # the chunks are stored by their own hash, the list must not be
+            raise OSError(f"{path} changed while it was backed up")
+        repository.put_chunk_list(hash_, chunk_hashes)
+        return chunk_hashes
+
+    def store_repository_files(self, repository, ui_caller) -> int:
+        """
+        puts a single copy of each unique file into the repository, returns the number of new blobs
+        with chunking big files are stored as chunks instead, blobs stored whole by earlier snapshots are kept
+        """
+        files = self.main_config_dict['file_tree'].items()
+        sizes = {record.path: record.st_size for record in self.files}
+        new_blobs = 0
+
+        ui_caller(func="start_progress_bar")  # progress is in bytes so it moves with the work left
+        ui_caller(func="set_progress_config", maximum=sum(sizes.get(self.target_path + paths[0], 0)
+                                                          for paths in self.main_config_dict['file_tree'].values()))
+        done = 0
+
+        for hash_, paths in files:
+            path = self.target_path + paths[0]
+            size = sizes.get(path, 0)
+            start = time.perf_counter()
+            if not repository.has_blob(hash_) and self.is_chunked(os.stat(path)):
+                self.main_config_dict.setdefault('chunks', {})[hash_] = self.put_chunks(repository, hash_, path)
+                self.report.add(bytes_read=size)
+            elif repository.put_blob(hash_, path, self.hash_engine):
+                new_blobs += 1
+                self.report.add(bytes_read=size, bytes_written=op.getsize(repository.blob_file(hash_)))
+            self.report.add(files=1)
+            self.report.file(paths[0], time.perf_counter() - start, size)
+
+            done += size
+            ui_caller(func="set_progress_config", value=done)
 
         ui_caller(func="stop_progress_bar")
 
-        zip_file.close()
+        if self.hash_cache is not None:
+            self.hash_cache.commit()
 
-        self.backup_zip.write(zip_file.filename, arcname="duplicates.zip")
+        return new_blobs
 
-        os.remove(zip_file.filename)
+    def write_file(self, zip_file, path, zinfo, file_digest=None):
+        """
+        streams a file into the zip, compression is chosen from its first block
+        file_digest -> hash object updated with the file as it is copied, for files that aren't hashed yet
+        """
+        start = time.perf_counter()
+        with open(path, "rb") as src:
+            head = src.read(Compressor.PROBE_SIZE)
+            zinfo.compress_type = self.compressor.choose(path, head)
+            set_compress_level(zinfo, self.compressor.level)
+
+            with zip_file.open(zinfo, mode="w") as dest:
+                dest.write(head)
+                if file_digest is None:
+                    shutil.copyfileobj(src, dest, 1024 * 1024)
+                else:
+                    file_digest.update(head)
+                    for block in iter(lambda: src.read(1024 * 1024), b""):
+                        file_digest.update(block)
+                        dest.write(block)
+
+        self.compressor.record(zinfo.compress_type, zinfo.file_size, zinfo.compress_size, time.perf_counter() - start)
+        self.report.file(path.replace(self.target_path, ""), time.perf_counter() - start, zinfo.file_size)
 
     def store_config_files(self):
         """
-        writes files dictionary and stats to config file
+        streams the file trees into the backup as a compressed binary manifest, see Manifest
+        """
+        zinfo = zipfile.ZipInfo("manifest", datetime.datetime.now().timetuple()[:6])
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        with self.backup_zip.open(zinfo, mode="w", force_zip64=True) as f:
+            write_manifest(f, self.main_config_dict)
+
+        if self.aliases:
+            zinfo = zipfile.ZipInfo(ALIASES_ENTRY, zinfo.date_time)
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+            self.backup_zip.writestr(zinfo, json.dumps(self.aliases))
+
+    def store_volume_index(self, index: dict):
+        """
+        stores the index of a split archive next to the manifest, Restore reads it to find the volume of each entry
+        """
+        zinfo = zipfile.ZipInfo(INDEX_ENTRY, datetime.datetime.now().timetuple()[:6])
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        self.backup_zip.writestr(zinfo, json.dumps(index))
+
+    def compression_stats(self, ui_caller) -> dict:
+        """
+        reports bytes saved and time spent by each codec
+        """
+        report = self.compressor.report()
+        for codec, stats in report.items():
+            ui_caller(f"{codec}: {stats['files']} files, {stats['bytes_saved'] / 1e6:.1f} MB saved "
+                      f"in {stats['seconds']:.1f}s")
+        return report
+
+    def chunking_stats(self, ui_caller) -> dict:
+        """
+        reports how many chunks were written and how many were already stored
         """
-        path = self.temp_path + "\\config"
-        with open(path, "w") as f:
-            f.write(json.dumps(self.main_config_dict))
-        self.backup_zip.write(path, arcname="config")
-        os.remove(path)
+        if self.chunker is not None:
+            ui_caller(f"Chunks: {self.chunk_stats['stored']} stored, {self.chunk_stats['reused']} reused")
+        return self.chunk_stats
 
     @staticmethod
     def generate_stats(config_dict: dict, ui_caller) -> dict:
@@ -1,6 +1,10 @@
 from tkinter import *
 from tkinter.ttk import *
 from Backup import Backup
+from Compression import CODECS
+from HashEngine import ALGORITHMS, FASTEST, choose
+from RunReport import format_report
+from BackgroundJob import BackgroundJob, JobCancelled
 from tkinter import messagebox
 from ConfigMGR import ConfigMGR
 from tkinter.filedialog import askdirectory
@@ -8,6 +12,9 @@ from datetime import datetime, timedelta
 import os.path as op
 import time
 
+# volume sizes offered for split archives, FAT32 can't hold a file of 4 GiB
+VOLUME_SIZES = {"Off": None, "100 MB": 100 * 1000 ** 2, "700 MB": 700 * 1000 ** 2, "4 GB": 4 * 1024 ** 3 - 1}
+
 
 class BackupFrame(Frame):
     def __init__(self, *args, **kw):
@@ -18,6 +25,8 @@ class BackupFrame(Frame):
         """
 
         self.config = ConfigMGR()
+        self.job = None  # BackgroundJob of the running backup
+        self.start_time = 0
 
         # create frames
         self.top_frame = Frame(self)
@@ -44,6 +53,25 @@ class BackupFrame(Frame):
         # self.exit_b = Button(self, text="Exit", command=exit, width=10)
         self.backup_b = Button(self, text="Backup", command=self.backup, width=10)
         self.set_default_b = Button(self, text="Set Default Paths", command=self.set_default_inputs)
+        self.cancel_b = Button(self, text="Cancel", command=self.cancel, width=10, state=DISABLED)
+
+        # create check boxes
+        self.incremental = BooleanVar(self, value=False)
+        self.incremental_cb = Checkbutton(self, text="Incremental", variable=self.incremental)
+        self.chunking = BooleanVar(self, value=False)
+        self.chunking_cb = Checkbutton(self, text="Chunk Large Files", variable=self.chunking)
+
+        # create compression selector
+        self.compression = Combobox(self, values=list(CODECS), state="readonly", width=10)
+        self.compression.set("deflate")
+
+        # create hash algorithm selector
+        self.hash_algorithm = Combobox(self, values=list(ALGORITHMS) + [FASTEST], state="readonly", width=8)
+        self.hash_algorithm.set("md5")
+
+        # create volume size selector, splits the archive into volumes
+        self.volume_size = Combobox(self, values=list(VOLUME_SIZES), state="readonly", width=8)
+        self.volume_size.set("Off")
 
         # position widgets
         self.pass_box.grid(row=0, column=1, columnspan=30)
@@ -62,6 +90,15 @@ class BackupFrame(Frame):
         # self.exit_b.pack(side=RIGHT)
         self.set_default_b.pack(side=LEFT)
         self.backup_b.pack(side=LEFT)
+        self.cancel_b.pack(side=LEFT)
+        self.incremental_cb.pack(side=LEFT)
+        self.chunking_cb.pack(side=LEFT)
+        Label(self, text="Compression: ").pack(side=LEFT)
+        self.compression.pack(side=LEFT)
+        Label(self, text="Hash: ").pack(side=LEFT)
+        self.hash_algorithm.pack(side=LEFT)
+        Label(self, text="Split: ").pack(side=LEFT)
+        self.volume_size.pack(side=LEFT)
 
         # bind buttons
         self.show_pass_b.bind('<ButtonPress-1>', lambda _: self.pass_box.config(show=""))
@@ -77,28 +114,25 @@ class BackupFrame(Frame):
         funcs = {"ui_print": self.ui_print,
                  "start_progress_bar": self.progress_bar.start,
                  "stop_progress_bar": self.progress_bar.stop,
-                 "set_progress_config": self.progress_bar.config}
+                 "set_progress_config": self.progress_bar.config,
+                 "report": self.ui_report}
 
         try:
             funcs[func](*args, **kwargs)
         except KeyError:
             return
-        finally:
-            self.update()
 
     def backup(self):
         """
         function takes gui inputs, plugs into backup class
-        runs backup
-        displays relevant outputs
+        runs backup in a BackgroundJob, backup_done or backup_failed display relevant outputs
 
         flow:
          - get inputs from input boxes
          - check inputs
          - disable buttons
-         - create backup object
-         -  start timer
-         - run back function
+         - start timer
+         - create backup object and run back function in the worker thread
          - end timer
          - display time taken
 
@@ -112,26 +146,54 @@ class BackupFrame(Frame):
 
         self.disable_buttons()
 
-        backup_obj = Backup(target_folder, backup_folder, password)
-
-        start = time.time()
-        try:
-            dest = backup_obj.backup(ui_caller=self)
-        except OSError as e:
-            messagebox.showerror("OS Error",
-                                 f"Following Error Occurred During Backup: {e}")
-            self("Error Occurred, Backup Aborted")
-            self.enable_buttons()
-            return
-
+        options = dict(incremental=self.incremental.get(), compression=self.compression.get(),
+                       chunking=self.chunking.get(), hash_algorithm=self.hash_algorithm.get(),
+                       volume_size=VOLUME_SIZES[self.volume_size.get()])
+
+        def job(ui_caller):
+            options["hash_algorithm"] = choose(options["hash_algorithm"])  # benchmarks here, not on the ui thread
+            hash_cache = self.config.get_hash_cache(algorithm=options["hash_algorithm"])  # sqlite is thread bound
+            catalog = self.config.get_catalog()
+            try:
+                return Backup(target_folder, backup_folder, password, hash_cache=hash_cache, catalog=catalog,
+                              **options).backup(ui_caller=ui_caller)
+            finally:
+                hash_cache.close()
+                catalog.close()
+
+        self.start_time = time.time()
+        self.job = BackgroundJob(self, job, self, self.backup_done, self.backup_failed)
+        self.job.start()
+
+    def backup_done(self, dest):
         end = time.time()
 
-        t = datetime(1, 1, 1) + timedelta(seconds=(end - start))
+        t = datetime(1, 1, 1) + timedelta(seconds=(end - self.start_time))
         self(f"Time Taken: {t.hour} Hours: {t.minute} Minutes: {t.second} Seconds")
         self.enable_buttons()
 
         messagebox.showinfo("Backup Complete", f"Backup Successfully completed\n Output File: {dest}")
 
+    def backup_failed(self, e):
+        if isinstance(e, JobCancelled):
+            self("Backup Cancelled")
+        elif isinstance(e, OSError):
+            messagebox.showerror("OS Error",
+                                 f"Following Error Occurred During Backup: {e}")
+            self("Error Occurred, Backup Aborted")
+        else:
+            messagebox.showerror("Error", f"Following Error Occurred During Backup: {e!r}")
+            self("Error Occurred, Backup Aborted")
+        self.enable_buttons()
+
+    def cancel(self):
+        """
+        stops the running backup, the partly written archive is deleted
+        """
+        if self.job is not None:
+            self.job.cancel()
+            self("Cancelling...")
+
     def browse_dir_target(self):
         """
         opens interactive browse window which user can use to locate folder
@@ -156,6 +218,11 @@ class BackupFrame(Frame):
         self.browse_dir_b.configure(state=DISABLED)
         self.backup_b.configure(state=DISABLED)
         self.set_default_b.configure(state=DISABLED)
+        self.incremental_cb.configure(state=DISABLED)
+        self.chunking_cb.configure(state=DISABLED)
+        for combobox in (self.compression, self.hash_algorithm, self.volume_size):
+            combobox.configure(state=DISABLED)
+        self.cancel_b.configure(state="normal")
 
     def enable_buttons(self):
         """
@@ -165,13 +232,20 @@ class BackupFrame(Frame):
         self.browse_dir_b.configure(state="normal")
         self.backup_b.configure(state="normal")
         self.set_default_b.configure(state="normal")
+        self.incremental_cb.configure(state="normal")
+        self.chunking_cb.configure(state="normal")
+        for combobox in (self.compression, self.hash_algorithm, self.volume_size):
+            combobox.configure(state="readonly")  # picked from the list, never typed in
+        self.cancel_b.configure(state=DISABLED)
+
+    def ui_report(self, report):
+        self.ui_print(format_report(report))
 
     def ui_print(self, data):
         self.text.config(state="normal")
         self.text.insert(END, data + "\n\n")
         self.text.see(END)
         self.text.config(state=DISABLED)
-        self.update()
 
     @staticmethod
     def check_inputs(target_folder, backup_folder, password):
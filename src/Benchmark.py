@@ -0,0 +1,316 @@
+"""
+reproducible benchmark suite, generates a synthetic tree then times every stage of a backup and a restore of it
+run from the src folder: python -m Benchmark [--files 2000 --max-size 4194304 ...] --out results.json
+compare two runs, e.g. before and after a change: python -m Benchmark --compare old.json new.json
+
+the tree only depends on the generator settings and the seed, so runs on different versions back up the same data
+each stage records seconds, files, bytes, files/s, MB/s and the peak rss while it ran
+
+isolated stages, each run on its own:
+    walk        FileItter.walk over the tree
+    hash        FileItter.hash_files of every file
+    copy        Restore.materialize of every file, the plain file copy speed of the disk
+    encrypt     Crypto.encrypt_file of a sample made of the tree's files
+    decrypt     Crypto.decrypt_file of the encrypted sample
+stages of a full run, taken from the RunReport of the backup and the restore with the files and bytes each
+stage actually handled (bytes are the larger of bytes read and written):
+    backup.walk, backup.hash, backup.pack (compress, encrypt and write), backup.manifest
+    restore.manifest, restore.directories, restore.extract (decrypt, extract and materialize)
+"""
+import argparse
+import json
+import os
+import os.path as op
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from Backup import Backup
+from Restore import Restore, materialize
+from FileItter import FileItter
+from HashEngine import HashEngine
+from crypto import Crypto
+from RunReport import reset_peak_rss, peak_rss
+
+WORDS = [b"backup", b"archive", b"segment", b"manifest", b"restore", b"chunk", b"the", b"of", b"data", b"file",
+         b"folder", b"hash", b"duplicate", b"password", b"encrypt", b"stream", b"volume", b"index", b"\n"]
+
+
+class TreeGenerator:
+    """
+    writes a deterministic synthetic tree, the same settings and seed always give the same files
+    files -> number of files
+    min_size, max_size -> file sizes are log-uniform between them, so most files are small and a few are big
+    duplicate_ratio -> chance a file is a copy of an earlier one
+    depth, fan_out -> folders are fan_out wide and depth deep, files are spread over all of them
+    compressibility -> 0 random bytes, 1 text only, in between each file is a mix
+
+    Usage: TreeGenerator(seed=1, files=500).generate(root) -> {"files", "bytes", "unique_files", "directories"}
+    """
+
+    def __init__(self, seed: int = 0, files: int = 1000, min_size: int = 1024, max_size: int = 4 * 1024 * 1024,
+                 duplicate_ratio: float = 0.3, depth: int = 3, fan_out: int = 4, compressibility: float = 0.5):
+        self.seed = seed
+        self.files = files
+        self.min_size = min_size
+        self.max_size = max_size
+        self.duplicate_ratio = duplicate_ratio
+        self.depth = depth
+        self.fan_out = fan_out
+        self.compressibility = compressibility
+
+    def settings(self) -> dict:
+        return dict(vars(self))
+
+    def directories(self) -> list:
+        """
+        relative folder paths, breadth first
+        """
+        dirs = [""]
+        level = [""]
+        for _ in range(self.depth):
+            level = [op.join(parent, f"dir{index}") for parent in level for index in range(self.fan_out)]
+            dirs += level
+        return dirs
+
+    def content(self, seed: int, size: int) -> bytes:
+        """
+        file contents made from a seed, text for the compressible part and random bytes for the rest
+        """
+        rnd = random.Random(seed)
+        text_size = int(size * self.compressibility)
+        text = bytearray()
+        while len(text) < text_size:
+            text += b" ".join(rnd.choices(WORDS, k=64)) + b" "
+        return bytes(text[:text_size]) + rnd.randbytes(size - text_size)
+
+    def generate(self, root: str) -> dict:
+        rnd = random.Random(self.seed)
+        dirs = self.directories()
+        for dir_ in dirs:
+            os.makedirs(op.join(root, dir_), exist_ok=True)
+
+        uniques = []  # (seed, size) of every unique file so duplicates can be written again
+        total = 0
+        for index in range(self.files):
+            if uniques and rnd.random() < self.duplicate_ratio:
+                seed, size = rnd.choice(uniques)
+            else:
+                seed = rnd.getrandbits(32)
+                size = int(self.min_size * (self.max_size / self.min_size) ** rnd.random())
+                uniques.append((seed, size))
+
+            with open(op.join(root, rnd.choice(dirs), f"file{index}.bin"), "wb") as f:
+                f.write(self.content(seed, size))
+            total += size
+
+        return {"files": self.files, "bytes": total, "unique_files": len(uniques), "directories": len(dirs)}
+
+
+def stage_result(seconds: float, files: int, bytes_: int, rss: int = None) -> dict:
+    seconds = max(seconds, 1e-9)
+    return {"seconds": seconds, "files": files, "bytes": bytes_, "files_per_s": files / seconds,
+            "mb_per_s": bytes_ / 1e6 / seconds, "peak_rss": rss}
+
+
+def report_stages(run: str, report: dict) -> dict:
+    """
+    the stages of a RunReport (Backup.stats["report"], Restore.stats["report"]) as run.stage results
+    each with its own files and bytes, plus run itself for the whole run
+    """
+    stages = {f"{run}.{name}": stage_result(stage["seconds"], stage["files"],
+                                            max(stage["bytes_read"], stage["bytes_written"]), stage["peak_rss"])
+              for name, stage in report["stages"].items()}
+    stages[run] = stage_result(report["seconds"], max((stage["files"] for stage in stages.values()), default=0),
+                               max((stage["bytes"] for stage in stages.values()), default=0), report["peak_rss"])
+    return stages
+
+
+class Benchmark:
+    """
+    times every stage of a backup and restore of a generated tree, see the module docstring for the stages
+    backup_options are passed to Backup, e.g. compression="lzma", chunking=True, incremental=True
+
+    Usage: Benchmark(working folder).run(TreeGenerator(...)) -> results dict, save with Benchmark.save
+    """
+
+    def __init__(self, work_dir: str, password: str = "benchmark", workers: int = None, sample_size: int = 64 * 1024 * 1024,
+                 **backup_options):
+        self.work_dir = work_dir
+        self.password = password
+        self.workers = workers or os.cpu_count() or 1
+        self.sample_size = sample_size
+        self.backup_options = backup_options
+
+    def run(self, generator: TreeGenerator, log=print) -> dict:
+        target = op.join(self.work_dir, "tree")
+        stages = {}
+
+        log("generating tree")
+        start = time.perf_counter()
+        tree = generator.generate(target)
+        stages["generate"] = stage_result(time.perf_counter() - start, tree["files"], tree["bytes"])
+        files, size = tree["files"], tree["bytes"]
+
+        log("walk")
+        reset_peak_rss()
+        start = time.perf_counter()
+        records = [record for record in FileItter(target).walk() if not record.is_dir]
+        stages["walk"] = stage_result(time.perf_counter() - start, len(records), 0, peak_rss())
+
+        log("hash")
+        engine = HashEngine(self.backup_options.get("hash_algorithm", "md5"))
+        reset_peak_rss()
+        start = time.perf_counter()
+        for _ in FileItter.hash_files(records, self.workers, engine=engine):
+            pass
+        stages["hash"] = stage_result(time.perf_counter() - start, files, size, peak_rss())
+
+        log("copy")
+        copy = op.join(self.work_dir, "copy")
+        reset_peak_rss()
+        start = time.perf_counter()
+        for record in records:
+            dest = op.join(copy, op.relpath(record.path, target))
+            os.makedirs(op.dirname(dest), exist_ok=True)
+            materialize(record.path, dest)
+        stages["copy"] = stage_result(time.perf_counter() - start, files, size, peak_rss())
+        shutil.rmtree(copy)
+
+        log("encrypt and decrypt")
+        stages.update(self.crypto_stages(records))
+
+        log("backup")
+        backup = Backup(target, op.join(self.work_dir, "backup"), self.password, workers=self.workers,
+                        **self.backup_options)
+        dest = backup.backup(ui_caller=lambda *args, **kwargs: None)
+        stages.update(report_stages("backup", backup.stats["report"]))
+
+        log("restore")
+        restore = Restore(dest, op.join(self.work_dir, "restore"), self.password, workers=self.workers)
+        restore.restore(ui_caller=lambda *args, **kwargs: None)
+        stages.update(report_stages("restore", restore.stats["report"]))
+
+        # the whole backup folder, the repository for incremental
+        backup_size = sum(record.st_size for record in FileItter(backup.backup_path).walk())
+
+        return {"created": time.time(),
+                "machine": {"platform": platform.platform(), "python": platform.python_version(),
+                            "cpu_count": os.cpu_count()},
+                "workers": self.workers,
+                "tree": dict(tree, generator=generator.settings()),
+                "backup_options": self.backup_options,
+                "backup_size": backup_size,
+                "backup_stats": backup.stats,
+                "restore_report": restore.stats["report"],
+                "stages": stages}
+
+    def crypto_stages(self, records: list) -> dict:
+        """
+        encrypts then decrypts a sample made of the tree's files, up to sample_size bytes
+        """
+        sample = op.join(self.work_dir, "sample")
+        size = 0
+        with open(sample, "wb") as out:
+            for record in records:
+                if size >= self.sample_size:
+                    break
+                with open(record.path, "rb") as f:
+                    size += out.write(f.read(self.sample_size - size))
+
+        crypto = Crypto(self.password, self.workers)
+        stages = {}
+        for name, func, args in (("encrypt", crypto.encrypt_file, (sample, sample + ".locked")),
+                                 ("decrypt", crypto.decrypt_file, (sample + ".locked", sample + ".out"))):
+            reset_peak_rss()
+            start = time.perf_counter()
+            func(*args)
+            stages[name] = stage_result(time.perf_counter() - start, 1, size, peak_rss())
+
+        for path in (sample, sample + ".locked", sample + ".out"):
+            os.remove(path)
+        return stages
+
+    @staticmethod
+    def save(results: dict, path: str):
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2)
+
+    @staticmethod
+    def compare(old: dict, new: dict) -> dict:
+        """
+        {stage: new MB/s / old MB/s} for the stages both runs have, above 1 is faster
+        stages without bytes (walk) compare files/s instead, stages with neither compare old seconds / new seconds
+        """
+        ratios = {}
+        for name, stage in new["stages"].items():
+            if name not in old["stages"]:
+                continue
+            if stage["bytes"] or stage["files"]:
+                key = "mb_per_s" if stage["bytes"] else "files_per_s"
+                ratios[name] = stage[key] / max(old["stages"][name][key], 1e-9)
+            else:
+                ratios[name] = old["stages"][name]["seconds"] / max(stage["seconds"], 1e-9)
+        return ratios
+
+
+def format_results(results: dict) -> str:
+    lines = [f"{results['tree']['files']} files, {results['tree']['bytes'] / 1e6:.1f} MB, "
+             f"{results['tree']['unique_files']} unique, backup {results['backup_size'] / 1e6:.1f} MB"]
+    for name, stage in results["stages"].items():
+        rss = f"{stage['peak_rss'] / 1e6:8.1f} MB rss" if stage["peak_rss"] is not None else ""
+        lines.append(f"{name:<20} {stage['seconds']:8.3f} s {stage['files_per_s']:10.0f} files/s "
+                     f"{stage['mb_per_s']:8.1f} MB/s {rss}")
+    return "\n".join(lines)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="Benchmark", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two saved results and exit")
+    parser.add_argument("--out", help="json file the results are saved to")
+    parser.add_argument("--work-dir", help="folder to generate the tree and backups in, a temp folder by default")
+    parser.add_argument("--keep", action="store_true", help="keep the temp folder, a --work-dir is always kept")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--files", type=int, default=1000)
+    parser.add_argument("--min-size", type=int, default=1024)
+    parser.add_argument("--max-size", type=int, default=4 * 1024 * 1024)
+    parser.add_argument("--duplicate-ratio", type=float, default=0.3)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--fan-out", type=int, default=4)
+    parser.add_argument("--compressibility", type=float, default=0.5)
+    parser.add_argument("--compression", default="deflate")
+    parser.add_argument("--hash", default="md5")
+    parser.add_argument("--chunking", action="store_true")
+    parser.add_argument("--incremental", action="store_true")
+    parser.add_argument("--volume-size", type=int, default=None, help="split the archive into volumes")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        old, new = (json.load(open(path)) for path in args.compare)
+        for name, ratio in Benchmark.compare(old, new).items():
+            print(f"{name:<20} {ratio:6.2f}x")
+        return 0
+
+    generator = TreeGenerator(args.seed, args.files, args.min_size, args.max_size, args.duplicate_ratio,
+                              args.depth, args.fan_out, args.compressibility)
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="backup-benchmark-")
+    try:
+        results = Benchmark(work_dir, workers=args.workers, compression=args.compression, hash_algorithm=args.hash,
+                            chunking=args.chunking, incremental=args.incremental, volume_size=args.volume_size).run(
+            generator, log=lambda text: print(text, file=sys.stderr))
+    finally:
+        if not args.work_dir and not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(format_results(results))
+    if args.out:
+        Benchmark.save(results, args.out)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,152 @@
+import sqlite3
+import os.path as op
+import os
+import json
+import time
+from Volumes import archive_size
+
+
+def _blob(path: str) -> bytes:
+    """
+    paths are stored as utf-8 blobs, bytes of posix names that aren't valid utf-8 are kept (surrogateescape)
+    """
+    return path.encode("utf-8", "surrogateescape")
+
+
+def _text(blob: bytes) -> str:
+    return blob.decode("utf-8", "surrogateescape")
+
+
+def _after(prefix: bytes):
+    """
+    smallest blob bigger than every blob starting with prefix, None if there is none
+    """
+    prefix = prefix.rstrip(b"\xff")
+    return prefix[:-1] + bytes([prefix[-1] + 1]) if prefix else None
+
+
+class Catalog:
+    """
+    local record of every backup made and the files in it, answers "which backups have this file"
+    without decrypting anything, stored as a sqlite database next to config.json, see ConfigMGR.get_catalog
+    tables:
+        backups     one row per backup: archive or snapshot path, target, size (with volumes), timings and dedup stats
+        paths       every relative path seen once, files refer to it by id so repeated backups stay small
+        files       one row per file per backup: path, hash and size, indexed by path and by hash
+    paths are kept as blobs so file names that aren't valid utf-8 can be recorded (see _blob)
+
+    Usage: catalog = Catalog(path to database); catalog.add_backup(...); catalog.find_path(path); catalog.close()
+    """
+
+    VERSION = 2  # bump when the schema changes, old databases are then dropped
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        try:
+            self.db = self.__connect()
+        except sqlite3.DatabaseError:  # corrupt database, start again
+            os.remove(db_path)
+            self.db = self.__connect()
+
+    def __connect(self):
+        """
+        opens the database and creates or resets the tables if the version is wrong
+        """
+        db = sqlite3.connect(self.db_path)
+        db.execute("PRAGMA foreign_keys = ON")
+        version = db.execute("PRAGMA user_version").fetchone()[0]
+        if version != self.VERSION:
+            for table in ("files", "paths", "backups"):
+                db.execute(f"DROP TABLE IF EXISTS {table}")
+            db.execute("CREATE TABLE backups (id INTEGER PRIMARY KEY, path BLOB UNIQUE, target_path BLOB, "
+                       "created REAL, size INTEGER, seconds REAL, incremental INTEGER, hash_algorithm TEXT, "
+                       "file_count INTEGER, unique_count INTEGER, reduction_percent INTEGER, stats TEXT)")
+            db.execute("CREATE TABLE paths (id INTEGER PRIMARY KEY, path BLOB UNIQUE)")
+            db.execute("CREATE TABLE files (backup_id INTEGER REFERENCES backups (id) ON DELETE CASCADE, "
+                       "path_id INTEGER REFERENCES paths (id), hash TEXT, size INTEGER)")
+            db.execute("CREATE INDEX files_path ON files (path_id)")
+            db.execute("CREATE INDEX files_hash ON files (hash)")
+            db.execute("CREATE INDEX files_backup ON files (backup_id)")
+            db.execute(f"PRAGMA user_version = {self.VERSION}")
+            db.commit()
+        return db
+
+    def add_backup(self, path: str, target_path: str, config_dict: dict, sizes: dict, stats: dict,
+                   seconds: float, incremental: bool = False) -> int:
+        """
+        records a finished backup, replaces an earlier record of the same path, returns its id
+        config_dict -> Backup.main_config_dict, sizes -> {relative path: size in bytes}
+        """
+        path = _blob(op.abspath(path))
+        self.db.execute("DELETE FROM backups WHERE path = ?", (path,))
+        cursor = self.db.execute("INSERT INTO backups (path, target_path, created, size, seconds, incremental, "
+                                 "hash_algorithm, file_count, unique_count, reduction_percent, stats) "
+                                 "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                 (path, _blob(op.abspath(target_path)), time.time(), archive_size(_text(path)), seconds,
+                                  int(incremental), config_dict.get("hash_algorithm", "md5"),
+                                  stats.get("file_count"), stats.get("individual_files_count"),
+                                  stats.get("reduction_percent"), json.dumps(stats)))
+        backup_id = cursor.lastrowid
+
+        files = [(_blob(file_path), hash_, sizes.get(file_path))
+                 for hash_, paths in config_dict["file_tree"].items() for file_path in paths]
+        self.db.executemany("INSERT OR IGNORE INTO paths (path) VALUES (?)", ((file_path,) for file_path, _, _ in files))
+        self.db.executemany("INSERT INTO files VALUES (?, (SELECT id FROM paths WHERE path = ?), ?, ?)",
+                            ((backup_id, file_path, hash_, size) for file_path, hash_, size in files))
+        self.db.commit()
+        return backup_id
+
+    def backups(self) -> list:
+        """
+        every recorded backup, newest first, as dicts of the backups table
+        """
+        cursor = self.db.execute("SELECT * FROM backups ORDER BY created DESC")
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row), path=_text(row[1]), target_path=_text(row[2]), stats=json.loads(row[-1]))
+                for row in cursor.fetchall()]
+
+    def find_path(self, path: str, prefix: bool = False) -> list:
+        """
+        returns (backup path, created, file path, hash, size) of every backup holding path, newest first
+        prefix=True matches every path starting with path, still an indexed range lookup
+        """
+        path = _blob(path)
+        end = _after(path)
+        if prefix and end is not None:
+            where, args = "paths.path >= ? AND paths.path < ?", (path, end)
+        elif prefix:
+            where, args = "paths.path >= ?", (path,)
+        else:
+            where, args = "paths.path = ?", (path,)
+        return self.rows(self.db.execute("SELECT backups.path, backups.created, paths.path, files.hash, files.size "
+                                         "FROM paths JOIN files ON files.path_id = paths.id "
+                                         "JOIN backups ON backups.id = files.backup_id "
+                                         f"WHERE {where} ORDER BY backups.created DESC, paths.path", args))
+
+    def find_hash(self, hash_: str) -> list:
+        """
+        returns (backup path, created, file path, hash, size) of every file with this hash, newest first
+        """
+        return self.rows(self.db.execute("SELECT backups.path, backups.created, paths.path, files.hash, files.size "
+                                         "FROM files JOIN paths ON paths.id = files.path_id "
+                                         "JOIN backups ON backups.id = files.backup_id "
+                                         "WHERE files.hash = ? ORDER BY backups.created DESC, paths.path",
+                                         (hash_,)))
+
+    @staticmethod
+    def rows(cursor) -> list:
+        """
+        file rows with their paths turned back into strings
+        """
+        return [(_text(backup), created, _text(path), hash_, size) for backup, created, path, hash_, size in cursor]
+
+    def remove_backup(self, path: str):
+        """
+        forgets a backup and its files, the backup itself is not touched
+        """
+        self.db.execute("DELETE FROM backups WHERE path = ?", (_blob(op.abspath(path)),))
+        self.db.execute("DELETE FROM paths WHERE id NOT IN (SELECT path_id FROM files)")
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
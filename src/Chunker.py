@@ -0,0 +1,63 @@
+import math
+import zlib
+import re
+
+# a boundary can only fall straight after one of these bytes, newline gives text files line aligned chunks
+# 0x00 and 0xff are left out so long zero filled runs (disk images) are skipped over at C speed
+ANCHORS = re.compile(b"[\n\x8d\xb3\xe7]")
+
+
+class Chunker:
+    """
+    content defined chunker, splits files into chunks whose boundaries depend only on nearby content
+    so inserting or appending data only changes the chunks around the edit, the rest dedupe against earlier copies
+
+    candidate boundaries are found with a regex scan for anchor bytes, a crc32 rolling window over the bytes
+    ending at each candidate decides if it is a boundary, which keeps the per byte work in C
+    chunk sizes average roughly avg_size and are clamped to avg_size / 4 and avg_size * 4
+
+    Usage: for chunk in Chunker(avg_size).chunks(file object): ...
+    """
+
+    WINDOW = 48  # bytes hashed at each candidate boundary
+
+    def __init__(self, avg_size: int = 1024 * 1024):
+        self.avg_size = avg_size
+        self.min_size = max(avg_size // 4, self.WINDOW)
+        self.max_size = avg_size * 4
+        # anchors turn up about once every 64 bytes in binary data and once a line in text
+        self.mask = (1 << max(int(math.log2(max(avg_size, 128) / 64)), 1)) - 1
+
+    def find_cut(self, buf, start: int, eof: bool):
+        """
+        returns the end of the chunk starting at start, None if more data is needed to decide
+        """
+        end = min(len(buf), start + self.max_size)
+        for match in ANCHORS.finditer(buf, start + self.min_size, end):
+            cut = match.end()
+            if not zlib.crc32(buf[cut - self.WINDOW:cut]) & self.mask:
+                return cut
+        if end - start == self.max_size or (eof and end > start):
+            return end
+        return None
+
+    def chunks(self, f, read_size: int = 8 * 1024 * 1024):
+        """
+        yields the chunks of a binary file object in order
+        """
+        buf = b""
+        start = 0
+        eof = False
+        while True:
+            cut = self.find_cut(buf, start, eof)
+            if cut is not None:
+                yield buf[start:cut]
+                start = cut
+                continue
+            if eof:
+                return
+
+            block = f.read(max(read_size, self.max_size))
+            eof = not block
+            buf = buf[start:] + block  # drop what has been yielded
+            start = 0
@@ -0,0 +1,154 @@
+from collections import Counter, defaultdict
+import os.path as op
+import zipfile
+import threading
+import math
+import io
+
+CODECS = {"stored": zipfile.ZIP_STORED,
+          "deflate": zipfile.ZIP_DEFLATED,
+          "bz2": zipfile.ZIP_BZIP2,
+          "lzma": zipfile.ZIP_LZMA}
+
+CODEC_NAMES = {v: k for k, v in CODECS.items()}
+
+# already compressed formats, never worth another pass
+INCOMPRESSIBLE = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".mp3", ".aac", ".ogg", ".flac", ".m4a",
+                  ".mp4", ".mkv", ".avi", ".mov", ".webm", ".zip", ".gz", ".tgz", ".bz2", ".xz", ".7z", ".rar",
+                  ".zst", ".lz4", ".jar", ".apk", ".docx", ".xlsx", ".pptx", ".odt", ".pdf", ".locked"}
+
+# text and other formats that always compress well, no need to probe
+COMPRESSIBLE = {".txt", ".log", ".csv", ".tsv", ".json", ".xml", ".html", ".htm", ".css", ".js", ".py", ".c",
+                ".h", ".cpp", ".java", ".md", ".sql", ".yaml", ".yml", ".ini", ".cfg", ".svg", ".bmp", ".wav",
+                ".tar"}
+
+# zipfile has no public way to add an entry whose data is already compressed, ZipFile.open(zinfo, "w") always
+# compresses what is written to it, so compressing in worker threads needs these zipfile internals.
+# they are the same from CPython 3.7 to 3.13, this module fails to import rather than write broken archives if
+# a later zipfile changes them. they are only used by Compressor.compress and write_compressed
+ZIP_INTERNALS = ("_get_compressor", "_MASK_COMPRESS_OPTION_1")
+ZIP_FILE_INTERNALS = ("_writing", "_writecheck", "_didModify", "_seekable", "start_dir")
+
+
+def check_zip_internals():
+    """
+    raises ImportError naming the zipfile internals this python doesn't have
+    """
+    with zipfile.ZipFile(io.BytesIO(), mode="w") as zip_file:
+        missing = [name for name in ZIP_INTERNALS if not hasattr(zipfile, name)] + \
+                  [f"ZipFile.{name}" for name in ZIP_FILE_INTERNALS if not hasattr(zip_file, name)]
+    if missing:
+        raise ImportError(f"zipfile of this python (supported: 3.7 to 3.13) lacks {', '.join(missing)}")
+
+
+check_zip_internals()
+
+
+def set_compress_level(zinfo: zipfile.ZipInfo, level: int):
+    """
+    level ZipFile.open(zinfo, "w") compresses an entry with, ZipInfo.compress_level from python 3.13, private before
+    """
+    if hasattr(zinfo, "compress_level"):
+        zinfo.compress_level = level
+    else:
+        zinfo._compresslevel = level
+
+
+class Compressor:
+    """
+    picks a compression method per file and keeps stats on what each codec saved and cost
+    known extensions decide straight away, anything else gets an entropy probe of its first block
+    files that look random (already compressed or encrypted) are stored as is
+
+    Usage: Compressor(codec name from CODECS, level).choose(path, first block) -> zipfile compress type
+    """
+
+    PROBE_SIZE = 64 * 1024
+    MIN_SIZE = 256  # zip headers cost more than compressing tiny files saves
+    ENTROPY_LIMIT = 7.5  # bits per byte, above this compression won't save enough to be worth it
+
+    def __init__(self, codec: str = "deflate", level: int = None):
+        if codec not in CODECS:
+            raise ValueError(f"codec must be one of {list(CODECS)}")
+        self.compress_type = CODECS[codec]
+        self.level = level
+        self.stats = defaultdict(lambda: {"files": 0, "bytes_in": 0, "bytes_out": 0, "seconds": 0.0})
+        self.lock = threading.Lock()  # compress is called from several threads
+
+    def choose(self, path: str, head: bytes) -> int:
+        """
+        returns the zipfile compress type to use for a file, head is the start of the file
+        """
+        if self.compress_type == zipfile.ZIP_STORED or len(head) < self.MIN_SIZE:
+            return zipfile.ZIP_STORED
+
+        extension = op.splitext(path)[1].lower()
+        if extension in INCOMPRESSIBLE:
+            return zipfile.ZIP_STORED
+        if extension in COMPRESSIBLE:
+            return self.compress_type
+
+        return zipfile.ZIP_STORED if self.entropy(head[:self.PROBE_SIZE]) > self.ENTROPY_LIMIT \
+            else self.compress_type
+
+    @staticmethod
+    def entropy(data: bytes) -> float:
+        """
+        shannon entropy of data in bits per byte, 8 is random
+        """
+        if not data:
+            return 0.0
+        length = len(data)
+        return -sum(count / length * math.log2(count / length) for count in Counter(data).values())
+
+    def compress(self, data: bytes, compress_type: int) -> bytes:
+        """
+        compresses data the same way zipfile would for compress_type
+        stats are recorded by the caller once the data is actually written
+        """
+        compressor = zipfile._get_compressor(compress_type, self.level)
+        return compressor.compress(data) + compressor.flush() if compressor else data
+
+    def record(self, compress_type: int, bytes_in: int, bytes_out: int, seconds: float):
+        with self.lock:
+            stats = self.stats[CODEC_NAMES[compress_type]]
+            stats["files"] += 1
+            stats["bytes_in"] += bytes_in
+            stats["bytes_out"] += bytes_out
+            stats["seconds"] += seconds
+
+    def report(self) -> dict:
+        """
+        {codec: {"files", "bytes_in", "bytes_out", "bytes_saved", "seconds"}}
+        """
+        return {codec: dict(stats, bytes_saved=stats["bytes_in"] - stats["bytes_out"])
+                for codec, stats in self.stats.items()}
+
+
+def write_compressed(zip_file: zipfile.ZipFile, zinfo: zipfile.ZipInfo, data: bytes, crc: int, file_size: int):
+    """
+    adds an entry whose data was already compressed with zinfo.compress_type, lets compression run in other threads
+    sizes and crc are known up front so the entry never needs a data descriptor, even on an unseekable stream
+    mirrors what zipfile does when an entry opened with ZipFile.open is closed
+    """
+    if zip_file._writing:
+        raise ValueError("Can't write to the ZIP file while there is another write handle open on it.")
+
+    zinfo.file_size = file_size
+    zinfo.compress_size = len(data)
+    zinfo.CRC = crc
+    zinfo.flag_bits = zipfile._MASK_COMPRESS_OPTION_1 if zinfo.compress_type == zipfile.ZIP_LZMA else 0
+
+    if zip_file._seekable:
+        zip_file.fp.seek(zip_file.start_dir)
+    zinfo.header_offset = zip_file.fp.tell()
+
+    zip_file._writecheck(zinfo)
+    zip_file._didModify = True
+
+    zip_file.fp.write(zinfo.FileHeader())
+    zip_file.fp.write(data)
+    zip_file.start_dir = zip_file.fp.tell()
+
+    zip_file.filelist.append(zinfo)
+    zip_file.NameToInfo[zinfo.filename] = zinfo
@@ -1,8 +1,11 @@
-import random
 import json
 import os.path as op
 import os
 import functools
+import datetime
+from HashCache import HashCache
+from Catalog import Catalog
+from Volumes import volume_files
 
 
 def save(func):
@@ -23,15 +26,14 @@ def save(func):
 class ConfigMGR:
     """
     class manages config data
-    main config data dict structure {"defaults": ("password", "backup_path", "target_path"), "backups": [backup_dict...]}'
-    backup_dict = {"size": int, "pass": password, "original_path": path, "backup_path", path}
-
-    !!! backup_dict and associated function not yet implemented !!!
+    main config data dict structure {"defaults": ("password", "backup_path", "target_path")}
+    the backups made are recorded in the catalog next to the config file, see Catalog
     """
 
-    # todo class unfinished
     def __init__(self):
         self.config_file_path = op.abspath("config.json")  # retrieve full path fo json file
+        self.hash_cache_path = op.abspath("hash_cache.db")  # hash cache lives next to the config file
+        self.catalog_path = op.abspath("catalog.db")
 
         try:  # config file validation
             self.data = json.load(open(self.config_file_path, "r"))
@@ -65,41 +67,65 @@ class ConfigMGR:
         """
         return self.data["defaults"]
 
-    def get_backups(self):
+    def get_hash_cache(self, max_entries=5000000, algorithm="md5"):
         """
-        Testing unused
+        returns the persistent hash cache used to skip re-hashing unchanged files
         """
-        final = []
-        for i in range(278):
-            final.append({"date": "2018-12-28 22-24-55",
-                          "values": ("path_to_backup", "original_path", "358MB", "True", "True"),
-                          "tags": random.choice(["NotFound", "Found"])})
-        return final
+        return HashCache(self.hash_cache_path, max_entries, algorithm)
 
-    def get_file_size(self, path):
+    def clear_hash_cache(self):
         """
-        Testing unused
-        return file size as nicely formatted string e.g 500MB
+        deletes the hash cache, it is rebuilt on the next backup
         """
-        return op.getsize(path)
+        if op.exists(self.hash_cache_path):
+            os.remove(self.hash_cache_path)
 
-    @save
-    def store_backup_data(self, path_to_backup, original_path):
+    def get_catalog(self):
         """
-        Testing unused
+        returns the catalog of backups made, pass it to Backup to record a new one
         """
-        self.data["backups"].append({"size": self.get_file_size(path_to_backup),
-                                     "original_path": original_path,
-                                     "backup_path": path_to_backup})
+        return Catalog(self.catalog_path)
+
+    def get_backups(self):
+        """
+        returns every backup in the catalog, newest first, as rows for a treeview
+        {"date": str, "values": (backup path, original path, size e.g 358MB, incremental, files), "tags": Found|NotFound}
+        """
+        catalog = self.get_catalog()
+        try:
+            backups = catalog.backups()
+        finally:
+            catalog.close()
+
+        return [{"date": datetime.datetime.fromtimestamp(backup["created"]).strftime("%Y-%m-%d %H-%M-%S"),
+                 "values": (backup["path"], backup["target_path"], self.get_file_size(backup["size"]),
+                            str(bool(backup["incremental"])), backup["file_count"]),
+                 "tags": "Found" if op.exists(backup["path"]) else "NotFound"}
+                for backup in backups]
+
+    @staticmethod
+    def get_file_size(size):
+        """
+        return file size as nicely formatted string e.g 500MB
+        """
+        for unit in ("B", "KB", "MB", "GB"):
+            if size < 1024:
+                return f"{size:.0f}{unit}"
+            size /= 1024
+        return f"{size:.0f}TB"
 
-    @save
     def remove_backup(self, path_to_backup, delete_file=True):
         """
-        Testing unused
+        removes a backup from the catalog and optionally deletes the archive or snapshot file
+        and the data volumes of a split archive
+        blobs of a removed snapshot stay in its repository, other snapshots may share them
         """
         if op.exists(path_to_backup) and delete_file:
+            for volume in volume_files(path_to_backup):
+                os.remove(volume)
             os.remove(path_to_backup)
-        for entry in list(self.data["backups"]):
-            if op.samefile(entry["backup_path"], path_to_backup):
-                self.data["backups"].remove(entry)
-                break
+        catalog = self.get_catalog()
+        try:
+            catalog.remove_backup(path_to_backup)
+        finally:
+            catalog.close()
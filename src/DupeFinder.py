@@ -0,0 +1,154 @@
+from FileItter import FileItter, FileRecord, inode_key, ordered_map
+from HashEngine import HashEngine
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+
+class DupeFinder:
+    """
+    staged duplicate detector, avoids reading files that cannot have a duplicate
+    stage 1: hard links (same device and inode) are the same file, only one is looked at,
+             files whose inode is unknown are never treated as hard links
+    stage 2: files are grouped by size, a file with a unique size cannot be a duplicate
+    stage 3: files that share a size are grouped by a hash of their first and last block
+    stage 4: only files that still collide are fully hashed
+
+    files with an up to date entry in the hash cache are never read
+    stages 3 and 4 read files in a worker pool, results are handled in order on the calling thread
+
+    Usage: DupeFinder(workers, use_processes, cache, engine).find(paths) -> [(hash or None, [paths]), ...]
+    a hash of None means the group is known to be unique but its contents were never read
+    """
+
+    PARTIAL_BLOCK = 4096  # bytes read from each end of a file for the partial hash
+
+    def __init__(self, workers: int = None, use_processes: bool = False, cache=None, engine=None, report=None):
+        self.workers = workers
+        self.use_processes = use_processes
+        self.cache = cache  # optional HashCache, a cached hash counts as a full hash
+        self.engine = engine or HashEngine()
+        self.report = report  # optional RunReport, bytes read are added to its running stage
+        self.bytes_read = 0
+
+    def find(self, paths, progress=lambda resolved: None):
+        """
+        groups paths by content, groups are returned in the order their first path was given
+        paths may be FileRecords from FileItter.walk, their stat is used instead of stat'ing each file again
+        progress is called with the bytes of files resolved so far (a file counts once per path, like the sum of
+        the sizes of paths) as each file is read, a file is resolved once its group can't change anymore
+        """
+        resolved = 0
+        order = {}
+        stats = {}
+        known = {}  # (dev, inode) -> hash from the cache
+        inodes = defaultdict(list)  # (dev, inode) -> paths
+        sizes = defaultdict(list)  # size -> (dev, inode)
+
+        for path in paths:
+            stat = path if isinstance(path, FileRecord) else os.stat(path)
+            path = stat.path if stat is path else path
+            key = inode_key(stat, path)
+            if key not in inodes:
+                sizes[stat.st_size].append(key)
+                stats[key] = stat
+                if self.cache is not None:
+                    known[key] = self.cache.get(path, stat)
+            inodes[key].append(path)
+            order.setdefault(key, len(order))
+
+        weight = lambda key: stats[key].st_size * len(inodes[key])  # progress made once a file is resolved
+
+        groups = []
+        full = []
+        small = []  # keys of files small enough to hash whole instead of partially
+        ends = []  # keys of files to partially hash
+        partial = defaultdict(list)  # (size, partial hash) -> (dev, inode)
+        by_hash = defaultdict(list)
+        for size, keys in sizes.items():
+            if len(keys) > 1 and size and not any(known.get(key) for key in keys):
+                # partial hash would read the whole file anyway for small files
+                (small if size <= self.PARTIAL_BLOCK * 2 else ends).extend(keys)
+                continue
+
+            if len(keys) == 1 or size == 0:  # unique size or empty files, no need to read anything
+                groups.append((self.engine.empty if size == 0 else known.get(keys[0]), keys))
+            else:  # cached hashes can only be compared with full hashes
+                for key in keys:
+                    if known.get(key):
+                        by_hash[known[key]].append(key)
+                        resolved += weight(key)
+                    else:
+                        full.append(key)
+                progress(resolved)
+                continue
+            resolved += sum(weight(key) for key in keys)
+            progress(resolved)
+
+        heads = {inodes[key][0]: key for key in small}
+        for path, hash_ in FileItter.hash_files(list(heads), self.workers, self.use_processes, engine=self.engine):
+            key = heads[path]
+            self.count(stats[key].st_size)
+            self.cache_put(path, stats[key], hash_)
+            partial[(stats[key].st_size, hash_)].append(key)
+            resolved += weight(key)
+            progress(resolved)
+
+        workers = self.workers or os.cpu_count() or 1
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            ends_hash = lambda key: self.partial_hash(inodes[key][0], stats[key].st_size)
+            for key, hash_ in ordered_map(executor, ends_hash, ends, workers * 4):
+                self.count(self.PARTIAL_BLOCK * 2)
+                partial[(stats[key].st_size, hash_)].append(key)
+                progress(resolved)  # still to be resolved, the call lets the ui cancel
+
+        for (size, hash_), keys in partial.items():
+            if size <= self.PARTIAL_BLOCK * 2:  # already a full hash
+                groups.append((hash_, keys))
+            elif len(keys) == 1:
+                groups.append((None, keys))
+                resolved += weight(keys[0])
+            else:
+                full.extend(keys)
+        progress(resolved)
+
+        heads = {inodes[key][0]: key for key in full}
+        for path, hash_ in FileItter.hash_files(list(heads), self.workers, self.use_processes,
+                                                engine=self.engine):
+            self.count(stats[heads[path]].st_size)
+            self.cache_put(path, stats[heads[path]], hash_)
+            by_hash[hash_].append(heads[path])
+            resolved += weight(heads[path])
+            progress(resolved)
+        groups.extend(by_hash.items())
+
+        final = []
+        for hash_, keys in groups:
+            if hash_ is None:  # unique groups are never merged, every inode is its own group
+                final.extend((None, inodes[key], order[key]) for key in keys)
+            else:
+                keys.sort(key=order.get)
+                final.append((hash_, [path for key in keys for path in inodes[key]], order[keys[0]]))
+
+        final.sort(key=lambda group: group[-1])
+        return [(hash_, group_paths) for hash_, group_paths, _ in final]
+
+    def count(self, size: int):
+        self.bytes_read += size
+        if self.report is not None:
+            self.report.add(bytes_read=size)
+
+    def cache_put(self, path, stat, hash_):
+        if self.cache is not None:
+            self.cache.put(path, stat, hash_)
+
+    def partial_hash(self, path, size):
+        """
+        hash of the first and last PARTIAL_BLOCK bytes of a file, runs in a worker thread so bytes are counted by find
+        """
+        h = self.engine.new()
+        with open(path, "rb") as f:
+            h.update(f.read(self.PARTIAL_BLOCK))
+            f.seek(size - self.PARTIAL_BLOCK)
+            h.update(f.read(self.PARTIAL_BLOCK))
+        return h.hexdigest()
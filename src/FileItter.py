@@ -1,7 +1,89 @@
 import os.path as op
 import os
+import stat as stat_
 from os import scandir
-import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+from HashEngine import HashEngine
+
+
+def ordered_map(executor, func, iterable, window):
+    """
+    like executor.map but only keeps `window` tasks in flight at once
+    yields (item, result) in the same order as the iterable
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append((item, executor.submit(func, item)))
+        if len(pending) >= window:
+            item_, future = pending.popleft()
+            yield item_, future.result()
+    while pending:
+        item_, future = pending.popleft()
+        yield item_, future.result()
+
+
+def _hash_item(item, engine=None):
+    """
+    item -> (path, cached hash or None), only hashes the file if there is no cached hash
+    """
+    path, hash_ = item
+    return hash_ or FileItter.hash_file(path, engine)
+
+
+def _hash_batch(items, engine=None):
+    """
+    process pool worker, hashes a batch of items to cut down on ipc for small files
+    """
+    return [_hash_item(item, engine) for item in items]
+
+
+def _batches(iterable, size):
+    """
+    groups an iterable into lists of at most size items
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def inode_key(stat, path):
+    """
+    key shared by the hard links of a file: (device, inode), or the path itself when the inode is unknown
+    an inode of 0 means the os didn't report one (DirEntry.stat on windows), such files are never grouped
+    """
+    return (stat.st_dev, stat.st_ino) if stat.st_ino else path
+
+
+class FileRecord:
+    """
+    compact record of a file or directory found by FileItter.walk
+    the stat fields use os.stat_result names so a record can be passed anywhere a stat result is expected
+    directories are not stat'ed, their fields are 0
+    """
+
+    __slots__ = ("path", "is_dir", "st_size", "st_mtime_ns", "st_ino", "st_dev", "st_mode")
+
+    def __init__(self, path, is_dir, stat=None):
+        self.path = path
+        self.is_dir = is_dir
+        if stat is None:
+            self.st_size = self.st_mtime_ns = self.st_ino = self.st_dev = self.st_mode = 0
+        else:
+            self.st_size = stat.st_size
+            self.st_mtime_ns = stat.st_mtime_ns
+            self.st_ino = stat.st_ino
+            self.st_dev = stat.st_dev
+            self.st_mode = stat.st_mode
+
+    def __repr__(self):
+        return f"FileRecord({self.path!r}, is_dir={self.is_dir}, size={self.st_size})"
 
 
 class FileItter:
@@ -14,35 +96,95 @@ class FileItter:
             FileNotFoundError(path)
         self.path = path
 
-    def itter_files(self, path):
+    def walk(self, path=None, follow_symlinks=True):
+        """
+        single iterative scandir walk, yields a FileRecord for every directory and file under path
+        a directory's entries come before anything in its subdirectories, no recursion so depth is unlimited
+        file records carry the stat taken here (following symlinks, like os.stat) so later stages don't stat again
+        follow_symlinks=False stats links themselves (like os.lstat), a dangling link is then a file like any other
+        on windows DirEntry.stat leaves the inode and device at 0, those files are stat'ed again to get them
+        symlinks to directories are yielded as directories but not followed, like os.walk
+        """
+        stack = [path or self.path]
+        while stack:
+            subdirs = []
+            with scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                        yield FileRecord(entry.path, True)
+                        continue
+
+                    stat = entry.stat(follow_symlinks=follow_symlinks)
+                    if not stat.st_ino:
+                        stat = os.stat(entry.path, follow_symlinks=follow_symlinks)
+                    yield FileRecord(entry.path, stat_.S_ISDIR(stat.st_mode), stat)
+            stack.extend(reversed(subdirs))  # first subdirectory is walked next
+
+    def itter_files(self, path=None):
         """
-        Recursively yield DirEntry objects for given directory
+        yield file paths for given directory
         """
-        for entry in scandir(path):
-            if entry.is_dir(follow_symlinks=False):
-                yield from self.itter_files(entry.path)
-            else:
-                yield entry.path
+        return (record.path for record in self.walk(path) if not record.is_dir)
 
-    def itter_directories(self):  # consider os.scandir()
+    def itter_directories(self):
         """
-        iteratively yield directories
+        yield directory paths
         """
-        for root, dirs, files in os.walk(self.path):
-            for dir in dirs:
-                yield os.path.join(root, dir)
+        return (record.path for record in self.walk() if record.is_dir)
 
     @staticmethod
-    def hash_file(path):
-        """
-        hashes file with md5
-        """
-        BLOCKSIZE = 65536
-        h = hashlib.md5()
-        with open(path, 'rb') as f:
-            buf = f.read(BLOCKSIZE)
-            while len(buf) > 0:
-                h.update(buf)
-                buf = f.read(BLOCKSIZE)
-        hash_ = h.hexdigest()
-        return hash_.strip()
+    def hash_files(paths, workers=None, use_processes=False, batch_size=64, cache=None, engine=None, report=None):
+        """
+        hashes files concurrently and yields (path, hash) in the same order as paths
+        threads are used by default as hashlib releases the GIL on large buffers
+        use_processes=True hashes batches of paths in a process pool, better for lots of small files
+        cache -> optional HashCache, files that have not changed since the last run are not read
+        engine -> HashEngine to hash with, md5 if not given
+        paths may be FileRecords from walk, their stat is used for the cache instead of stat'ing again
+        report -> RunReport, bytes read are added to its running stage (cache hits are counted by the HashCache)
+        """
+        workers = workers or os.cpu_count() or 1
+        stats = {}
+
+        def items():
+            for path in paths:
+                record = path if isinstance(path, FileRecord) else None
+                path = record.path if record else path
+                if cache is None and report is None:
+                    yield path, None
+                    continue
+                stats[path] = record or os.stat(path)
+                # cache is only touched from this thread, sqlite connections can't be shared
+                yield path, cache.get(path, stats[path]) if cache is not None else None
+
+        def store(item, hash_):
+            stat = stats.pop(item[0], None)
+            if item[1] is None:  # hashed now
+                if cache is not None:
+                    cache.put(item[0], stat, hash_)
+                if report is not None:
+                    report.add(bytes_read=stat.st_size)
+            return item[0], hash_
+
+        if workers == 1:  # no point paying for a pool
+            for item in items():
+                yield store(item, _hash_item(item, engine))
+            return
+
+        if use_processes:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                for batch, hashes in ordered_map(executor, partial(_hash_batch, engine=engine), _batches(items(), batch_size), workers * 2):
+                    for item, hash_ in zip(batch, hashes):
+                        yield store(item, hash_)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for item, hash_ in ordered_map(executor, partial(_hash_item, engine=engine), items(), workers * 4):
+                    yield store(item, hash_)
+
+    @staticmethod
+    def hash_file(path, engine=None):
+        """
+        hashes file with engine, md5 if not given
+        """
+        return (engine or HashEngine()).hash_file(path)
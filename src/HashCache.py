@@ -0,0 +1,95 @@
+import sqlite3
+import os.path as op
+import os
+import time
+
+
+class HashCache:
+    """
+    persistent cache of file hashes so unchanged files are not re-hashed on every backup
+    an entry is only used if the path, size, mtime and inode all still match the file on disk
+    and it was hashed with the same algorithm (see HashEngine)
+    stored as a sqlite database next to config.json, see ConfigMGR.get_hash_cache
+    paths are kept as utf-8 blobs (surrogateescape) so file names that aren't valid utf-8 can be cached
+
+    Usage: cache = HashCache(path to database); cache.get(path, stat); cache.put(path, stat, hash); cache.close()
+    """
+
+    VERSION = 3  # bump when the schema or hashing changes, old databases are then dropped
+    RACY_SECONDS = 2  # files modified this close to the scan may change again within the same mtime tick
+
+    def __init__(self, db_path: str, max_entries: int = 5000000, algorithm: str = "md5"):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.algorithm = algorithm
+        self.run_started = time.time_ns()
+        self.hits = 0
+        self.misses = 0
+        self.seen = []  # paths hit this run, last_seen is updated in bulk on commit
+
+        try:
+            self.db = self.__connect()
+        except sqlite3.DatabaseError:  # corrupt database, start again
+            os.remove(db_path)
+            self.db = self.__connect()
+
+    def __connect(self):
+        """
+        opens the database and creates or resets the table if the version is wrong
+        """
+        db = sqlite3.connect(self.db_path)
+        version = db.execute("PRAGMA user_version").fetchone()[0]
+        if version != self.VERSION:
+            db.execute("DROP TABLE IF EXISTS hashes")
+            db.execute("CREATE TABLE hashes (path BLOB PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+                       "inode INTEGER, algorithm TEXT, hash TEXT, last_seen INTEGER)")
+            db.execute("CREATE INDEX hashes_last_seen ON hashes (last_seen)")
+            db.execute(f"PRAGMA user_version = {self.VERSION}")
+            db.commit()
+        return db
+
+    def get(self, path: str, stat: os.stat_result):
+        """
+        returns the cached hash if the file has not changed since it was hashed else None
+        """
+        path = self.key(path)
+        row = self.db.execute("SELECT size, mtime_ns, inode, algorithm, hash FROM hashes WHERE path = ?",
+                              (path,)).fetchone()
+        if row and row[:4] == (stat.st_size, stat.st_mtime_ns, stat.st_ino, self.algorithm):
+            self.hits += 1
+            self.seen.append((self.run_started, path))
+            return row[4]
+        self.misses += 1
+        return None
+
+    def put(self, path: str, stat: os.stat_result, hash_: str):
+        """
+        stores a hash, stat must be taken before the file was read
+        files modified just before the backup started are skipped as they could change without mtime changing
+        """
+        if stat.st_mtime_ns >= self.run_started - self.RACY_SECONDS * 10 ** 9:
+            return
+        self.db.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (self.key(path), stat.st_size, stat.st_mtime_ns, stat.st_ino, self.algorithm, hash_,
+                         self.run_started))
+
+    @staticmethod
+    def key(path: str) -> bytes:
+        return op.abspath(path).encode("utf-8", "surrogateescape")
+
+    def commit(self):
+        """
+        writes pending changes and prunes the least recently seen entries if the cache is too big
+        """
+        self.db.executemany("UPDATE hashes SET last_seen = ? WHERE path = ?", self.seen)
+        self.seen = []
+
+        count = self.db.execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+        if count > self.max_entries:
+            self.db.execute("DELETE FROM hashes WHERE path IN "
+                            "(SELECT path FROM hashes ORDER BY last_seen LIMIT ?)", (count - self.max_entries,))
+        self.db.commit()
+
+    def close(self):
+        self.commit()
+        self.db.close()
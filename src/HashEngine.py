@@ -0,0 +1,117 @@
+import threading
+import hashlib
+import time
+import os
+from functools import lru_cache
+
+ALGORITHMS = ("md5", "sha256", "blake2b")
+FASTEST = "fastest"  # not an algorithm, the user's choice of whichever of ALGORITHMS is fastest here, see choose
+
+_buffers = threading.local()  # one reusable read buffer per thread
+
+
+class HashEngine:
+    """
+    hashes files and data with a selectable algorithm, the algorithm is recorded in the backup config
+    files are read with readinto into a reusable per thread buffer with a block size picked from the file size,
+    big files get bigger blocks so there are fewer calls per byte (not mmap, a file truncated while it is mapped
+    kills the process with SIGBUS, a read just comes up short)
+    blake2b uses a 32 byte digest so its names are the same length as sha256
+
+    Usage: HashEngine(algorithm from ALGORITHMS).hash_file(path) -> hex digest
+    """
+
+    SMALL_SIZE = 256 * 1024  # read in a single call
+    BLOCK_SIZE = 1024 * 1024  # block size for medium files
+    LARGE_SIZE = 64 * 1024 * 1024  # files from this size are read in LARGE_BLOCK_SIZE blocks
+    LARGE_BLOCK_SIZE = 8 * 1024 * 1024
+
+    def __init__(self, algorithm: str = "md5"):
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"algorithm must be one of {ALGORITHMS}")
+        self.algorithm = algorithm
+
+    def new(self):
+        """
+        returns a new hashlib object
+        """
+        if self.algorithm == "blake2b":
+            return hashlib.blake2b(digest_size=32)
+        return hashlib.new(self.algorithm)
+
+    def hash_bytes(self, data) -> str:
+        h = self.new()
+        h.update(data)
+        return h.hexdigest()
+
+    @property
+    def empty(self) -> str:
+        """
+        hash of an empty file
+        """
+        return self.new().hexdigest()
+
+    def block_size(self, size: int) -> int:
+        if size <= self.SMALL_SIZE:
+            return self.SMALL_SIZE
+        return self.BLOCK_SIZE if size < self.LARGE_SIZE else self.LARGE_BLOCK_SIZE
+
+    @staticmethod
+    def buffer(size: int) -> memoryview:
+        """
+        returns a view of this thread's read buffer, grown when needed
+        """
+        if getattr(_buffers, "data", None) is None or len(_buffers.data) < size:
+            _buffers.data = bytearray(size)
+        return memoryview(_buffers.data)[:size]
+
+    def hash_file(self, path: str) -> str:
+        h = self.new()
+        with open(path, "rb", buffering=0) as f:
+            size = os.fstat(f.fileno()).st_size
+            view = self.buffer(self.block_size(size))
+            while True:
+                read = f.readinto(view)
+                if not read:
+                    break
+                h.update(view[:read])
+        return h.hexdigest()
+
+
+def benchmark(size: int = 32 * 1024 * 1024, rounds: int = 3) -> dict:
+    """
+    measures each algorithm on this machine, returns {algorithm: MB/s} using the best of rounds
+    """
+    data = os.urandom(size)
+    results = {}
+    for algorithm in ALGORITHMS:
+        engine = HashEngine(algorithm)
+        best = float("inf")
+        for _ in range(rounds):
+            start = time.perf_counter()
+            engine.hash_bytes(data)
+            best = min(best, time.perf_counter() - start)
+        results[algorithm] = size / 1e6 / max(best, 1e-9)
+    return results
+
+
+@lru_cache(maxsize=None)
+def fastest(size: int = 32 * 1024 * 1024) -> str:
+    """
+    returns the fastest algorithm on this machine, benchmarked once per process
+    """
+    results = benchmark(size)
+    return max(results, key=results.get)
+
+
+def choose(algorithm: str) -> str:
+    """
+    algorithm to hash with for an option from ALGORITHMS or FASTEST, the benchmark only runs for FASTEST
+    the choice is recorded in the backup like any other, restores never need to benchmark
+    """
+    return fastest() if algorithm == FASTEST else algorithm
+
+
+if __name__ == "__main__":
+    for name, speed in sorted(benchmark().items(), key=lambda item: -item[1]):
+        print(f"{name}: {speed:.0f} MB/s")
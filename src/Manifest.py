@@ -0,0 +1,180 @@
+import struct
+from HashEngine import HashEngine
+
+MAGIC = b"BUMANIF1"
+COUNTS = struct.Struct("<QQQQ")  # directories, chunked files, blobs, files
+PATH = struct.Struct("<HI")  # bytes shared with the previous path, length of the rest
+COUNT = struct.Struct("<I")
+
+WRITE_SIZE = 64 * 1024
+PATH_ERRORS = "surrogateescape"  # file names that aren't valid utf-8 (posix allows any bytes) keep their bytes
+ALIASES_ENTRY = "aliases"  # entry next to the manifest, hash -> entry name of files stored before they were hashed
+
+
+class Manifest:
+    """
+    lazy reader of the binary manifest that replaces the json config of a backup
+    layout, written by write_manifest:
+        magic | algorithm name (length byte + ascii) | counts
+        directory table: front coded paths
+        chunk table: digest | chunk count | chunk digests         for files stored in chunks
+        blob table: digest | path count | front coded paths      one per unique file
+    digests are raw bytes and every path only stores what differs from the path before it
+    paths are utf-8, bytes of names that aren't valid utf-8 are kept as they are (see PATH_ERRORS)
+
+    the directory and chunk tables are read up front, the blob table is streamed every time items() is called
+    so a restore never holds the whole file tree, it quacks like the file_tree dict (len, items, keys, values)
+
+    Usage: Manifest(function returning a new binary stream of the manifest)
+    """
+
+    def __init__(self, opener):
+        self.opener = opener
+        with opener() as f:
+            self.read_head(_Reader(f))
+
+    @staticmethod
+    def is_manifest(head: bytes) -> bool:
+        return head.startswith(MAGIC)
+
+    def read_head(self, reader):
+        """
+        reads everything before the blob table
+        """
+        if reader.read(len(MAGIC)) != MAGIC:
+            raise ValueError("not a manifest")
+        self.algorithm = reader.read(reader.read(1)[0]).decode()
+        self.digest_size = len(bytes.fromhex(HashEngine(self.algorithm).empty))
+        directories, chunked, self.blob_count, self.file_count = reader.unpack(COUNTS)
+
+        previous = b""
+        self.directory_tree = []
+        for _ in range(directories):
+            previous = reader.path(previous)
+            self.directory_tree.append(previous.decode("utf-8", PATH_ERRORS))
+
+        self.chunks = {}
+        for _ in range(chunked):
+            hash_ = reader.read(self.digest_size).hex()
+            data = reader.read(reader.unpack(COUNT)[0] * self.digest_size)
+            self.chunks[hash_] = [data[i:i + self.digest_size].hex() for i in range(0, len(data), self.digest_size)]
+
+    def __len__(self):
+        return self.blob_count
+
+    def items(self):
+        """
+        yields (hash, [paths]) for every unique file, reading the blob table as it goes
+        """
+        with self.opener() as f:
+            reader = _Reader(f)
+            self.read_head(reader)  # the head is small, cheaper to read again than to seek in a compressed stream
+
+            previous = b""
+            for _ in range(self.blob_count):
+                hash_ = reader.read(self.digest_size).hex()
+                paths = []
+                for _ in range(reader.unpack(COUNT)[0]):
+                    previous = reader.path(previous)
+                    paths.append(previous.decode("utf-8", PATH_ERRORS))
+                yield hash_, paths
+
+    def keys(self):
+        return (hash_ for hash_, _ in self.items())
+
+    def values(self):
+        return (paths for _, paths in self.items())
+
+    def __iter__(self):
+        return self.keys()
+
+
+class _Reader:
+    """
+    buffered reader over the manifest stream, avoids a read call per field
+    """
+
+    def __init__(self, f, block_size=1024 * 1024):
+        self.f = f
+        self.block_size = block_size
+        self.buf = b""
+        self.pos = 0
+
+    def read(self, n: int) -> bytes:
+        if self.pos + n > len(self.buf):
+            self.buf = self.buf[self.pos:] + self.f.read(max(n, self.block_size))
+            self.pos = 0
+            if len(self.buf) < n:
+                raise ValueError("manifest is truncated")
+        data = self.buf[self.pos:self.pos + n]
+        self.pos += n
+        return data
+
+    def unpack(self, struct_: struct.Struct):
+        return struct_.unpack(self.read(struct_.size))
+
+    def path(self, previous: bytes) -> bytes:
+        shared, rest = self.unpack(PATH)
+        return previous[:shared] + self.read(rest)
+
+
+def _shared(a: bytes, b: bytes) -> int:
+    """
+    length of the common prefix, binary search so the comparing is done by bytes slices in C
+    """
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def _path(previous: bytes, path: bytes) -> bytes:
+    shared = min(_shared(previous, path), 0xFFFF)
+    return PATH.pack(shared, len(path) - shared) + path[shared:]
+
+
+def write_manifest(f, config_dict: dict):
+    """
+    streams the manifest of a backup config dict ("directory_tree", "file_tree", "chunks", "hash_algorithm")
+    to a binary file object, written in WRITE_SIZE pieces so the whole thing is never built in memory
+    """
+    algorithm = config_dict.get("hash_algorithm", "md5")
+    directories = config_dict["directory_tree"]
+    file_tree = config_dict["file_tree"]
+    chunks = config_dict.get("chunks", {})
+
+    out = bytearray()
+
+    def flush(force=False):
+        if force or len(out) >= WRITE_SIZE:
+            f.write(bytes(out))
+            out.clear()
+
+    out += MAGIC + bytes([len(algorithm)]) + algorithm.encode()
+    out += COUNTS.pack(len(directories), len(chunks), len(file_tree), sum(len(paths) for paths in file_tree.values()))
+
+    previous = b""
+    for directory in directories:
+        path = directory.encode("utf-8", PATH_ERRORS)
+        out += _path(previous, path)
+        previous = path
+        flush()
+
+    for hash_, chunk_hashes in chunks.items():
+        out += bytes.fromhex(hash_) + COUNT.pack(len(chunk_hashes)) + bytes.fromhex("".join(chunk_hashes))
+        flush()
+
+    previous = b""
+    for hash_, paths in file_tree.items():
+        out += bytes.fromhex(hash_) + COUNT.pack(len(paths))
+        for path in paths:
+            path = path.encode("utf-8", PATH_ERRORS)
+            out += _path(previous, path)
+            previous = path
+        flush()
+
+    flush(force=True)
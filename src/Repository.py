@@ -0,0 +1,189 @@
+import os.path as op
+import os
+import pathlib
+import tempfile
+import json
+import shutil
+from Manifest import Manifest, write_manifest, MAGIC
+
+
+class WrongRepositoryPassword(Exception):
+    pass
+
+
+class Repository:
+    """
+    content addressed store of encrypted blobs shared by every incremental snapshot in a backup folder
+    layout:
+        backup_path/repository.locked                  encrypted marker, used to check the password
+        backup_path/blobs/ab/abcdef...blob.locked      one encrypted blob per unique file or chunk hash
+        backup_path/blobs/ab/abcdef...chunks.locked    chunk hashes of a file stored in chunks (see Chunker)
+        backup_path/snapshots/date.snapshot.locked     encrypted manifest (older ones json config) of a single backup
+
+    a snapshot only adds the blobs the repository does not already have
+
+    Usage: Repository(backup path, Crypto object)
+    """
+
+    MARKER = b"BackupUtility repository v1"
+
+    def __init__(self, path: str, crypto):
+        self.path = path
+        self.crypto = crypto
+        self.blob_path = op.join(path, "blobs")
+        self.snapshot_path = op.join(path, "snapshots")
+
+        pathlib.Path(self.blob_path).mkdir(parents=True, exist_ok=True)
+        pathlib.Path(self.snapshot_path).mkdir(parents=True, exist_ok=True)
+
+        self.check_marker()
+
+    @staticmethod
+    def from_snapshot(snapshot_path: str, crypto):
+        """
+        opens the repository a snapshot file belongs to
+        """
+        return Repository(op.dirname(op.dirname(op.abspath(snapshot_path))), crypto)
+
+    @staticmethod
+    def is_snapshot(path: str) -> bool:
+        return path.endswith(".snapshot.locked")
+
+    def check_marker(self):
+        """
+        creates the marker on a new repository, otherwise checks the password can decrypt it
+        stops a snapshot with a different password from mixing unreadable blobs into the repository
+        """
+        marker = op.join(self.path, "repository.locked")
+        with tempfile.TemporaryDirectory() as temp:
+            plain = op.join(temp, "repository")
+            if not op.exists(marker):
+                with open(plain, "wb") as f:
+                    f.write(self.MARKER)
+                self.crypto.encrypt_file(plain, marker + ".tmp")
+                os.replace(marker + ".tmp", marker)
+                return
+
+            try:
+                self.crypto.decrypt_file(marker, plain)
+            except ValueError:  # segmented marker failed authentication
+                raise WrongRepositoryPassword(self.path)
+            with open(plain, "rb") as f:
+                if f.read() != self.MARKER:
+                    raise WrongRepositoryPassword(self.path)
+
+    def blob_file(self, hash_: str) -> str:
+        return op.join(self.blob_path, hash_[:2], hash_ + ".blob.locked")
+
+    def has_blob(self, hash_: str) -> bool:
+        return op.exists(self.blob_file(hash_))
+
+    def put_blob(self, hash_: str, source: str, engine=None) -> bool:
+        """
+        encrypts source into the repository under its hash, returns False if the blob was already stored
+        written to a temp name first so an interrupted backup never leaves a partial blob
+        engine -> HashEngine the hash was made with, the data is hashed as it is encrypted and OSError raised
+        (nothing stored) if it no longer matches, a blob is never kept under the hash of other contents
+        """
+        dest = self.blob_file(hash_)
+        if op.exists(dest):
+            return False
+
+        pathlib.Path(op.dirname(dest)).mkdir(exist_ok=True)
+        digest = engine.new() if engine is not None else None
+        writer = self.crypto.open_segment_writer(dest + ".tmp")
+        try:
+            with open(source, "rb") as src:
+                for block in iter(lambda: src.read(1024 * 1024), b""):
+                    if digest is not None:
+                        digest.update(block)
+                    writer.write(block)
+            if digest is not None and digest.hexdigest() != hash_:
+                raise OSError(f"{source} changed while it was backed up")
+        except BaseException:
+            writer.abort()
+            raise
+        writer.close()
+        os.replace(writer.name, dest)
+        return True
+
+    def get_blob(self, hash_: str, dest: str):
+        """
+        decrypts a blob to dest
+        """
+        self.crypto.decrypt_file(self.blob_file(hash_), dest)
+
+    def open_blob(self, hash_: str):
+        """
+        returns a reader over the plaintext of a blob
+        """
+        return self.crypto.open_reader(self.blob_file(hash_))
+
+    def put_blob_data(self, hash_: str, data: bytes) -> bool:
+        """
+        same as put_blob for data already in memory, used for chunks
+        """
+        return self.__put_data(self.blob_file(hash_), data)
+
+    def __put_data(self, dest: str, data: bytes) -> bool:
+        if op.exists(dest):
+            return False
+
+        pathlib.Path(op.dirname(dest)).mkdir(exist_ok=True)
+        temp = dest + ".tmp"
+        writer = self.crypto.open_segment_writer(temp)
+        writer.write(data)
+        writer.close()
+        os.replace(temp, dest)
+        return True
+
+    def chunk_list_file(self, hash_: str) -> str:
+        return op.join(self.blob_path, hash_[:2], hash_ + ".chunks.locked")
+
+    def put_chunk_list(self, hash_: str, chunk_hashes: list):
+        """
+        records the chunks a file is made of, later snapshots of the unchanged file reuse it without reading it
+        """
+        self.__put_data(self.chunk_list_file(hash_), json.dumps(chunk_hashes).encode())
+
+    def get_chunk_list(self, hash_: str):
+        """
+        returns the chunk hashes of a file stored in chunks or None
+        """
+        if not op.exists(self.chunk_list_file(hash_)):
+            return None
+        with self.crypto.open_reader(self.chunk_list_file(hash_)) as f:
+            return json.loads(f.read())
+
+    def get_chunked(self, chunk_hashes: list, dest: str):
+        """
+        reassembles a file stored in chunks to dest
+        """
+        with open(dest, "wb") as dst:
+            for chunk_hash in chunk_hashes:
+                with self.open_blob(chunk_hash) as src:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+
+    def put_snapshot(self, name: str, config_dict: dict) -> str:
+        """
+        streams the manifest of a snapshot config, encrypted, into the snapshots folder and returns its path
+        """
+        dest = op.join(self.snapshot_path, name + ".snapshot.locked")
+        with self.crypto.open_segment_writer(dest + ".tmp") as writer:
+            write_manifest(writer, config_dict)
+        os.replace(dest + ".tmp", dest)
+        return dest
+
+    def get_snapshot(self, snapshot_path: str):
+        """
+        returns a Manifest read straight from the encrypted snapshot, or the parsed config of an older json snapshot
+        """
+        with self.crypto.open_reader(snapshot_path) as f:
+            if not Manifest.is_manifest(f.read(len(MAGIC))):
+                f.seek(0)
+                return json.loads(f.read().decode().strip())
+        return Manifest(lambda: self.crypto.open_reader(snapshot_path))
+
+    def list_snapshots(self) -> list:
+        return sorted(op.join(self.snapshot_path, name) for name in os.listdir(self.snapshot_path)
+                      if self.is_snapshot(name))
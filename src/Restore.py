@@ -1,9 +1,35 @@
 import zipfile
-import tempfile
-from crypto import Crypto
+import struct
+import fnmatch
+import errno
+import io
+from crypto import Crypto, WrongPassword, DamagedSegment
+from Repository import Repository, WrongRepositoryPassword
+from Manifest import Manifest, ALIASES_ENTRY
+from FileItter import FileItter, FileRecord, ordered_map
+from HashEngine import HashEngine
+from RunReport import RunReport
+from Volumes import VolumeSet, DamagedVolume, INDEX_ENTRY
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import os.path as op
+import os
 import pathlib
 import json
 import shutil
+import time
+import zlib
+import stat as stat_
+
+try:
+    import fcntl
+except ImportError:  # windows, reflinks are not supported
+    fcntl = None
+
+# stored data that can't be read back
+ARCHIVE_ERRORS = (DamagedSegment, DamagedVolume, zipfile.BadZipFile, zlib.error, EOFError)
+FICLONE = 0x40049409  # linux ioctl, clones a file's extents on btrfs/xfs/ocfs2
+LINK_MODES = ("copy", "hardlink", "reflink")
 
 
 class InvalidPassword(Exception):
@@ -14,98 +40,691 @@ class BadBackupFile(Exception):
     pass
 
 
+def materialize(source: str, dest: str, link_mode: str = "copy"):
+    """
+    creates dest with the contents of source
+    copy -> full copy, hardlink -> hard link to source, reflink -> copy on write clone where the filesystem
+    supports it, otherwise copy_file_range so the copy is done in the kernel
+    links fall back to a full copy when the filesystem refuses them
+    """
+    if op.lexists(dest):
+        os.remove(dest)
+
+    if link_mode == "hardlink":
+        try:
+            return os.link(source, dest)
+        except OSError:
+            pass
+    elif link_mode == "reflink":
+        with open(source, "rb") as src, open(dest, "wb") as dst:
+            try:
+                return fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            except (OSError, AttributeError):
+                pass
+            try:
+                remaining = os.fstat(src.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+                return
+            except (OSError, AttributeError):
+                src.seek(0)
+                dst.seek(0)
+                dst.truncate()
+
+    shutil.copy(source, dest)
+
+
+def match_path(path: str, patterns) -> bool:
+    """
+    True if path matches a glob pattern or is inside a directory prefix
+    separators are compared as / and the leading separator is optional
+    """
+    path = "/" + path.replace("\\", "/").lstrip("/")
+    for pattern in patterns:
+        pattern = "/" + pattern.replace("\\", "/").lstrip("/")
+        prefix = pattern.rstrip("/")
+        if fnmatch.fnmatchcase(path, pattern) or path == prefix or path.startswith(prefix + "/"):
+            return True
+    return False
+
+
+class FileWindow(io.RawIOBase):
+    """
+    seekable read only view of size bytes of a file object starting at offset
+    used to open a zip stored uncompressed inside another zip without extracting it
+    """
+
+    def __init__(self, fileobj, offset: int, size: int):
+        super().__init__()
+        self.fileobj = fileobj
+        self.offset = offset
+        self.size = size
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.pos = max(offset, 0)
+        return self.pos
+
+    def readinto(self, buffer):
+        length = max(min(len(buffer), self.size - self.pos), 0)
+        self.fileobj.seek(self.offset + self.pos)
+        read = self.fileobj.readinto(memoryview(buffer)[:length])
+        self.pos += read
+        return read
+
+
 class Restore:
     """
     Restore class restores file from a correctly formatted .zip.locked file
     files names and data are preserved, file system specific meta data lost such as original data created etc.
+    also restores incremental snapshots (date.snapshot.locked) from their repository
+    split archives are restored from their index volume, only the data volumes holding requested files are read
+    archives are decrypted in place and each file is streamed straight to its destination, nothing goes via temp
     Usage: Restore(date backups.zip.locked path, destination directory, password to decrypt backup)
+    optional: workers -> number of threads writing files (defaults to cpu count)
+              link_mode -> how paths sharing a hash are created, one of LINK_MODES
+              differential -> restore over an existing tree, files already there with the right hash are kept
+                              and only missing or different ones are written, see compare_existing
+              delete_extras -> with differential, files and folders in the destination that are not in the
+                               backup (and match the patterns, if any) are deleted
+              hash_cache -> HashCache used by differential, unchanged destination files are not hashed again
+              profile -> name of a stage (manifest, directories, compare, extract, delete, verify) to run
+                         under cProfile, see RunReport
     """
 
-    def __init__(self, backup_path: str, restore_path: str, password: str):
+    def __init__(self, backup_path: str, restore_path: str, password: str,
+                 workers: int = None, link_mode: str = "copy", differential: bool = False,
+                 delete_extras: bool = False, hash_cache=None, profile: str = None):
+        if link_mode not in LINK_MODES:
+            raise ValueError(f"link_mode must be one of {LINK_MODES}")
+
         self.backup_path = backup_path
         self.restore_path = restore_path
+        self.workers = workers or os.cpu_count() or 1
+        self.link_mode = link_mode
+        self.differential = differential
+        self.delete_extras = delete_extras
+        self.hash_cache = hash_cache
 
-        pathlib.Path(restore_path).mkdir(parents=True, exist_ok=True)  # create restore directory
+        if restore_path:  # listing doesn't need a destination
+            pathlib.Path(restore_path).mkdir(parents=True, exist_ok=True)  # create restore directory
 
-        self.tempfile = tempfile.TemporaryDirectory()
+        self.crypto = Crypto(password, self.workers)
 
-        self.crypto = Crypto(password)
+        self.reader = None  # SegmentReader of a segmented archive
+        self.backup_zip = None
+        self.duplicates_zip = None  # ZipFile of duplicates.zip, a VolumeSet for split archives
+        self.chunks = {}  # file hash -> chunk hashes for files backed up with chunking
+        self.aliases = {}  # file hash -> entry name for files stored before they were hashed, see Backup.write_unhashed
+        self.hash_algorithm = "md5"  # algorithm the hashes in the config were made with, older backups are md5
+        self.stats = {}  # filled in by restore, see materialize_all
+        self.report = RunReport(profile)  # per stage measurements, also handed to ui_caller(func="report")
 
-    def restore(self, ui_caller=print):
+    def restore(self, ui_caller=print, patterns=None):
 
         """
         groups restore functions and runs in correct order
+        patterns -> optional list of glob patterns or path prefixes, only matching paths are restored
         """
-        ui_caller("Step 1 of 4: unzipping files")
+        if Repository.is_snapshot(self.backup_path):
+            return self.restore_snapshot(ui_caller, patterns)
+
+        ui_caller("Step 1 of 3: parsing config")
+        with self.report.stage("manifest"):
+            dir_tree, file_tree = self.filter_trees(*self.read_config(), patterns)
+
         try:
-            self.unzip_to_temp()
-        except zipfile.BadZipFile:  # incorrect password
-            self.tempfile.cleanup()
-            raise InvalidPassword()
+            ui_caller("Step 2 of 3: building directory tree")
+            self.build_directory_tree(dir_tree)
+
+            ui_caller("Step 3 of 3: restoring files")
+            self.restore_files(file_tree, ui_caller)
+            if self.differential and self.delete_extras:
+                self.remove_extras(dir_tree, file_tree, patterns, ui_caller)
+        except ARCHIVE_ERRORS as e:
+            raise BadBackupFile(self.backup_path) from e
+        finally:
+            self.close()
+        ui_caller("done!")
+        self.finish_report(ui_caller)
+        return True
+
+    def finish_report(self, ui_caller):
+        """
+        adds the run report to the stats and hands it to the ui
+        """
+        self.stats["report"] = self.report.as_dict()
+        ui_caller(func="report", report=self.stats["report"])
+
+    def list(self, patterns=None) -> list:
+        """
+        returns sorted (path, hash) of the files in the backup matching patterns
+        only the config is read, no file data is decrypted for segmented archives and snapshots
+        """
+        if Repository.is_snapshot(self.backup_path):
+            file_tree = self.use_config(self.read_snapshot()[1])[1]
+        else:
+            file_tree = self.read_config()[1]
+
+        try:
+            file_tree = self.filter_trees([], file_tree, patterns)[1]
+            return sorted((path, hash_) for hash_, paths in file_tree.items() for path in paths)
+        finally:
+            self.close()
+
+    def verify(self, ui_caller=print) -> list:
+        """
+        checks the backup in memory without writing anything, returns one report per bad entry
+        {"name": archive entry or blob hash, "error": what is wrong, "paths": backed up paths that depend on it}
+        every blob the manifest refers to must exist, each one is decrypted, decompressed and hashed again with
+        the backup's hash algorithm by worker threads and compared to its hash, chunks against their own hash
+        archive entries are read in the order they are stored so the archive is decrypted front to back
+        """
+        with self.report.stage("manifest"):
+            if Repository.is_snapshot(self.backup_path):
+                repository, config = self.read_snapshot()
+                file_tree = self.use_config(config)[1]
+                entry = lambda hash_, chunk: hash_
+                read = repository.open_blob
+                order = lambda name: name
+                volumes = None
+                size_of = lambda name: op.getsize(repository.blob_file(name)) if repository.has_blob(name) else 0
+            else:
+                file_tree = self.read_config()[1]
+                entry = lambda hash_, chunk: \
+                    hash_ + ".chunk" if chunk else self.aliases.get(hash_, hash_ + ".duplicate")
+                read = self.duplicates_zip.open
+                volumes = self.duplicates_zip if isinstance(self.duplicates_zip, VolumeSet) else None
+                offsets = {name: zinfo.header_offset for name, zinfo in self.duplicates_zip.NameToInfo.items()}
+                order = lambda name: offsets.get(name, -1)  # missing entries first, they fail fast
+                size_of = lambda name: self.duplicates_zip.NameToInfo[name].file_size if name in offsets else 0
+
+        engine = HashEngine(self.hash_algorithm)
+
+        def check(item):
+            """
+            returns (error or None, bytes read)
+            """
+            name, hash_ = item
+            digest = engine.new()
+            size = 0
+            try:
+                with read(name) as src:
+                    while True:
+                        data = src.read(1024 * 1024)
+                        if not data:
+                            break
+                        digest.update(data)
+                        size += len(data)
+            except (KeyError, FileNotFoundError):
+                return "missing", size
+            except (zipfile.BadZipFile, ValueError, OSError, EOFError, zlib.error) as e:
+                return f"unreadable: {e}", size
+            if digest.hexdigest() != hash_:
+                return f"hash mismatch, contents hash to {digest.hexdigest()}", size
+            return None, size
+
+        try:
+            with self.report.stage("manifest"):
+                expected = {}  # entry name -> hash its contents must have
+                for hash_ in file_tree:
+                    for chunk_hash in self.chunks.get(hash_, ()):
+                        expected[entry(chunk_hash, True)] = chunk_hash
+                    if hash_ not in self.chunks:
+                        expected[entry(hash_, False)] = hash_
+                items = sorted(expected.items(), key=lambda item: order(item[0]))
 
-        ui_caller("Step 2 of 4: parsing config")
-        dir_tree, file_tree = self.parse_config()
+            ui_caller(func="start_progress_bar")  # progress is in bytes of stored data
+            ui_caller(func="set_progress_config", maximum=sum(size_of(name) for name, _ in items))
 
-        ui_caller("Step 3 of 3: building directory tree")
+            start = time.time()
+            bad = {}
+            read_bytes = 0
+            done = 0
+            with self.report.stage("verify"), ThreadPoolExecutor(max_workers=self.workers) as executor:
+                reader = self.data_reader()
+                results = ordered_map(executor, check, items, self.workers * 4)
+                for (name, _), (error, size) in results:
+                    read_bytes += size
+                    done += size_of(name)
+                    if error is not None:
+                        bad[name] = {"name": name, "error": error, "paths": []}
+                        if volumes is not None:  # the volume to copy again
+                            bad[name]["volume"] = volumes.volume_file(name)
+                        ui_caller(f"Bad: {name} ({error})")
+                    ui_caller(func="set_progress_config", value=done)
+                self.report.add(files=len(items), bytes_read=read_bytes)
+                if reader is not None:
+                    self.report.add(decrypt_seconds=reader.crypto_seconds)
+
+            if bad:  # second pass over the file tree to name the paths each bad entry breaks
+                for hash_, paths in file_tree.items():
+                    names = [entry(chunk_hash, True) for chunk_hash in self.chunks[hash_]] if hash_ in self.chunks \
+                        else [entry(hash_, False)]
+                    for name in names:
+                        if name in bad:
+                            bad[name]["paths"].extend(paths)
+        finally:
+            self.close()
+
+        ui_caller(func="stop_progress_bar")
+
+        elapsed = max(time.time() - start, 1e-6)
+        self.stats = {"entries": len(items), "bad": len(bad), "bytes_read": read_bytes, "seconds": elapsed}
+        ui_caller(f"Verified {len(items)} stored files ({read_bytes / 1e6:.1f} MB) at "
+                  f"{read_bytes / 1e6 / elapsed:.1f} MB/s, {len(bad)} bad")
+        if volumes is not None:
+            self.stats["bad_volumes"] = sorted({report["volume"] for report in bad.values()})
+            if self.stats["bad_volumes"]:
+                ui_caller(f"Damaged volumes: {', '.join(self.stats['bad_volumes'])}")
+        self.finish_report(ui_caller)
+        return list(bad.values())
+
+    def restore_snapshot(self, ui_caller, patterns=None):
+        """
+        restores an incremental snapshot, blobs are decrypted straight from the repository to their paths
+        """
+        ui_caller("Step 1 of 3: reading snapshot")
+        with self.report.stage("manifest"):
+            repository, config = self.read_snapshot()
+            dir_tree, file_tree = self.filter_trees(*self.use_config(config), patterns)
+
+        ui_caller("Step 2 of 3: building directory tree")
         self.build_directory_tree(dir_tree)
 
-        ui_caller("Step 4 of 4: restoring files")
-        self.restore_files(file_tree, ui_caller)
+        ui_caller("Step 3 of 3: restoring files")
+        try:
+            self.restore_repository_files(repository, file_tree, ui_caller)
+        except ARCHIVE_ERRORS as e:
+            raise BadBackupFile(self.backup_path) from e
+        if self.differential and self.delete_extras:
+            self.remove_extras(dir_tree, file_tree, patterns, ui_caller)
 
-        self.tempfile.cleanup()
         ui_caller("done!")
+        self.finish_report(ui_caller)
         return True
 
-    def unzip_to_temp(self):
+    def read_snapshot(self):
         """
-        decrypts and unzips backup file to temp folder and relevant internal zips
-        order: date backup.zip.locked -> backup.zip -> config, duplicates.zip -> config, duplicates.zip, *.duplicate
+        opens the repository of a snapshot, returns (repository, Manifest or json config of older snapshots)
         """
-        temp_zip = self.tempfile.name + "\\backup.zip"
+        try:
+            repository = Repository.from_snapshot(self.backup_path, self.crypto)
+            return repository, repository.get_snapshot(self.backup_path)
+        except WrongRepositoryPassword:
+            raise InvalidPassword()
+        except (OSError, ValueError) as e:  # missing repository or unreadable snapshot
+            raise BadBackupFile(self.backup_path) from e
+
+    def read_config(self):
+        """
+        opens the backup and returns (directory tree, file tree) from its config
+        """
+        try:
+            self.open_backup()
+            return self.parse_config()
+        except WrongPassword:
+            self.close()
+            raise InvalidPassword()
+        except zipfile.BadZipFile as e:
+            self.close()
+            if not Crypto.is_segmented(self.backup_path):  # a wrong password decrypts the original format to garbage
+                raise InvalidPassword()
+            raise BadBackupFile(self.backup_path) from e
+        except (ValueError, OSError, EOFError, zlib.error) as e:  # a segment failed authentication, damaged manifest
+            self.close()
+            raise BadBackupFile(self.backup_path) from e
 
+    def open_backup(self):
+        """
+        opens backup.zip and the duplicates.zip inside it without extracting anything
+        order: date backup.zip.locked -> backup.zip -> config, duplicates.zip -> *.duplicate
+        both formats are decrypted in place, only the parts that are read get decrypted
+        duplicates.zip is stored uncompressed so it is read through a window onto its data in backup.zip
+        split archives have a volume index instead of duplicates.zip, the volumes are opened as they are needed
+        """
         try:
-            self.crypto.decrypt_file(self.backup_path, temp_zip)
-        except BaseException:  # struct.error: unpack requires a buffer of 8 bytes raised if file invalid
-            self.tempfile.cleanup()
-            raise BadBackupFile(self.backup_path)
+            self.reader = self.crypto.open_reader(self.backup_path)
+        except WrongPassword:
+            raise InvalidPassword()
+        except (ValueError, OSError) as e:
+            raise BadBackupFile(self.backup_path) from e
 
-        with zipfile.ZipFile(temp_zip, mode="r", allowZip64=True) as zipf:
-            zipf.extractall(path=self.tempfile.name)
+        self.backup_zip = zipfile.ZipFile(self.reader, mode="r", allowZip64=True)
 
-        with zipfile.ZipFile(self.tempfile.name + "\\duplicates.zip", mode="r", allowZip64=True) as zipf:
-            zipf.extractall(path=self.tempfile.name)
+        if INDEX_ENTRY in self.backup_zip.NameToInfo:
+            self.duplicates_zip = VolumeSet(json.loads(self.backup_zip.read(INDEX_ENTRY)),
+                                            op.dirname(op.abspath(self.backup_path)), self.crypto, self.workers)
+            return
+
+        zinfo = self.backup_zip.getinfo("duplicates.zip")
+        self.backup_zip.fp.seek(zinfo.header_offset)
+        header = struct.unpack(zipfile.structFileHeader, self.backup_zip.fp.read(zipfile.sizeFileHeader))
+        offset = zinfo.header_offset + zipfile.sizeFileHeader \
+            + header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH]
+
+        self.duplicates_zip = zipfile.ZipFile(FileWindow(self.backup_zip.fp, offset, zinfo.file_size),
+                                              mode="r", allowZip64=True)
+
+    def close(self):
+        """
+        closes the backup
+        """
+        for file in (self.duplicates_zip, self.backup_zip, self.reader):
+            if file is not None:
+                file.close()
+        self.duplicates_zip = self.backup_zip = self.reader = None
 
     def parse_config(self):
         """
-        parses json from config file in temp folder
+        opens the manifest in backup.zip, older backups have a json config file instead
+        the manifest is read lazily so the backup must stay open while the file tree is used
+        """
+        if ALIASES_ENTRY in self.backup_zip.NameToInfo:
+            self.aliases = json.loads(self.backup_zip.read(ALIASES_ENTRY))
+        if "manifest" in self.backup_zip.NameToInfo:
+            return self.use_config(Manifest(self.open_manifest))
+        return self.use_config(json.loads(self.backup_zip.read("config").decode().strip()))
+
+    @contextmanager
+    def open_manifest(self):
+        """
+        opens the manifest on a reader of its own, the file tree is streamed from it while worker threads
+        read blobs through self.reader and a reader can't be shared between threads
         """
-        with open(self.tempfile.name + "\\config", "r") as f:
-            _json = json.loads(f.read().strip())
-        return _json["directory_tree"], _json["file_tree"]
+        with self.crypto.open_reader(self.backup_path) as reader, \
+                zipfile.ZipFile(reader, mode="r", allowZip64=True) as backup_zip, backup_zip.open("manifest") as f:
+            yield f
+
+    def use_config(self, config):
+        """
+        config -> Manifest or parsed json config, returns (directory tree, file tree)
+        the file tree is a dict {hash: [paths]} or the Manifest itself, which streams the same items
+        """
+        if isinstance(config, Manifest):
+            self.chunks = config.chunks
+            self.hash_algorithm = config.algorithm
+            return config.directory_tree, config
+        self.chunks = config.get("chunks", {})
+        self.hash_algorithm = config.get("hash_algorithm", "md5")
+        return config["directory_tree"], config["file_tree"]
+
+    def extract_blob(self, hash_: str, dest: str):
+        """
+        streams hash.duplicate from inside the archive straight to dest
+        files stored in chunks are joined back together from their hash.chunk entries
+        """
+        with open(dest, "wb") as dst:
+            for name in self.entry_names(hash_):
+                with self.duplicates_zip.open(name) as src:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+
+    def entry_names(self, hash_: str) -> list:
+        """
+        names of the archive entries holding a file, its chunks, its alias or hash.duplicate
+        """
+        if hash_ in self.chunks:
+            return [chunk_hash + ".chunk" for chunk_hash in self.chunks[hash_]]
+        if hash_ in self.aliases:
+            return [self.aliases[hash_]]
+        return [hash_ + ".duplicate"]
+
+    def data_reader(self):
+        """
+        what file data is decrypted through, its bytes_read and crypto_seconds go in the report
+        """
+        return self.duplicates_zip if isinstance(self.duplicates_zip, VolumeSet) else self.reader
+
+    def blob_size(self, hash_: str):
+        """
+        size of a stored file, read from the archive's entries, None for snapshots as blob sizes aren't recorded
+        """
+        if self.duplicates_zip is None:
+            return None
+        return sum(self.duplicates_zip.getinfo(name).file_size for name in self.entry_names(hash_))
+
+    @staticmethod
+    def filter_trees(dir_tree: list, file_tree: dict, patterns=None):
+        """
+        keeps the paths matching any of the patterns, returns (directory tree, file tree)
+        parents of kept files are added to the directory tree so they can be restored into
+        """
+        if not patterns:
+            return dir_tree, file_tree
+
+        files = {}
+        for hash_, paths in file_tree.items():
+            paths = [path for path in paths if match_path(path, patterns)]
+            if paths:
+                files[hash_] = paths
+
+        dirs = {dir_ for dir_ in dir_tree if match_path(dir_, patterns)}
+        for paths in files.values():
+            for path in paths:
+                dirs.update(str(parent) for parent in pathlib.PurePath(path).parents if str(parent) not in ("/", "\\", "."))
+        return sorted(dirs), files
 
     def build_directory_tree(self, dir_tree: list):
         """
         iterates through dir tree parsed from config
         builds directory tree in destination folder
         uses Path.mkdir()
+        differential restores replace files that are in the way of a directory
         """
-        for dir_ in dir_tree:
-            pathlib.Path(self.restore_path + dir_).mkdir(parents=True, exist_ok=True)
+        with self.report.stage("directories"):
+            for dir_ in dir_tree:
+                path = self.restore_path + dir_
+                if self.differential and op.lexists(path) and not op.isdir(path):
+                    os.remove(path)
+                pathlib.Path(path).mkdir(parents=True, exist_ok=True)
+            self.report.add(files=len(dir_tree))
 
     def restore_files(self, file_tree: dict, ui_caller):
         """
         only to be used after build_directory_tree
-        iterates through keys (md5 hashes) and accesses values (list of paths)
-        copies files with hash.duplicate to its location in the destination directory with name corrected amended
+        iterates through keys (file hashes) and accesses values (list of paths)
+        streams hash.duplicate out of the archive to the first path then creates the other paths from it using link_mode
+        """
+        self.materialize_all(file_tree, self.extract_blob, self.blob_size, ui_caller)
+
+    def restore_repository_files(self, repository, file_tree: dict, ui_caller):
+        """
+        only to be used after build_directory_tree
+        decrypts each blob once to its first path and creates the rest from it using link_mode
+        """
+        def write_first(hash_, dest):
+            if hash_ in self.chunks:
+                repository.get_chunked(self.chunks[hash_], dest)
+            else:
+                repository.get_blob(hash_, dest)
+
+        def stored_size(hash_):  # encrypted size, close enough to weigh progress and count bytes read
+            return sum(op.getsize(repository.blob_file(blob)) for blob in self.chunks.get(hash_, [hash_]))
+
+        self.materialize_all(file_tree, write_first, stored_size, ui_caller)
+
+    def materialize_all(self, file_tree: dict, write_first, size_of, ui_caller):
+        """
+        writes every hash in parallel, write_first(hash, dest) creates the first path of a hash
+        size_of(hash) -> bytes of stored data read for a hash, progress moves by it
+        differential restores only write the paths that compare_existing found missing or different, a hash
+        with an intact copy in the destination is copied from there instead of being decrypted
+        reports files/s and MB/s when done
         """
+        start = time.time()
+        intact = {}
+        kept = 0
+        if self.differential:
+            with self.report.stage("compare"):
+                file_tree, intact, kept = self.compare_existing(file_tree, ui_caller)
+
+        def write(item):
+            hash_, paths = item
+            file_start = time.perf_counter()
+            source = intact.get(hash_)
+            if source is None:
+                source = self.restore_path + paths[0]
+                if self.differential:
+                    self.clear_path(source)
+                write_first(hash_, source)
+                paths = paths[1:]
+            for path in paths:
+                if self.differential:
+                    self.clear_path(self.restore_path + path)
+                materialize(source, self.restore_path + path, self.link_mode)
+            size = op.getsize(source)
+            self.report.file(item[1][0], time.perf_counter() - file_start, size)
+            return len(item[1]) * size
+
+        files = 0
+        written = 0
+        items = file_tree.items()
+        if isinstance(self.duplicates_zip, VolumeSet):  # several volumes are read at once
+            items = self.duplicates_zip.interleave(items, lambda item: self.entry_names(item[0])[0])
+
+        with self.report.stage("extract"):
+            reader = self.data_reader()
+            before = (reader.bytes_read, reader.crypto_seconds) if reader is not None else (0, 0.0)
+
+            ui_caller(func="start_progress_bar")  # progress is in bytes of stored data so it moves with the work left
+            ui_caller(func="set_progress_config", maximum=sum(size_of(hash_) for hash_ in file_tree))
+            done = 0
+
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                written_items = ordered_map(executor, write, items, self.workers * 4)
+                for (hash_, paths), size in written_items:
+                    files += len(paths)
+                    written += size
+                    stored = size_of(hash_) if hash_ not in intact else 0
+                    done += stored
+                    self.report.add(files=len(paths), bytes_written=size, bytes_read=stored if reader is None else 0)
+                    ui_caller(func="set_progress_config", value=done)
+
+            if reader is not None:
+                self.report.add(bytes_read=reader.bytes_read - before[0],
+                                decrypt_seconds=reader.crypto_seconds - before[1])
+
+            ui_caller(func="stop_progress_bar")
+
+        elapsed = max(time.time() - start, 1e-6)
+        self.stats = {"files": files, "bytes_written": written, "seconds": elapsed, "kept": kept}
+        ui_caller(f"Restored {files} files ({written / 1e6:.1f} MB) at "
+                  f"{files / elapsed:.0f} files/s, {written / 1e6 / elapsed:.1f} MB/s")
+        if self.differential:
+            ui_caller(f"Kept {kept} files that were already intact")
+
+    def compare_existing(self, file_tree: dict, ui_caller):
+        """
+        checks the destination against the file tree, returns (file tree of the paths still to write,
+        {hash: an intact destination path to copy from}, number of paths already intact)
+        every path is stat'ed, regular files of the right size (known for archives) are hashed like
+        FileItter.hash_file with the backup's algorithm, in parallel and through the hash cache if there is one
+        """
+        ui_caller("Comparing with existing files")
+        cache = self.hash_cache if self.hash_cache is not None and self.hash_cache.algorithm == self.hash_algorithm \
+            else None
+
+        candidates = []  # FileRecords of destination files that may be intact
+        expected = {}  # destination path -> hash it must have
+        for hash_, paths in file_tree.items():
+            size = self.blob_size(hash_)
+            for path in paths:
+                dest = self.restore_path + path
+                try:
+                    stat = os.stat(dest, follow_symlinks=False)
+                except OSError:
+                    continue
+                if stat_.S_ISREG(stat.st_mode) and (size is None or stat.st_size == size):
+                    candidates.append(FileRecord(dest, False, stat))
+                    expected[dest] = hash_
+
         ui_caller(func="start_progress_bar")
-        ui_caller(func="set_progress_config", maximum=len(file_tree.keys()))
+        ui_caller(func="set_progress_config", maximum=sum(record.st_size for record in candidates))
+        cache_before = (cache.hits, cache.misses) if cache is not None else (0, 0)
+        self.report.add(files=len(candidates))
 
-        for index, hash_ in enumerate(file_tree):
+        matching = set()
+        done = 0
+        hashed = FileItter.hash_files(candidates, self.workers, cache=cache, engine=HashEngine(self.hash_algorithm),
+                                      report=self.report)
+        for record, (dest, hash_) in zip(candidates, hashed):
+            if hash_ == expected[dest]:
+                matching.add(dest)
+            done += record.st_size
+            ui_caller(func="set_progress_config", value=done)
+        if cache is not None:
+            cache.commit()
+            self.report.add(cache_hits=cache.hits - cache_before[0], cache_misses=cache.misses - cache_before[1])
 
-            ui_caller(func="set_progress_config", value=index)
+        remaining = {}
+        intact = {}
+        kept = 0
+        for hash_, paths in file_tree.items():
+            missing = [path for path in paths if self.restore_path + path not in matching]
+            kept += len(paths) - len(missing)
+            if not missing:
+                continue
+            if len(missing) < len(paths):
+                intact[hash_] = next(self.restore_path + path for path in paths
+                                     if self.restore_path + path in matching)
+            remaining[hash_] = missing
+        return remaining, intact, kept
 
-            for path in file_tree[hash_]:
-                shutil.copy(self.tempfile.name + "\\" + hash_ + ".duplicate", self.restore_path + path)
+    @staticmethod
+    def clear_path(path: str):
+        """
+        removes whatever is at path so a file can be written there without touching other hard links to it
+        """
+        if op.isdir(path) and not op.islink(path):
+            shutil.rmtree(path)
+        elif op.lexists(path):
+            os.remove(path)
 
-        ui_caller(func="stop_progress_bar")
+    def remove_extras(self, dir_tree: list, file_tree: dict, patterns, ui_caller):
+        """
+        deletes the files and folders in the destination that are not in the backup
+        with patterns only paths matching them are considered, the rest of the destination is left alone,
+        a matching folder that still holds files the patterns don't match is kept
+        links are deleted, never followed, whether they point anywhere or not
+        """
+        root = op.normpath(self.restore_path)
+        keep = {op.normpath(self.restore_path + dir_) for dir_ in dir_tree}
+        keep.update(op.normpath(self.restore_path + path) for paths in file_tree.values() for path in paths)
+
+        extras = [record for record in FileItter(root).walk(follow_symlinks=False)
+                  if op.normpath(record.path) not in keep
+                  and (not patterns or match_path(op.normpath(record.path)[len(root):], patterns))]
+
+        deleted = 0
+        with self.report.stage("delete"):
+            for record in reversed(extras):  # a folder's contents come after it in the walk
+                if record.is_dir and not op.islink(record.path):
+                    try:
+                        os.rmdir(record.path)
+                    except OSError as e:
+                        if e.errno != errno.ENOTEMPTY:
+                            raise
+                        continue  # holds files the patterns leave alone
+                else:
+                    os.remove(record.path)
+                deleted += 1
+            self.report.add(files=deleted)
+
+        self.stats["deleted"] = deleted
+        ui_caller(f"Deleted {deleted} files and folders that are not in the backup")
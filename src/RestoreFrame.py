@@ -1,6 +1,8 @@
 from tkinter import *
 from tkinter.ttk import *
-from Restore import Restore, BadBackupFile, InvalidPassword
+from Restore import Restore, BadBackupFile, InvalidPassword, LINK_MODES
+from BackgroundJob import BackgroundJob, JobCancelled
+from RunReport import format_report
 from tkinter import messagebox
 from tkinter.filedialog import askdirectory, askopenfilename
 import os.path as op
@@ -15,6 +17,9 @@ class RestoreFrame(Frame):
         ui setup
         """
 
+        self.job = None  # BackgroundJob of the running restore or listing
+        self.start_time = 0
+
         # create frames
         self.top_frame = Frame(self)
         self.bottom_frame = Frame(self)
@@ -23,6 +28,7 @@ class RestoreFrame(Frame):
         Label(self.top_frame, text="Password: ").grid(row=0, sticky=W)
         Label(self.top_frame, text="File To Restore: ").grid(row=1, sticky=W)
         Label(self.top_frame, text="Output Folder:  ").grid(row=2, sticky=W)
+        Label(self.top_frame, text="Only Paths: ").grid(row=3, sticky=W)
 
         # create text box and progress bar
         self.text = Text(self.bottom_frame, font=("Calibri", 12, ""), state=DISABLED)
@@ -32,18 +38,33 @@ class RestoreFrame(Frame):
         self.pass_box = Entry(self.top_frame, show="*", width=100)
         self.restore_file = Entry(self.top_frame, width=100)
         self.output_path = Entry(self.top_frame, width=100)
+        self.patterns = Entry(self.top_frame, width=100)  # ; separated globs or folders, empty restores everything
 
         # create buttons
         self.browse_b = Button(self.top_frame, text="Browse", command=self.browse_restore_file, width=10)
         self.browse_dir_b = Button(self.top_frame, text="Browse", command=self.browse_output_path, width=10)
         # self.exit_b = Button(self, text="Exit", command=exit, width=10)
         self.backup_b = Button(self, text="Restore", command=self.restore, width=10)
+        self.list_b = Button(self, text="List Files", command=self.list_files, width=10)
+        self.verify_b = Button(self, text="Verify", command=self.verify, width=10)
+        self.cancel_b = Button(self, text="Cancel", command=self.cancel, width=10, state=DISABLED)
+
+        # create duplicate strategy selector
+        self.link_mode = Combobox(self, values=LINK_MODES, state="readonly", width=10)
+        self.link_mode.set(LINK_MODES[0])
         self.show_pass_b = Button(self.top_frame, text="Show Pass", width=10)
 
+        # create differential restore options
+        self.differential = BooleanVar(self, value=False)
+        self.differential_cb = Checkbutton(self, text="Only Changed Files", variable=self.differential)
+        self.delete_extras = BooleanVar(self, value=False)
+        self.delete_extras_cb = Checkbutton(self, text="Delete Extra Files", variable=self.delete_extras)
+
         # position widgets
         self.pass_box.grid(row=0, column=1, columnspan=30)
         self.restore_file.grid(row=1, column=1, columnspan=30)
         self.output_path.grid(row=2, column=1, columnspan=30)
+        self.patterns.grid(row=3, column=1, columnspan=30)
         self.show_pass_b.grid(row=0, column=31, sticky=W)
         self.browse_b.grid(row=1, column=31, sticky=W)
         self.browse_dir_b.grid(row=2, column=31, sticky=W)
@@ -56,6 +77,13 @@ class RestoreFrame(Frame):
 
         # self.exit_b.pack(side=RIGHT)
         self.backup_b.pack(side=LEFT)
+        self.list_b.pack(side=LEFT)
+        self.verify_b.pack(side=LEFT)
+        self.cancel_b.pack(side=LEFT)
+        Label(self, text="Duplicates: ").pack(side=LEFT)
+        self.link_mode.pack(side=LEFT)
+        self.differential_cb.pack(side=LEFT)
+        self.delete_extras_cb.pack(side=LEFT)
 
         # bind buttons
         self.show_pass_b.bind('<ButtonPress-1>', lambda _: self.pass_box.config(show=""))
@@ -70,18 +98,18 @@ class RestoreFrame(Frame):
                  "start_progress_bar": self.progress_bar.start,
                  "stop_progress_bar": self.progress_bar.stop,
                  "set_progress_config": self.progress_bar.config,
+                 "report": self.ui_report,
                  "update": self.update}
 
         try:
             funcs[func](*args, **kwargs)
         except KeyError:
             return
-        finally:
-            self.update()
 
     def restore(self):
         """
         main restore function sets up inputs for restore class
+        the restore runs in a BackgroundJob, restore_done or restore_failed report the outcome
         """
         restore_file = self.restore_file.get()
         out_path = self.output_path.get()
@@ -92,40 +120,112 @@ class RestoreFrame(Frame):
 
         self.disable_buttons()  # disables all buttons
 
-        restore_obj = Restore(restore_file, out_path, password)  # get restore class object
+        restore_obj = Restore(restore_file, out_path, password, link_mode=self.link_mode.get(),
+                              differential=self.differential.get(),
+                              delete_extras=self.delete_extras.get())  # get restore class object
+        patterns = self.get_patterns()
 
-        start = time.time()
+        self.start_time = time.time()
+        self.job = BackgroundJob(self, lambda ui_caller: restore_obj.restore(ui_caller=ui_caller, patterns=patterns),
+                                 self, lambda _: self.restore_done(out_path), self.restore_failed)
+        self.job.start()
 
-        try:
-            restore_obj.restore(ui_caller=self)
-        except BadBackupFile:
+    def restore_done(self, out_path):
+        end = time.time()
+
+        self("Time Taken: " + str((end - self.start_time) / 60) + " mins")
+
+        self.enable_buttons()  # re-enable all buttons
+
+        messagebox.showinfo("Restore Complete",
+                            f"Restore Successfully completed\n Output File: {out_path}")
+
+    def restore_failed(self, e):
+        """
+        reports why a restore or listing stopped
+        """
+        if isinstance(e, JobCancelled):
+            self("Cancelled")
+        elif isinstance(e, BadBackupFile):
             messagebox.showerror("Bad Backup File",
-                                 f"File to restore is not a valid backup file:\n{restore_file}")
+                                 f"File to restore is not a valid backup file:\n{self.restore_file.get()}")
             self("Error Occurred Restore Aborted")
-            self.enable_buttons()
-            return
-
-        except InvalidPassword:
+        elif isinstance(e, InvalidPassword):
             messagebox.showerror("Incorrect Password",
-                                 f"Password Incorrect: {'*'*len(password)}")
+                                 f"Password Incorrect: {'*'*len(self.pass_box.get())}")
             self("Error Occurred Restore Aborted")
-            self.enable_buttons()
-            return
-        except OSError as e:
+        elif isinstance(e, OSError):
             messagebox.showerror("OS Error",
                                  f"Following Error Occurred During Restore: {e}")
             self("Error Occurred, Restore Aborted")
-            self.enable_buttons()
+        else:
+            messagebox.showerror("Error", f"Following Error Occurred During Restore: {e!r}")
+            self("Error Occurred, Restore Aborted")
+        self.enable_buttons()
+
+    def cancel(self):
+        """
+        stops the running restore, files already written are left in place
+        """
+        if self.job is not None:
+            self.job.cancel()
+            self("Cancelling...")
+
+    def list_files(self):
+        """
+        prints the files in the backup matching the path filter, only the backups config is read
+        """
+        restore_file = self.restore_file.get()
+        password = self.pass_box.get()
+
+        if not password or not op.isfile(restore_file):
+            messagebox.showerror("Error", "Password and a file to restore are required")
             return
 
-        end = time.time()
+        self.disable_buttons()
 
-        self("Time Taken: " + str((end - start) / 60) + " mins")
+        patterns = self.get_patterns()
+        self.job = BackgroundJob(self, lambda ui_caller: Restore(restore_file, "", password).list(patterns),
+                                 self, self.list_done, self.restore_failed)
+        self.job.start()
 
-        self.enable_buttons()  # re-enable all buttons
+    def list_done(self, files):
+        self("\n".join(path for path, hash_ in files))
+        self(f"{len(files)} files")
+        self.enable_buttons()
 
-        messagebox.showinfo("Restore Complete",
-                            f"Restore Successfully completed\n Output File: {out_path}")
+    def verify(self):
+        """
+        checks every stored file of the backup against its hash, nothing is written to disk
+        """
+        restore_file = self.restore_file.get()
+        password = self.pass_box.get()
+
+        if not password or not op.isfile(restore_file):
+            messagebox.showerror("Error", "Password and a file to restore are required")
+            return
+
+        self.disable_buttons()
+
+        self.job = BackgroundJob(self, lambda ui_caller: Restore(restore_file, "", password).verify(ui_caller),
+                                 self, self.verify_done, self.restore_failed)
+        self.job.start()
+
+    def verify_done(self, bad):
+        for report in bad:
+            self(f"{report['name']}: {report['error']}\n" + "\n".join(report["paths"]))
+        self.enable_buttons()
+
+        if bad:
+            messagebox.showerror("Verify Failed", f"{len(bad)} stored files are damaged, see the output for details")
+        else:
+            messagebox.showinfo("Verify Complete", "Every stored file matches its hash")
+
+    def get_patterns(self):
+        """
+        splits the path filter into a list of patterns
+        """
+        return [pattern.strip() for pattern in self.patterns.get().split(";") if pattern.strip()]
 
     def browse_restore_file(self):
         """
@@ -152,6 +252,9 @@ class RestoreFrame(Frame):
         self.browse_b.configure(state=DISABLED)
         self.browse_dir_b.configure(state=DISABLED)
         self.backup_b.configure(state=DISABLED)
+        self.list_b.configure(state=DISABLED)
+        self.verify_b.configure(state=DISABLED)
+        self.cancel_b.configure(state="normal")
 
     def enable_buttons(self):
         """
@@ -160,13 +263,18 @@ class RestoreFrame(Frame):
         self.browse_b.configure(state="normal")
         self.browse_dir_b.configure(state="normal")
         self.backup_b.configure(state="normal")
+        self.list_b.configure(state="normal")
+        self.verify_b.configure(state="normal")
+        self.cancel_b.configure(state=DISABLED)
+
+    def ui_report(self, report):
+        self.ui_print(format_report(report))
 
     def ui_print(self, data):
         self.text.config(state="normal")
         self.text.insert(END, data + "\n\n")
         self.text.see(END)
         self.text.config(state=DISABLED)
-        self.update()
 
     @staticmethod
     def check_inputs(restore_file, output_path, password):
@@ -0,0 +1,155 @@
+import heapq
+import io
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # windows, peak rss comes from /proc or is not measured
+    resource = None
+
+COUNTERS = ("files", "bytes_read", "bytes_written", "cache_hits", "cache_misses")
+
+
+def reset_peak_rss():
+    """
+    starts a new peak rss measurement where the os allows it (linux), otherwise peaks only ever grow
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss() -> int:
+    """
+    peak resident memory of this process in bytes since reset_peak_rss, None if it can't be measured
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # bytes on macos, kilobytes elsewhere
+
+
+class RunReport:
+    """
+    instrumentation of a backup, restore or verify run
+    the run is split into named stages, each records its duration, peak memory and counters
+    (files, bytes read and written, cache hits and misses, plus any extra ones like encrypt_seconds)
+    the slowest files of the whole run are kept, counters and files may be added from worker threads
+
+    profile -> name of a stage to run under cProfile, the top functions end up in the report
+               cProfile only sees the thread the stage runs in, not the worker pools
+
+    Usage: report = RunReport(); with report.stage("hash"): ... report.add(files=1, bytes_read=n); report.as_dict()
+    """
+
+    SLOWEST = 10  # slowest files kept
+    PROFILE_LINES = 30
+
+    def __init__(self, profile: str = None, slowest: int = SLOWEST):
+        self.profile = profile
+        self.slowest_count = slowest
+        self.stages = {}  # stage name -> measurements, in the order the stages ran
+        self.current = None
+        self.slowest = []  # min heap of (seconds, path, size)
+        self.profile_text = None
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        measures the code in the with block as stage name, running a stage again adds to it
+        """
+        stage = self.stages.setdefault(name, dict(dict.fromkeys(COUNTERS, 0), seconds=0.0, peak_rss=None))
+        self.current = stage
+        profiler = None
+        if name == self.profile:  # imported here, cProfile and pstats are slow to import and rarely wanted
+            import cProfile
+            profiler = cProfile.Profile()
+
+        reset_peak_rss()
+        start = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield stage
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                import pstats
+                out = io.StringIO()
+                pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(self.PROFILE_LINES)
+                self.profile_text = out.getvalue()
+            stage["seconds"] += time.perf_counter() - start
+            rss = peak_rss()
+            stage["peak_rss"] = rss if stage["peak_rss"] is None else max(stage["peak_rss"], rss or 0)
+            self.current = None
+
+    def add(self, **counts):
+        """
+        adds to the counters of the running stage, does nothing outside a stage
+        """
+        with self.lock:
+            if self.current is not None:
+                for key, value in counts.items():
+                    self.current[key] = self.current.get(key, 0) + value
+
+    def file(self, path: str, seconds: float, size: int):
+        """
+        records how long a single file took, only the slowest are kept
+        """
+        with self.lock:
+            item = (seconds, path, size)
+            if len(self.slowest) < self.slowest_count:
+                heapq.heappush(self.slowest, item)
+            elif item > self.slowest[0]:
+                heapq.heapreplace(self.slowest, item)
+
+    def as_dict(self) -> dict:
+        """
+        json ready report: total seconds, peak memory, stages with MB/s, slowest files, profile text
+        """
+        stages = {}
+        for name, stage in self.stages.items():
+            seconds = max(stage["seconds"], 1e-9)
+            stages[name] = dict(stage, files_per_s=stage["files"] / seconds,
+                                mb_per_s=max(stage["bytes_read"], stage["bytes_written"]) / 1e6 / seconds)
+
+        rss = [stage["peak_rss"] for stage in self.stages.values() if stage["peak_rss"] is not None]
+        return {"seconds": sum(stage["seconds"] for stage in self.stages.values()),
+                "peak_rss": max(rss, default=None),
+                "stages": stages,
+                "slowest_files": [{"path": path, "seconds": seconds, "size": size}
+                                  for seconds, path, size in sorted(self.slowest, reverse=True)],
+                "profile": self.profile_text}
+
+
+def format_report(report: dict) -> str:
+    """
+    a few lines per run for the gui and terminal, the dict has everything
+    """
+    lines = ["--- Stages ---"]
+    for name, stage in report["stages"].items():
+        line = f"{name}: {stage['seconds']:.2f} s, {stage['files']} files"
+        if stage["bytes_read"] or stage["bytes_written"]:
+            line += f", {stage['mb_per_s']:.1f} MB/s"
+        if stage["cache_hits"] or stage["cache_misses"]:
+            line += f", cache {stage['cache_hits']}/{stage['cache_hits'] + stage['cache_misses']} hits"
+        lines.append(line)
+    if report["peak_rss"] is not None:
+        lines.append(f"Peak memory: {report['peak_rss'] / 1e6:.0f} MB")
+    if report["slowest_files"]:
+        slowest = report["slowest_files"][0]
+        lines.append(f"Slowest file: {slowest['path']} ({slowest['seconds']:.2f} s, {slowest['size'] / 1e6:.1f} MB)")
+    return "\n".join(lines)
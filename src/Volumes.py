@@ -0,0 +1,277 @@
+import glob
+import itertools
+import os
+import os.path as op
+import threading
+import zipfile
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from crypto import SEGMENT_HEADER, SEGMENT_TAG
+
+INDEX_ENTRY = "volumes"  # entry of the index volume listing the data volumes and the entries in each
+
+
+class DamagedVolume(ValueError):
+    pass
+
+
+def volume_name(dest: str, number: int) -> str:
+    """
+    file name of data volume number of the archive dest, "date backup.zip.locked" -> "date backup.vol001.locked"
+    """
+    return f"{dest[:-len('.zip.locked')]}.vol{number + 1:03d}.locked"
+
+
+def volume_files(dest: str) -> list:
+    """
+    data volumes next to an index volume, found by name so no password is needed
+    """
+    if not dest.endswith(".zip.locked"):
+        return []
+    return sorted(glob.glob(glob.escape(dest[:-len(".zip.locked")]) + ".vol[0-9][0-9][0-9]*.locked"))
+
+
+def archive_size(dest: str) -> int:
+    """
+    bytes taken by an archive, its data volumes included
+    """
+    return op.getsize(dest) + sum(op.getsize(path) for path in volume_files(dest))
+
+
+def entry_bound(size: int) -> int:
+    """
+    most bytes size bytes can take once compressed by any codec in Compression.CODECS
+    """
+    return size + size // 64 + 1024
+
+
+def discard(zip_file: zipfile.ZipFile):
+    """
+    lets go of a zip being written to a file that was aborted, closing it can't write its directory anymore
+    but leaves it detached so it doesn't try again (and print the error) when it is garbage collected
+    """
+    try:
+        zip_file.close()
+    except (ValueError, OSError):
+        pass
+
+
+def volume_capacity(volume_size: int, segment_size: int = 1024 * 1024) -> int:
+    """
+    bytes of zip (entries and directory) a volume can hold and still be at most volume_size once encrypted
+    """
+    trailer = 128  # sealed container index and its length
+    return (volume_size - SEGMENT_HEADER.size - trailer) * segment_size // (segment_size + SEGMENT_TAG) - SEGMENT_TAG
+
+
+class VolumeWriter:
+    """
+    writes the entries of a split archive (hash.duplicate and hash.chunk) into data volumes of at most volume_size bytes
+    each volume is a segmented container (see crypto.SegmentWriter) holding a stored zip so it can be read, verified
+    or copied again on its own, the archive itself only holds the manifest and the index returned by close
+    entries are never split across volumes, a new volume is started when the next entry might not fit,
+    Backup stores files too big for an empty volume as pieces (see Backup.write_pieces)
+    a full volume is finished (last segments sealed, zip directory written) in a thread pool while the next one is
+    filled, segments within a volume are sealed in parallel by its SegmentWriter
+    volumes keep a .part name until every one of them is complete
+
+    Usage: volumes = VolumeWriter(dest, crypto, volume_size); zip_file = volumes.reserve(name, size); volumes.close()
+    """
+
+    MIN_SIZE = 1024 * 1024
+    LOCAL_HEADER = 128  # zip local header, zip64 extra and data descriptor of an entry, without its name
+    CENTRAL_HEADER = 128  # zip directory record of an entry with its zip64 extra, without its name
+    END_RECORDS = 128  # zip64 end of directory record, its locator and the end of directory record
+    NAME_LENGTH = 256  # longest entry name planned for when working out max_entry
+
+    def __init__(self, dest: str, crypto, volume_size: int, workers: int = 1):
+        if volume_size < self.MIN_SIZE:
+            raise ValueError(f"volume_size must be at least {self.MIN_SIZE} bytes")
+        self.dest = dest
+        self.crypto = crypto
+        self.volume_size = volume_size
+        self.capacity = volume_capacity(volume_size) - self.END_RECORDS
+        # biggest file that surely fits in an empty volume whatever it is compressed with
+        self.max_entry = (self.capacity - self.LOCAL_HEADER - self.CENTRAL_HEADER - 2 * self.NAME_LENGTH
+                          - 1024) * 64 // 65
+
+        self.volumes = []  # (ZipFile, SegmentWriter) of every volume in order
+        self.entries = set()  # names of the entries in every volume
+        self.directory = 0  # bytes the open volume's zip directory will take
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.finishing = []  # futures of volumes being finished
+        self.bytes_written = 0
+        self.crypto_seconds = 0.0
+        self.zip = None
+        self.writer = None
+        self.open_volume()
+
+    def open_volume(self):
+        self.writer = self.crypto.open_segment_writer(volume_name(self.dest, len(self.volumes)) + ".part")
+        self.zip = zipfile.ZipFile(self.writer, mode="w", compression=zipfile.ZIP_STORED, allowZip64=True)
+        self.volumes.append((self.zip, self.writer))
+        self.directory = 0
+
+    def free(self, name: str) -> int:
+        """
+        bytes of data an entry called name can still take in the open volume
+        """
+        return self.capacity - self.writer.tell() - self.directory - self.LOCAL_HEADER - self.CENTRAL_HEADER \
+            - 2 * len(name.encode())
+
+    def room(self, name: str) -> int:
+        """
+        bytes of a file that surely fit in the open volume as an entry called name, once compressed
+        """
+        return max((self.free(name) - 1024) * 64 // 65, 0)
+
+    def reserve(self, name: str, size: int) -> zipfile.ZipFile:
+        """
+        returns the zip to write an entry of at most size stored bytes to, a new volume is started if it might not fit
+        """
+        if size > self.free(name) and self.writer.tell():
+            self.next_volume()
+        if size > self.free(name):
+            raise ValueError(f"{name} ({size} bytes) does not fit in a volume of {self.volume_size} bytes")
+        self.entries.add(name)
+        self.directory += self.CENTRAL_HEADER + len(name.encode())
+        return self.zip
+
+    def next_volume(self):
+        """
+        hands the open volume to the thread pool to be finished and opens the next one
+        """
+        self.finishing.append(self.executor.submit(self.finish, self.zip, self.writer))
+        self.open_volume()
+
+    @staticmethod
+    def finish(zip_file, writer):
+        zip_file.close()
+        writer.close()
+
+    def close(self) -> dict:
+        """
+        finishes every volume and gives them their final names
+        returns the index for the index volume: every volume's file name and size and the
+        (name, file size, header offset) of each entry in it
+        """
+        self.finishing.append(self.executor.submit(self.finish, self.zip, self.writer))
+        try:
+            for future in self.finishing:
+                future.result()
+        finally:
+            self.executor.shutdown()
+
+        volumes = []
+        for number, (zip_file, writer) in enumerate(self.volumes):
+            name = volume_name(self.dest, number)
+            os.replace(writer.name, name)
+            self.bytes_written += writer.bytes_written
+            self.crypto_seconds += writer.crypto_seconds
+            volumes.append({"name": op.basename(name), "size": op.getsize(name),
+                            "entries": [[zinfo.filename, zinfo.file_size, zinfo.header_offset]
+                                        for zinfo in zip_file.infolist()]})
+        return {"volume_size": self.volume_size, "volumes": volumes}
+
+    def abort(self):
+        """
+        stops writing and deletes every volume written so far
+        """
+        self.executor.shutdown(cancel_futures=True)
+        for number, (zip_file, writer) in enumerate(self.volumes):
+            if not writer.closed:
+                writer.abort()
+            discard(zip_file)
+            for path in (writer.name, volume_name(self.dest, number)):
+                if op.exists(path):
+                    os.remove(path)
+
+
+class VolumeSet:
+    """
+    read side of a split archive, stands in for duplicates.zip in Restore
+    the index from the index volume says which volume holds each entry, its size and its offset, so a volume is
+    only opened (and only has to be there) when one of its entries is read
+    every volume has its own reader and zip so threads reading different volumes don't wait on each other
+    offsets count on from the end of the volume before so sorting by them gives storage order across volumes
+
+    Usage: VolumeSet(index, folder of the index volume, crypto, workers).open(name)
+    """
+
+    def __init__(self, index: dict, folder: str, crypto, workers: int = 1):
+        self.folder = folder
+        self.crypto = crypto
+        self.volumes = index["volumes"]
+        self.reader_workers = max(workers // max(len(self.volumes), 1), 1)  # threads decrypting ahead per volume
+        self.NameToInfo = {}  # entry name -> ZipInfo with its size and offset, same as ZipFile.NameToInfo
+        self.volume_of = {}  # entry name -> volume number
+        self.opened = {}  # volume number -> (reader, ZipFile)
+        self.lock = threading.Lock()
+
+        start = 0
+        for number, volume in enumerate(self.volumes):
+            for name, file_size, offset in volume["entries"]:
+                zinfo = zipfile.ZipInfo(name)
+                zinfo.file_size = file_size
+                zinfo.header_offset = start + offset
+                self.NameToInfo[name] = zinfo
+                self.volume_of[name] = number
+            start += volume["size"]
+
+    def getinfo(self, name: str) -> zipfile.ZipInfo:
+        return self.NameToInfo[name]
+
+    def volume_file(self, name: str) -> str:
+        """
+        file name of the volume holding an entry
+        """
+        return self.volumes[self.volume_of[name]]["name"]
+
+    def volume(self, number: int) -> zipfile.ZipFile:
+        """
+        opens a volume the first time one of its entries is read
+        DamagedVolume if the file is not the size the index expects, it is then damaged or from another backup
+        """
+        with self.lock:
+            if number not in self.opened:
+                path = op.join(self.folder, self.volumes[number]["name"])
+                if op.getsize(path) != self.volumes[number]["size"]:
+                    raise DamagedVolume(f"{path} is {op.getsize(path)} bytes, expected {self.volumes[number]['size']}")
+                reader = self.crypto.open_reader(path, self.reader_workers)
+                try:
+                    self.opened[number] = (reader, zipfile.ZipFile(reader, mode="r", allowZip64=True))
+                except BaseException:
+                    reader.close()
+                    raise
+            return self.opened[number][1]
+
+    def open(self, name: str):
+        """
+        opens an entry for reading like ZipFile.open, KeyError if no volume holds it
+        """
+        return self.volume(self.volume_of[name]).open(name)
+
+    def interleave(self, items, name_of) -> list:
+        """
+        reorders items round robin over the volumes holding them, keeping their order within each volume
+        so worker threads read several volumes at once, each one front to back
+        name_of(item) -> name of the entry the item reads first
+        """
+        lanes = defaultdict(list)
+        for item in items:
+            lanes[self.volume_of.get(name_of(item), -1)].append(item)
+        return [item for group in itertools.zip_longest(*lanes.values()) for item in group if item is not None]
+
+    @property
+    def bytes_read(self) -> int:
+        return sum(reader.bytes_read for reader, _ in list(self.opened.values()))
+
+    @property
+    def crypto_seconds(self) -> float:
+        return sum(reader.crypto_seconds for reader, _ in list(self.opened.values()))
+
+    def close(self):
+        for reader, zip_file in self.opened.values():
+            zip_file.close()
+            reader.close()
+        self.opened = {}
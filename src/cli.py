@@ -0,0 +1,319 @@
+"""
+headless command line interface, for cron, systemd timers and servers without a display
+run from the src folder: python -m cli backup|restore|list|verify|search ... (or python src ... from the repo root)
+
+only the standard library is imported up front, Backup, Restore and crypto are imported by the command
+that needs them so --help starts instantly
+
+--json prints one json object per line on stdout:
+    {"event": "message", "text": ...}
+    {"event": "progress", "value": ..., "maximum": ..., "eta": seconds or null}   at most PROGRESS_INTERVAL apart
+    {"event": "report", ...}                              RunReport of the run: stages, slowest files, profile
+    {"event": "result", "command": ..., ...}              stats of the finished command
+    {"event": "error", "type": ..., "message": ...}
+"""
+import argparse
+import getpass
+import json
+import os
+import sys
+import time
+
+from HashEngine import ALGORITHMS, FASTEST, choose
+
+PASSWORD_ENV = "BACKUP_PASSWORD"
+# copies of Compression.CODECS and Restore.LINK_MODES, those modules aren't imported until a command runs
+CODECS = ("stored", "deflate", "bz2", "lzma")
+LINK_MODES = ("copy", "hardlink", "reflink")
+
+
+class TerminalUI:
+    """
+    ui_caller for the terminal, same protocol as BackupFrame.__call__
+    messages go to stderr (stdout with --json) and the progress bar is redrawn at most every PROGRESS_INTERVAL
+    """
+
+    PROGRESS_INTERVAL = 0.25  # seconds
+
+    def __init__(self, as_json: bool = False, quiet: bool = False, report_path: str = None):
+        self.as_json = as_json
+        self.quiet = quiet
+        self.report_path = report_path
+        self.maximum = 0
+        self.value = 0
+        self.started = time.monotonic()
+        self.last_draw = 0.0
+        self.bar = sys.stderr.isatty() and not as_json
+
+    def __call__(self, *args, func="ui_print", **kwargs):
+        funcs = {"ui_print": self.ui_print,
+                 "start_progress_bar": self.start_progress_bar,
+                 "stop_progress_bar": self.stop_progress_bar,
+                 "set_progress_config": self.set_progress_config,
+                 "report": self.report}
+
+        if func in funcs:
+            funcs[func](*args, **kwargs)
+
+    def emit(self, event: str, **fields):
+        print(json.dumps(dict(event=event, **fields)), flush=True)
+
+    def ui_print(self, data):
+        if self.as_json:
+            self.emit("message", text=str(data))
+        elif not self.quiet:
+            self.clear_bar()
+            print(data, file=sys.stderr, flush=True)
+
+    def start_progress_bar(self):
+        self.maximum = self.value = 0
+        self.started = time.monotonic()
+
+    def stop_progress_bar(self):
+        self.draw()
+        self.clear_bar()
+
+    def set_progress_config(self, maximum=None, value=None, **_):
+        if maximum is not None:
+            self.maximum = maximum
+        if value is not None:
+            self.value = value
+        if time.monotonic() - self.last_draw >= self.PROGRESS_INTERVAL:
+            self.draw()
+
+    def eta(self):
+        """
+        seconds left at the rate so far, progress is in bytes for the long stages so the rate is steady
+        """
+        if not self.value or not self.maximum:
+            return None
+        return (time.monotonic() - self.started) * max(self.maximum - self.value, 0) / self.value
+
+    def draw(self):
+        self.last_draw = time.monotonic()
+        eta = self.eta()
+        if self.as_json:
+            self.emit("progress", value=self.value, maximum=self.maximum, eta=eta)
+        elif self.bar and not self.quiet and self.maximum:
+            filled = int(30 * min(self.value / self.maximum, 1))
+            left = f" ETA {int(eta) // 60}:{int(eta) % 60:02d}" if eta is not None else ""
+            sys.stderr.write(f"\r[{'#' * filled}{' ' * (30 - filled)}] {self.value}/{self.maximum}{left}\033[K")
+            sys.stderr.flush()
+
+    def clear_bar(self):
+        if self.bar and not self.quiet:
+            sys.stderr.write("\r\033[K")
+
+    def report(self, report: dict):
+        if self.report_path:
+            with open(self.report_path, "w") as f:
+                json.dump(report, f, indent=2)
+        if self.as_json:
+            self.emit("report", **report)
+        elif not self.quiet:
+            from RunReport import format_report  # RunReport pulls in the profiler, --help doesn't need it
+            self.clear_bar()
+            print(format_report(report), file=sys.stderr, flush=True)
+
+    def result(self, command: str, **fields):
+        if self.as_json:
+            self.emit("result", command=command, **fields)
+
+    def error(self, e: BaseException):
+        if self.as_json:
+            self.emit("error", type=type(e).__name__, message=str(e))
+        else:
+            self.clear_bar()
+            print(f"Error: {type(e).__name__}: {e}", file=sys.stderr)
+
+
+def get_password(args) -> str:
+    """
+    --password-file, then the BACKUP_PASSWORD environment variable, then a prompt if there is a terminal
+    """
+    if args.password_file:
+        with open(args.password_file, "r") as f:
+            return f.read().rstrip("\r\n")
+    if os.environ.get(PASSWORD_ENV):
+        return os.environ[PASSWORD_ENV]
+    if sys.stdin.isatty():
+        return getpass.getpass("Password: ")
+    raise ValueError(f"no password, use --password-file or set {PASSWORD_ENV}")
+
+
+def run_backup(args, ui):
+    from Backup import Backup
+    from HashCache import HashCache
+    from Catalog import Catalog
+
+    args.hash = choose(args.hash)
+    hash_cache = HashCache(args.hash_cache, algorithm=args.hash) if args.hash_cache else None
+    catalog = Catalog(args.catalog) if args.catalog else None
+    backup = Backup(args.target, args.dest, get_password(args), workers=args.workers,
+                    use_processes=args.processes, prefilter=not args.no_prefilter, hash_cache=hash_cache,
+                    incremental=args.incremental, single_pass=args.single_pass, compression=args.compression,
+                    compression_level=args.compression_level, chunking=args.chunking, chunk_size=args.chunk_size,
+                    hash_algorithm=args.hash, catalog=catalog, profile=args.profile, volume_size=args.volume_size)
+    start = time.time()
+    try:
+        dest = backup.backup(ui_caller=ui)
+    finally:
+        if hash_cache is not None:
+            hash_cache.close()
+        if catalog is not None:
+            catalog.close()
+    ui.result("backup", dest=dest, seconds=time.time() - start, stats=backup.stats)
+
+
+def run_restore(args, ui):
+    from Restore import Restore
+    from HashCache import HashCache
+
+    hash_cache = HashCache(args.hash_cache, algorithm=args.hash) if args.hash_cache else None
+    restore = Restore(args.archive, args.dest, get_password(args), workers=args.workers, link_mode=args.link_mode,
+                      differential=args.differential, delete_extras=args.delete_extras, hash_cache=hash_cache,
+                      profile=args.profile)
+    start = time.time()
+    try:
+        restore.restore(ui_caller=ui, patterns=args.only)
+    finally:
+        if hash_cache is not None:
+            hash_cache.close()
+    ui.result("restore", dest=args.dest, seconds=time.time() - start, stats=restore.stats)
+
+
+def run_list(args, ui):
+    from Restore import Restore
+
+    files = Restore(args.archive, "", get_password(args)).list(args.only)
+    if ui.as_json:
+        ui.result("list", files=[{"path": path, "hash": hash_} for path, hash_ in files])
+    else:
+        for path, hash_ in files:
+            print(f"{hash_}  {path}")
+
+
+def run_verify(args, ui):
+    from Restore import Restore
+
+    restore = Restore(args.archive, "", get_password(args), workers=args.workers, profile=args.profile)
+    bad = restore.verify(ui_caller=ui)
+    ui.result("verify", ok=not bad, bad=bad, stats=restore.stats)
+    if not ui.as_json:
+        for report in bad:
+            print(f"{report['name']}: {report['error']}" + (f" in {report['volume']}" if "volume" in report else ""))
+            for path in report["paths"]:
+                print(f"    {path}")
+    return 0 if not bad else 2
+
+
+def run_search(args, ui):
+    """
+    no password needed, only the catalog is read
+    """
+    from Catalog import Catalog
+
+    catalog = Catalog(args.catalog)
+    try:
+        if args.hash:
+            rows = catalog.find_hash(args.hash.lower())
+        elif args.path is not None:
+            rows = catalog.find_path(args.path, prefix=args.prefix)
+        else:
+            backups = catalog.backups()
+            if ui.as_json:
+                ui.result("search", backups=backups)
+            else:
+                for backup in backups:
+                    print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(backup['created']))}  "
+                          f"{backup['file_count']} files  {backup['size']} bytes  {backup['path']}")
+            return
+    finally:
+        catalog.close()
+
+    if ui.as_json:
+        ui.result("search", files=[{"backup": backup, "created": created, "path": path, "hash": hash_, "size": size}
+                                   for backup, created, path, hash_, size in rows])
+    else:
+        for backup, created, path, hash_, size in rows:
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(created))}  {hash_}  {size}  {path}  {backup}")
+    return 0 if rows else 3
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="backuputility", description="Backup Utility without the gui")
+    parser.add_argument("--json", action="store_true", help="print json events on stdout instead of text")
+    parser.add_argument("--quiet", action="store_true", help="only print errors")
+    parser.add_argument("--password-file", help=f"file holding the password, else ${PASSWORD_ENV} or a prompt")
+    parser.add_argument("--workers", type=int, default=None, help="worker threads, defaults to cpu count")
+    parser.add_argument("--report", help="json file the run report (stage timings, slowest files) is saved to")
+    parser.add_argument("--profile", metavar="STAGE",
+                        help="run this stage under cProfile, e.g. hash or pack for backup, extract for restore")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    backup = commands.add_parser("backup", help="back up a folder")
+    backup.add_argument("target", help="folder to back up")
+    backup.add_argument("dest", help="folder the backup is written to")
+    backup.add_argument("--incremental", action="store_true", help="back up into a repository in dest")
+    backup.add_argument("--compression", default="deflate", choices=CODECS)
+    backup.add_argument("--compression-level", type=int, default=None)
+    backup.add_argument("--hash", default="md5", choices=ALGORITHMS + (FASTEST,),
+                        help=f"{FASTEST} benchmarks the algorithms on this machine and uses the fastest")
+    backup.add_argument("--hash-cache", help="sqlite hash cache file, unchanged files are not hashed again")
+    backup.add_argument("--chunking", action="store_true", help="split large files into content defined chunks")
+    backup.add_argument("--chunk-size", type=int, default=1024 * 1024, help="average chunk size in bytes")
+    backup.add_argument("--single-pass", action="store_true", help="hash files while packing them")
+    backup.add_argument("--no-prefilter", action="store_true", help="fully hash every file up front")
+    backup.add_argument("--processes", action="store_true", help="hash in a process pool")
+    backup.add_argument("--catalog", help="sqlite catalog file the backup and its files are recorded in")
+    backup.add_argument("--volume-size", type=int, default=None,
+                        help="split the archive into volumes of at most this many bytes")
+    backup.set_defaults(run=run_backup)
+
+    restore = commands.add_parser("restore", help="restore a backup or snapshot")
+    restore.add_argument("archive", help="date backup.zip.locked or date.snapshot.locked")
+    restore.add_argument("dest", help="folder to restore into")
+    restore.add_argument("--only", action="append", help="glob or path prefix to restore, can be repeated")
+    restore.add_argument("--link-mode", default="copy", choices=LINK_MODES, help="how duplicate files are created")
+    restore.add_argument("--differential", action="store_true",
+                         help="restore over an existing folder, only missing or different files are written")
+    restore.add_argument("--delete-extras", action="store_true",
+                         help="with --differential, delete files in dest that are not in the backup")
+    restore.add_argument("--hash-cache", help="sqlite hash cache file, unchanged files in dest are not hashed again")
+    restore.add_argument("--hash", default="md5", choices=ALGORITHMS, help="algorithm of the backup, for --hash-cache")
+    restore.set_defaults(run=run_restore)
+
+    list_ = commands.add_parser("list", help="list the files in a backup")
+    list_.add_argument("archive")
+    list_.add_argument("--only", action="append", help="glob or path prefix to list, can be repeated")
+    list_.set_defaults(run=run_list)
+
+    verify = commands.add_parser("verify", help="check every stored file against its hash, nothing is written")
+    verify.add_argument("archive")
+    verify.set_defaults(run=run_verify)
+
+    search = commands.add_parser("search", help="find which backups hold a file, lists the backups without filters")
+    search.add_argument("catalog", help="sqlite catalog file written by backup --catalog")
+    search.add_argument("--path", help="relative path as stored in the backup, e.g. /docs/a.txt")
+    search.add_argument("--prefix", action="store_true", help="match every path starting with --path")
+    search.add_argument("--hash", help="file hash")
+    search.set_defaults(run=run_search)
+
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    ui = TerminalUI(args.json, args.quiet, args.report)
+    try:
+        return args.run(args, ui) or 0
+    except KeyboardInterrupt:
+        ui.error(KeyboardInterrupt("cancelled"))
+        return 130
+    except Exception as e:  # wrong password, missing paths, bad archive...
+        ui.error(e)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,97 +1,450 @@
 """
-source: https://eli.thegreenplace.net/2010/06/25/aes-encryption-of-files-in-python-with-pycrypto/
-minor changes for compatibility with 3.7
+encryption of backups, snapshots, blobs and volumes
+files are written as segmented containers (see SegmentWriter): a header with the salt and a key check, then
+AES-GCM segments that are authenticated one by one, sealed in parallel and read back with random access
+files in the original AES-CBC format of the first versions are still read (see CBCReader), never written
 """
 import os
+import io
 import struct
+import shutil
 import hashlib
+import hmac
+import json
+import time
+from collections import deque
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from Crypto.Cipher import AES
 from Crypto import Random
 
 
-class Crypto:
+SEGMENT_MAGIC = b'BUSEG\x00\x02\x00'  # never a plausible size field of the old format
+SEGMENT_HEADER = struct.Struct('<8sI16s16s8s')  # magic, segment size, salt, key check, nonce prefix
+SEGMENT_TAG = 16
+INDEX_SEGMENT = 0xFFFFFFFF  # segment number used for the nonce of the index
 
-    def __init__(self, password):
-        self.__dk = self.__derive_key(password)
 
-    @staticmethod
-    def __derive_key(password):
+class WrongPassword(ValueError):  # a ValueError like every other container that can't be read
+    pass
+
+
+class DamagedSegment(ValueError):  # a segment failed authentication, the container is damaged or was tampered with
+    pass
+
+
+class SegmentWriter(io.RawIOBase):
+    """
+    write only file object for the segmented container
+    layout: header | segment 0 | segment 1 | ... | encrypted index | index length (<Q)
+    the header holds the random salt the key was derived with and a key check value,
+    so a wrong password is caught from the header alone
+    each segment is segment_size bytes of plaintext encrypted with AES-GCM (last one may be shorter)
+    the nonce is the file's random prefix + the segment number so segments can't be reordered or swapped
+    the header is authenticated with every segment and the index records the plaintext size and segment count
+    so truncating the file is detected
+    segments are independent so with workers > 1 they are sealed in a thread pool (AES releases the GIL),
+    at most workers * 2 segments are in flight and they are written in order
+    bytes_written and crypto_seconds (time spent sealing, summed over threads) are kept for RunReport
+    """
+
+    def __init__(self, out_filename, key, salt, check, segment_size=1024 * 1024, workers=1):
+        super().__init__()
+        self.name = out_filename
+        self.key = key
+        self.segment_size = segment_size
+        self.segments = 0
+        self.size = 0
+        self.pending = bytearray()
+        self.executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+        self.window = workers * 2
+        self.in_flight = deque()  # futures of sealed segments not written yet
+
+        self.header = SEGMENT_HEADER.pack(SEGMENT_MAGIC, segment_size, salt, check, Random.new().read(8))
+        self.outfile = open(out_filename, 'wb')
+        self.outfile.write(self.header)
+        self.bytes_written = len(self.header)
+        self.crypto_seconds = 0.0
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.size
+
+    def write(self, data):
+        self.pending += data
+        self.size += len(data)
+        while len(self.pending) >= self.segment_size:
+            self.write_segment(bytes(self.pending[:self.segment_size]))
+            del self.pending[:self.segment_size]
+        return len(data)
+
+    def write_segment(self, plain):
+        if self.executor is None:
+            self.write_sealed(timed(seal_segment, self.key, self.header, self.segments, plain))
+        else:
+            self.in_flight.append(self.executor.submit(timed, seal_segment, self.key, self.header, self.segments,
+                                                       plain))
+            if len(self.in_flight) >= self.window:
+                self.write_sealed(self.in_flight.popleft().result())
+        self.segments += 1
+
+    def write_sealed(self, result):
+        """
+        result -> (sealed segment, seconds spent sealing it)
+        """
+        sealed, seconds = result
+        self.outfile.write(sealed)
+        self.bytes_written += len(sealed)
+        self.crypto_seconds += seconds
+
+    def close(self):
+        if self.closed:
+            return
+        if self.pending:
+            self.write_segment(bytes(self.pending))
+        while self.in_flight:
+            self.write_sealed(self.in_flight.popleft().result())
+        self.shutdown()
+        index = json.dumps({"size": self.size, "segments": self.segments}).encode()
+        index = seal_segment(self.key, self.header, INDEX_SEGMENT, index)
+        self.outfile.write(index)
+        self.outfile.write(struct.pack('<Q', len(index)))
+        self.bytes_written += len(index) + 8
+        self.outfile.close()
+        super().close()
+
+    def abort(self):
         """
-        derives cryptographic key using pbkdf2 key derivation scheme
-        salt = sha3_256 digest of password string, 16 bytes as recommended
+        closes and deletes a partly written file
         """
-        salt = hashlib.sha3_256(password.encode()).digest()
-        return hashlib.pbkdf2_hmac("sha256", password.encode(), salt, 100000)
+        self.shutdown()
+        self.outfile.close()
+        super().close()
+        os.remove(self.name)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
 
-    def encrypt_file(self, in_filename, out_filename=None, chunksize=64 * 1024):
 
-        """ Encrypts a file using AES (CBC mode) with the
-            given key.
+class PlainReader(io.RawIOBase):
+    """
+    base for the seekable read only views of an encrypted file's plaintext
+    the plaintext is split into segments of segment_size, subclasses read one with read_sealed(number)
+    and decrypt it with decrypt_segment(number, sealed)
+    only the segments covering what is read are decrypted, the last one is kept for the next read
+    with workers > 1 reading sequentially decrypts the next workers * 2 segments ahead in a thread pool,
+    random access only decrypts what is asked for
+    bytes_read and crypto_seconds (time spent decrypting, summed over threads) are kept for RunReport
+    """
 
-            key:
-                The encryption key - a string that must be
-                either 16, 24 or 32 bytes long. Longer keys
-                are more secure.
+    def __init__(self, in_filename, segment_size, workers=1):
+        super().__init__()
+        self.name = in_filename
+        self.segment_size = segment_size
+        self.size = 0
+        self.infile = open(in_filename, 'rb')
+        self.pos = 0
+        self.cached = (None, b'')  # last decrypted segment (number, plaintext)
+        self.executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+        self.window = workers * 2
+        self.prefetched = {}  # segment number -> future of (plaintext, seconds)
+        self.bytes_read = 0
+        self.crypto_seconds = 0.0
 
-            in_filename:
-                Name of the input file
+    def readable(self):
+        return True
 
-            out_filename:
-                If None, '<in_filename>.enc' will be used.
+    def seekable(self):
+        return True
 
-            chunksize:
-                Sets the size of the chunk which the function
-                uses to read and encrypt the file. Larger chunk
-                sizes can be faster for some files and machines.
-                chunksize must be divisible by 16.
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.pos = max(offset, 0)
+        return self.pos
+
+    def segment(self, number):
         """
-        if not out_filename:
-            out_filename = in_filename + '.locked'
+        returns the plaintext of a segment
+        """
+        if self.cached[0] != number:
+            sequential = self.cached[0] is not None and number == self.cached[0] + 1 or number == 0
+            self.cached = (number, self.load_segment(number, sequential))
+        return self.cached[1]
 
-        iv = Random.new().read(AES.block_size)
-        encryptor = AES.new(self.__dk, AES.MODE_CBC, iv)
-        fsize = os.path.getsize(in_filename)
+    def load_segment(self, number, sequential):
+        """
+        decrypts a segment, prefetching the ones after it when reading sequentially
+        """
+        if self.executor is None:
+            plain, seconds = timed(self.decrypt_segment, number, self.fetch(number))
+            self.crypto_seconds += seconds
+            return plain
 
-        with open(in_filename, 'rb') as infile:
-            with open(out_filename, 'wb+') as outfile:
-                outfile.write(struct.pack('<Q', fsize))
-                outfile.write(iv)
-
-                while True:
-                    chunk = infile.read(chunksize)
-                    if len(chunk) == 0:
-                        break
-                    elif len(chunk) % 16 != 0:
-                        chunk += b' ' * (16 - len(chunk) % 16)
-
-                    outfile.write(encryptor.encrypt(chunk))
-                outfile.seek(0)
-        return outfile.name
+        future = self.prefetched.pop(number, None)
+        if not sequential or future is None:
+            for stale in self.prefetched.values():
+                stale.cancel()
+            self.prefetched.clear()
+        if future is None:
+            future = self.executor.submit(timed, self.decrypt_segment, number, self.fetch(number))
+
+        if sequential:
+            count = (self.size + self.segment_size - 1) // self.segment_size
+            for ahead in range(number + 1, min(number + 1 + self.window, count)):
+                if ahead not in self.prefetched:  # file reads stay in this thread, only decryption is farmed out
+                    self.prefetched[ahead] = self.executor.submit(timed, self.decrypt_segment, ahead,
+                                                                  self.fetch(ahead))
+        plain, seconds = future.result()
+        self.crypto_seconds += seconds
+        return plain
 
-    def decrypt_file(self, in_filename, out_filename=None, chunksize=64 * 1024):
-        """ Decrypts a file using AES (CBC mode) with the
-            given key. Parameters are similar to encrypt_file,
-            with one difference: out_filename, if not supplied
-            will be in_filename without its last extension
-            (i.e. if in_filename is 'aaa.zip.enc' then
-            out_filename will be 'aaa.zip')
+    def fetch(self, number):
         """
-        if out_filename is None:
-            out_filename = os.path.splitext(in_filename)[0]
+        read_sealed that counts the bytes read
+        """
+        sealed = self.read_sealed(number)
+        self.bytes_read += len(sealed)
+        return sealed
+
+    def read_sealed(self, number):
+        raise NotImplementedError
+
+    def decrypt_segment(self, number, sealed):
+        raise NotImplementedError
+
+    def readinto(self, buffer):
+        length = min(len(buffer), self.size - self.pos)
+        done = 0
+        while done < length:
+            number, start = divmod(self.pos, self.segment_size)
+            chunk = self.segment(number)[start:start + length - done]
+            buffer[done:done + len(chunk)] = chunk
+            done += len(chunk)
+            self.pos += len(chunk)
+        return done
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+        self.infile.close()
+        super().close()
+
+
+class SegmentReader(PlainReader):
+    """
+    seekable read only view of the plaintext of a segmented container
+    every segment read is authenticated, DamagedSegment if one was tampered with, WrongPassword if the password is
+    wrong, ValueError if the file is not a container or was cut short
+    keys(salt) -> (segment key, key check)
+    """
+
+    def __init__(self, in_filename, keys, workers=1):
+        super().__init__(in_filename, 0, workers)
+        try:
+            self.read_header(keys)
+        except BaseException:
+            self.infile.close()
+            raise
+
+    def read_header(self, keys):
+        """
+        checks the header and the password then reads the index at the end of the file
+        """
+        self.header = self.infile.read(SEGMENT_HEADER.size)
+        if not self.header.startswith(SEGMENT_MAGIC):
+            raise ValueError(f"not a segmented container: {self.name}")
+        end = self.infile.seek(0, os.SEEK_END)
+        if end < SEGMENT_HEADER.size + SEGMENT_TAG + 8:
+            raise ValueError(f"truncated segmented container: {self.name}")
+
+        _, self.segment_size, salt, check, _ = SEGMENT_HEADER.unpack(self.header)
+        self.key, expected = keys(salt)
+        if not hmac.compare_digest(check, expected):
+            raise WrongPassword(f"wrong password for {self.name}")
+
+        self.infile.seek(-8, os.SEEK_END)
+        index_length = struct.unpack('<Q', self.infile.read(8))[0]
+        if index_length > end - SEGMENT_HEADER.size - 8:
+            raise ValueError(f"truncated segmented container: {self.name}")
+        self.infile.seek(-8 - index_length, os.SEEK_END)
+        index = json.loads(open_segment(self.key, self.header, INDEX_SEGMENT, self.infile.read(index_length)))
+        self.size = index["size"]
+        self.segments = index["segments"]
+
+    def read_sealed(self, number):
+        self.infile.seek(len(self.header) + number * (self.segment_size + SEGMENT_TAG))
+        return self.infile.read(min(self.segment_size, self.size - number * self.segment_size) + SEGMENT_TAG)
+
+    def decrypt_segment(self, number, sealed):
+        return open_segment(self.key, self.header, number, sealed)
+
+
+class CBCReader(PlainReader):
+    """
+    seekable read only view of the plaintext of the original AES-CBC format
+    a CBC block only needs the ciphertext block before it to decrypt so any part can be read on its own,
+    which also lets old files be decrypted in parallel
+    there is no authentication, a wrong key just produces garbage
+    """
+
+    def __init__(self, in_filename, key, segment_size=64 * 1024, workers=1):
+        super().__init__(in_filename, segment_size, workers)
+        self.key = key
+
+        header = self.infile.read(struct.calcsize('<Q'))
+        self.size = struct.unpack('<Q', header)[0] if len(header) == 8 else -1
+        padded = (self.size + 15) // 16 * 16
+        if self.size < 0 or os.path.getsize(in_filename) != 8 + AES.block_size + padded:
+            self.infile.close()
+            raise ValueError(f"not an encrypted backup: {in_filename}")
+
+    def read_sealed(self, number):
+        start = number * self.segment_size
+        self.infile.seek(8 + start)  # the iv or the ciphertext block before this segment
+        return self.infile.read(AES.block_size + min(self.segment_size, (self.size + 15) // 16 * 16 - start))
+
+    def decrypt_segment(self, number, sealed):
+        iv, ciphertext = sealed[:AES.block_size], sealed[AES.block_size:]
+        return AES.new(self.key, AES.MODE_CBC, iv).decrypt(ciphertext)[:self.size - number * self.segment_size]
+
+
+def timed(func, *args):
+    """
+    runs func, returns (its result, seconds it took), lets worker threads report the time spent on crypto
+    """
+    start = time.perf_counter()
+    return func(*args), time.perf_counter() - start
+
+
+def seal_segment(key, header, number, plain):
+    """
+    encrypts and authenticates one segment, returns ciphertext + tag
+    """
+    cipher = AES.new(key, AES.MODE_GCM, nonce=header[-8:] + struct.pack('<I', number))
+    cipher.update(header)
+    ciphertext, tag = cipher.encrypt_and_digest(plain)
+    return ciphertext + tag
+
+
+def open_segment(key, header, number, sealed):
+    """
+    decrypts a segment written by seal_segment, raises DamagedSegment (a ValueError) if it fails authentication
+    """
+    cipher = AES.new(key, AES.MODE_GCM, nonce=header[-8:] + struct.pack('<I', number))
+    cipher.update(header)
+    try:
+        return cipher.decrypt_and_verify(sealed[:-SEGMENT_TAG], sealed[-SEGMENT_TAG:])
+    except ValueError as e:
+        raise DamagedSegment(str(e)) from None
+
+
+@lru_cache(maxsize=1024)
+def derive_key(password, salt):
+    """
+    derives cryptographic key using pbkdf2 key derivation scheme
+    cached so opening many files written with the same salt only pays for the 100000 iterations once
+    """
+    return hashlib.pbkdf2_hmac("sha256", password, salt, 100000)
+
+
+class Crypto:
+    """
+    new files are written in the segmented container (see SegmentWriter), AES-GCM segments sealed in parallel
+    files in the original AES-CBC format (space padded, unauthenticated) can still be read and decrypted
+    every Crypto object picks a random salt for the files it writes, one per backup run
+    keys are derived when first needed and cached per (password, salt) for the whole process
+    workers -> threads used to encrypt and decrypt segments, defaults to cpu count
+    """
+
+    def __init__(self, password, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.__password = password.encode()
+        self.__salt = Random.new().read(16)
+
+    def __derive_key(self, salt=None):
+        """
+        salt = random salt from the container header,
+        files from before salts were added use the sha3_256 digest of the password string
+        """
+        return derive_key(self.__password, salt or hashlib.sha3_256(self.__password).digest())
+
+    def __keys(self, salt):
+        """
+        returns (segment key, key check) for a container with this salt, see SegmentReader
+        """
+        dk = self.__derive_key(salt)
+        return hmac.new(dk, b"segmented container", hashlib.sha256).digest(), \
+            hmac.new(dk, b"key check", hashlib.sha256).digest()[:16]
+
+    def encrypt_file(self, in_filename, out_filename=None, chunksize=1024 * 1024):
+        """
+        encrypts a file into the segmented container, returns the output name
+
+        in_filename:
+            Name of the input file
+
+        out_filename:
+            If None, '<in_filename>.locked' will be used.
+
+        chunksize:
+            size of the reads from the input file
+        """
+        if not out_filename:
+            out_filename = in_filename + '.locked'
 
         with open(in_filename, 'rb') as infile:
-            origsize = struct.unpack('<Q', infile.read(struct.calcsize('Q')))[0]
+            with self.open_segment_writer(out_filename) as outfile:
+                shutil.copyfileobj(infile, outfile, chunksize)
+        return outfile.name
 
-            iv = infile.read(16)
+    def open_segment_writer(self, out_filename, segment_size=1024 * 1024):
+        """
+        returns a SegmentWriter for the segmented container, which can be read back with random access
+        """
+        key, check = self.__keys(self.__salt)
+        return SegmentWriter(out_filename, key, self.__salt, check, segment_size, self.workers)
 
-            decryptor = AES.new(self.__dk, AES.MODE_CBC, iv)
+    def open_reader(self, in_filename, workers=None):
+        """
+        returns a seekable reader over the plaintext of either format
+        SegmentReader for segmented containers, CBCReader for the original format
+        workers -> threads decrypting ahead, defaults to the workers of this object
+        raises ValueError if the file is neither or fails authentication, WrongPassword (a ValueError) if
+        the password is wrong
+        """
+        workers = workers or self.workers
+        if self.is_segmented(in_filename):
+            return SegmentReader(in_filename, self.__keys, workers)
+        return CBCReader(in_filename, self.__derive_key(), workers=workers)
 
-            with open(out_filename, 'wb') as outfile:
+    @staticmethod
+    def is_segmented(in_filename):
+        """
+        True if the file is a segmented container rather than the original AES-CBC format
+        """
+        with open(in_filename, 'rb') as f:
+            return f.read(len(SEGMENT_MAGIC)) == SEGMENT_MAGIC
 
-                while True:
-                    chunk = infile.read(chunksize)
-                    if len(chunk) == 0:
-                        break
-                    outfile.write(decryptor.decrypt(chunk))
+    def decrypt_file(self, in_filename, out_filename=None, chunksize=1024 * 1024):
+        """
+        decrypts a file in either format, segments are decrypted in parallel
+        out_filename, if not supplied will be in_filename without its last extension
+        (i.e. if in_filename is 'aaa.zip.enc' then out_filename will be 'aaa.zip')
+        raises ValueError if the file fails authentication
+        """
+        if out_filename is None:
+            out_filename = os.path.splitext(in_filename)[0]
 
-                outfile.truncate(origsize)
+        with self.open_reader(in_filename) as infile, open(out_filename, 'wb') as outfile:
+            shutil.copyfileobj(infile, outfile, chunksize)
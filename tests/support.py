@@ -0,0 +1,89 @@
+"""
+shared helpers for the tests, the modules live flat in src so it is put on the path here
+run from the repository root: python -m unittest discover tests (or python -m pytest tests)
+"""
+import filecmp
+import os
+import os.path as op
+import random
+import sys
+
+sys.path.insert(0, op.join(op.dirname(op.dirname(op.abspath(__file__))), "src"))
+
+
+def quiet(*args, **kwargs):
+    """
+    ui_caller that ignores everything
+    """
+
+
+def make_tree(root: str, seed: int = 1, big: int = 0) -> str:
+    """
+    writes a small tree with duplicates, a hard link and an empty folder, big -> size of an extra random file
+    """
+    rnd = random.Random(seed)
+    blobs = [rnd.randbytes(rnd.randint(0, 100000)) for _ in range(6)] + [b"text " * 5000]
+    for index in range(3):
+        sub = op.join(root, f"dir{index}", "inner")
+        os.makedirs(sub)
+        for number in range(6):
+            with open(op.join(sub if number % 2 else op.dirname(sub), f"file{number}.bin"), "wb") as f:
+                f.write(rnd.choice(blobs))
+    os.makedirs(op.join(root, "empty", "folder"))
+    os.link(op.join(root, "dir0", "file0.bin"), op.join(root, "hard.bin"))
+    if big:
+        with open(op.join(root, "big.bin"), "wb") as f:
+            f.write(rnd.randbytes(big))
+    return root
+
+
+def same_trees(a: str, b: str) -> bool:
+    """
+    True if both trees have the same folders and files with the same contents
+    """
+    compared = filecmp.dircmp(a, b)
+    if compared.left_only or compared.right_only or compared.funny_files:
+        return False
+    _, mismatch, errors = filecmp.cmpfiles(a, b, compared.common_files, shallow=False)
+    if mismatch or errors:
+        return False
+    return all(same_trees(op.join(a, name), op.join(b, name)) for name in compared.common_dirs)
+
+
+def flip_byte(path: str, offset: int):
+    """
+    flips the lowest bit of the byte at offset, negative offsets count from the end
+    """
+    with open(path, "r+b") as f:
+        f.seek(offset, os.SEEK_SET if offset >= 0 else os.SEEK_END)
+        byte = f.read(1)[0]
+        f.seek(-1, os.SEEK_CUR)
+        f.write(bytes([byte ^ 1]))
+
+
+def truncate(path: str, length: int):
+    """
+    cuts a file to length bytes, negative lengths cut that many bytes off the end
+    """
+    with open(path, "r+b") as f:
+        f.truncate(length if length >= 0 else op.getsize(path) + length)
+
+
+def encrypt_cbc(password: str, in_filename: str, out_filename: str):
+    """
+    encrypts a file in the original AES-CBC format the first versions wrote, which is still read but never written:
+    plaintext size (<Q) | iv | AES-CBC of the plaintext space padded to 16 bytes,
+    with the key derived from the password and the sha3_256 digest of the password as the salt
+    """
+    import hashlib
+    import struct
+    from Crypto.Cipher import AES
+    from crypto import derive_key
+
+    key = derive_key(password.encode(), hashlib.sha3_256(password.encode()).digest())
+    iv = os.urandom(AES.block_size)
+    with open(in_filename, "rb") as f:
+        data = f.read()
+    with open(out_filename, "wb") as f:
+        f.write(struct.pack("<Q", len(data)) + iv)
+        f.write(AES.new(key, AES.MODE_CBC, iv).encrypt(data + b" " * (-len(data) % 16)))
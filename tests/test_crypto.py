@@ -0,0 +1,169 @@
+import os
+import os.path as op
+import tempfile
+import unittest
+
+from support import encrypt_cbc, flip_byte, truncate
+
+from crypto import Crypto, SegmentReader, SEGMENT_HEADER, SEGMENT_MAGIC, SEGMENT_TAG, WrongPassword, DamagedSegment
+
+
+class SegmentedContainerTest(unittest.TestCase):
+    """
+    the segmented container: round trips, random access, wrong passwords, tampering and truncation
+    """
+
+    SEGMENT_SIZE = 4096
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.crypto = Crypto("password", workers=3)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def write(self, data: bytes, name: str = "file.locked", crypto=None) -> str:
+        path = op.join(self.folder.name, name)
+        with (crypto or self.crypto).open_segment_writer(path, self.SEGMENT_SIZE) as writer:
+            for start in range(0, len(data), 1000):  # writes that don't line up with segments
+                writer.write(data[start:start + 1000])
+        return path
+
+    def read(self, path: str, crypto=None, workers=None) -> bytes:
+        with (crypto or self.crypto).open_reader(path, workers) as reader:
+            return reader.read()
+
+    def test_round_trip(self):
+        for size in (0, 1, self.SEGMENT_SIZE - 1, self.SEGMENT_SIZE, self.SEGMENT_SIZE * 5 + 17):
+            for workers in (1, 3):
+                data = os.urandom(size)
+                path = self.write(data, crypto=Crypto("password", workers=workers))
+                self.assertTrue(Crypto.is_segmented(path))
+                self.assertEqual(self.read(path, workers=workers), data, (size, workers))
+
+    def test_layout(self):
+        data = os.urandom(self.SEGMENT_SIZE * 3 + 5)
+        path = self.write(data)
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(len(SEGMENT_MAGIC)), SEGMENT_MAGIC)
+        index = op.getsize(path) - SEGMENT_HEADER.size - len(data) - 4 * SEGMENT_TAG - 8
+        self.assertGreater(index, SEGMENT_TAG)  # sealed index after the segments
+
+    def test_random_access(self):
+        data = os.urandom(self.SEGMENT_SIZE * 4 + 100)
+        path = self.write(data)
+        with self.crypto.open_reader(path) as reader:
+            for start, length in ((0, 10), (self.SEGMENT_SIZE - 3, 10), (len(data) - 50, 200), (5000, 9000)):
+                reader.seek(start)
+                self.assertEqual(reader.read(length), data[start:start + length])
+            self.assertEqual(reader.seek(0, os.SEEK_END), len(data))
+
+    def test_file_round_trip(self):
+        source = op.join(self.folder.name, "plain")
+        with open(source, "wb") as f:
+            f.write(os.urandom(100000))
+        locked = self.crypto.encrypt_file(source)
+        self.crypto.decrypt_file(locked, source + ".out")
+        with open(source, "rb") as a, open(source + ".out", "rb") as b:
+            self.assertEqual(a.read(), b.read())
+
+    def test_every_writer_uses_its_own_salt(self):
+        data = b"same data" * 100
+        first = self.write(data, "first.locked")
+        second = self.write(data, "second.locked", Crypto("password"))
+        with open(first, "rb") as a, open(second, "rb") as b:
+            self.assertNotEqual(a.read(SEGMENT_HEADER.size), b.read(SEGMENT_HEADER.size))
+        self.assertEqual(self.read(second), data)
+
+    def test_wrong_password(self):
+        path = self.write(os.urandom(10000))
+        with self.assertRaises(WrongPassword):
+            Crypto("not the password").open_reader(path)
+
+    def test_tampered_segment(self):
+        data = os.urandom(self.SEGMENT_SIZE * 3)
+        path = self.write(data)
+        flip_byte(path, SEGMENT_HEADER.size + self.SEGMENT_SIZE + SEGMENT_TAG + 10)  # inside segment 1
+        with self.crypto.open_reader(path, 1) as reader:
+            self.assertEqual(reader.read(self.SEGMENT_SIZE), data[:self.SEGMENT_SIZE])  # segment 0 is intact
+            with self.assertRaises(DamagedSegment):
+                reader.read(10)
+
+    def test_tampered_header(self):
+        path = self.write(os.urandom(10000))
+        flip_byte(path, SEGMENT_HEADER.size - 1)  # nonce prefix, authenticated with every segment
+        with self.assertRaises(DamagedSegment):
+            self.read(path)
+
+    def test_tampered_index(self):
+        path = self.write(os.urandom(10000))
+        flip_byte(path, -9)  # last byte of the sealed index
+        with self.assertRaises(DamagedSegment):
+            self.crypto.open_reader(path)
+
+    def test_swapped_segments(self):
+        path = self.write(os.urandom(self.SEGMENT_SIZE * 2))
+        sealed = self.SEGMENT_SIZE + SEGMENT_TAG
+        with open(path, "r+b") as f:
+            f.seek(SEGMENT_HEADER.size)
+            first, second = f.read(sealed), f.read(sealed)
+            f.seek(SEGMENT_HEADER.size)
+            f.write(second + first)
+        with self.assertRaises(DamagedSegment):
+            self.read(path)
+
+    def test_truncated(self):
+        data = os.urandom(self.SEGMENT_SIZE * 3)
+        for length in (len(SEGMENT_MAGIC), SEGMENT_HEADER.size - 1, SEGMENT_HEADER.size, SEGMENT_HEADER.size + 20,
+                       -1, -8, -(self.SEGMENT_SIZE + 100)):
+            path = self.write(data)
+            truncate(path, length)
+            with self.assertRaises(ValueError, msg=length):
+                self.read(path)
+
+    def test_not_a_container(self):
+        path = op.join(self.folder.name, "plain")
+        with open(path, "wb") as f:
+            f.write(b"just some bytes that are not encrypted")
+        self.assertFalse(Crypto.is_segmented(path))
+        with self.assertRaises(ValueError):
+            SegmentReader(path, lambda salt: (b"k" * 32, b"c" * 16))
+
+
+class CBCTest(unittest.TestCase):
+    """
+    files in the original AES-CBC format are still read
+    """
+
+    def test_decrypt(self):
+        with tempfile.TemporaryDirectory() as folder:
+            for size in (0, 15, 16, 100000):
+                data = os.urandom(size)
+                plain, locked = op.join(folder, "plain"), op.join(folder, "plain.locked")
+                with open(plain, "wb") as f:
+                    f.write(data)
+                encrypt_cbc("password", plain, locked)
+                self.assertFalse(Crypto.is_segmented(locked))
+
+                crypto = Crypto("password", workers=2)
+                with crypto.open_reader(locked) as reader:
+                    self.assertEqual(reader.read(), data)
+                    reader.seek(size // 2)
+                    self.assertEqual(reader.read(100), data[size // 2:size // 2 + 100])
+                crypto.decrypt_file(locked, plain + ".out")
+                with open(plain + ".out", "rb") as f:
+                    self.assertEqual(f.read(), data)
+
+    def test_truncated(self):
+        with tempfile.TemporaryDirectory() as folder:
+            plain, locked = op.join(folder, "plain"), op.join(folder, "plain.locked")
+            with open(plain, "wb") as f:
+                f.write(os.urandom(1000))
+            encrypt_cbc("password", plain, locked)
+            truncate(locked, -16)
+            with self.assertRaises(ValueError):
+                Crypto("password").open_reader(locked)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+import hashlib
+import io
+import unittest
+
+import support  # noqa: F401  puts src on the path
+
+from Manifest import Manifest, write_manifest
+
+
+def digest(text: str, algorithm: str = "md5") -> str:
+    return hashlib.new(algorithm, text.encode()).hexdigest()
+
+
+class ManifestTest(unittest.TestCase):
+    """
+    the binary manifest: round trips, truncation and files that are not a manifest
+    """
+
+    def config(self, algorithm: str = "md5") -> dict:
+        odd = b"dir/caf\xe9.txt".decode("utf-8", "surrogateescape")  # latin-1 name, not valid utf-8
+        return {
+            "hash_algorithm": algorithm,
+            "directory_tree": ["dir", "dir/sub", "dir/sub/deeper", "other", "été"],
+            "file_tree": {
+                digest("a", algorithm): ["dir/a.txt", "dir/sub/a.txt", "other/a copy.txt"],
+                digest("b", algorithm): ["dir/sub/deeper/" + "long name " * 100],
+                digest("c", algorithm): [odd, "été/ça.txt"],
+            },
+            "chunks": {digest("b", algorithm): [digest("b1", algorithm), digest("b2", algorithm)]},
+        }
+
+    def write(self, config: dict) -> bytes:
+        f = io.BytesIO()
+        write_manifest(f, config)
+        return f.getvalue()
+
+    def test_round_trip(self):
+        for algorithm in ("md5", "sha256"):
+            config = self.config(algorithm)
+            data = self.write(config)
+            self.assertTrue(Manifest.is_manifest(data[:16]))
+
+            manifest = Manifest(lambda: io.BytesIO(data))
+            self.assertEqual(manifest.algorithm, algorithm)
+            self.assertEqual(manifest.directory_tree, config["directory_tree"])
+            self.assertEqual(manifest.chunks, config["chunks"])
+            self.assertEqual(len(manifest), len(config["file_tree"]))
+            self.assertEqual(dict(manifest.items()), config["file_tree"])
+            self.assertEqual(list(manifest.items()), list(manifest.items()))  # items() can be read again
+            self.assertEqual(list(manifest), list(config["file_tree"]))
+
+    def test_empty(self):
+        data = self.write({"directory_tree": [], "file_tree": {}})
+        manifest = Manifest(lambda: io.BytesIO(data))
+        self.assertEqual((manifest.algorithm, manifest.directory_tree, manifest.chunks), ("md5", [], {}))
+        self.assertEqual(list(manifest.items()), [])
+
+    def test_truncated(self):
+        data = self.write(self.config())
+        for length in (4, 20, len(data) // 2, len(data) - 1):
+            with self.assertRaises(ValueError, msg=length):
+                manifest = Manifest(lambda: io.BytesIO(data[:length]))
+                list(manifest.items())
+
+    def test_not_a_manifest(self):
+        self.assertFalse(Manifest.is_manifest(b'{"directory_tree": []}'))
+        with self.assertRaises(ValueError):
+            Manifest(lambda: io.BytesIO(b'{"directory_tree": [], "file_tree": {}}'))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+import json
+import os
+import os.path as op
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+from support import quiet, make_tree, same_trees, flip_byte, truncate, encrypt_cbc
+
+from Backup import Backup
+from HashEngine import HashEngine
+from Restore import Restore, InvalidPassword, BadBackupFile
+from crypto import SEGMENT_HEADER, SEGMENT_TAG
+
+
+class RestoreTest(unittest.TestCase):
+    """
+    backups restored end to end: round trips, wrong passwords, tampered and truncated archives, original format
+    """
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.base = self.folder.name
+        self.source = make_tree(op.join(self.base, "source"), big=3 * 1024 * 1024)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def backup(self, **kwargs) -> str:
+        out = tempfile.mkdtemp(dir=self.base)
+        return Backup(self.source, out, "password", workers=2, **kwargs).backup(ui_caller=quiet)
+
+    def restore(self, backup_path: str, password: str = "password", **kwargs) -> str:
+        dest = tempfile.mkdtemp(dir=self.base)
+        Restore(backup_path, dest, password, workers=2).restore(quiet, **kwargs)
+        return dest
+
+    def test_round_trip(self):
+        for options in ({}, {"compression": "stored"}, {"compression": "lzma"}, {"chunking": True}):
+            backup_path = self.backup(**options)
+            self.assertTrue(same_trees(self.source, self.restore(backup_path)), options)
+            self.assertEqual(Restore(backup_path, "", "password").verify(quiet), [])
+
+    def test_patterns(self):
+        dest = self.restore(self.backup(), patterns=["/dir1"])
+        self.assertEqual(sorted(os.listdir(dest)), ["dir1"])
+        self.assertTrue(same_trees(op.join(self.source, "dir1"), op.join(dest, "dir1")))
+
+    def test_snapshot(self):
+        repository = op.join(self.base, "repository")
+        Backup(self.source, repository, "password", incremental=True).backup(ui_caller=quiet)
+        with open(op.join(self.source, "dir2", "new.txt"), "w") as f:
+            f.write("added after the first snapshot")
+        snapshot = Backup(self.source, repository, "password", incremental=True).backup(ui_caller=quiet)
+        self.assertTrue(same_trees(self.source, self.restore(snapshot)))
+
+    def test_wrong_password(self):
+        with self.assertRaises(InvalidPassword):
+            self.restore(self.backup(), "not the password")
+
+    def test_tampered(self):
+        backup_path = self.backup()
+        segment = 1024 * 1024  # middle of the second segment, only the big file is stored there
+        flip_byte(backup_path, SEGMENT_HEADER.size + segment + SEGMENT_TAG + segment // 2)
+        with self.assertRaises(BadBackupFile):
+            self.restore(backup_path)
+        damaged = Restore(backup_path, "", "password").verify(quiet)
+        self.assertEqual([report["paths"] for report in damaged], [["/big.bin"]])
+
+    def test_truncated(self):
+        backup_path = self.backup()
+        copy = backup_path + ".copy"
+        for length in (SEGMENT_HEADER.size, 1024 * 1024, -1):
+            shutil.copy(backup_path, copy)
+            truncate(copy, length)
+            with self.assertRaises(BadBackupFile, msg=length):
+                self.restore(copy)
+
+    def test_original_format(self):
+        """
+        an archive the way the first versions wrote it: backup.zip holding a json config and duplicates.zip
+        (stored, hash.duplicate entries), encrypted with AES-CBC
+        """
+        hasher = HashEngine("md5")
+        directory_tree, file_tree = [], {}
+        for root, dirs, files in os.walk(self.source):
+            directory_tree += [op.join(root, name).replace(self.source, "") for name in dirs]
+            for name in files:
+                path = op.join(root, name)
+                file_tree.setdefault(hasher.hash_file(path), []).append(path.replace(self.source, ""))
+
+        duplicates = op.join(self.base, "duplicates.zip")
+        with zipfile.ZipFile(duplicates, "w", zipfile.ZIP_STORED, allowZip64=True) as zip_file:
+            for hash_, paths in file_tree.items():
+                zip_file.write(self.source + paths[0], arcname=hash_ + ".duplicate")
+        plain = op.join(self.base, "backup.zip")
+        with zipfile.ZipFile(plain, "w", zipfile.ZIP_STORED, allowZip64=True) as zip_file:
+            zip_file.write(duplicates, arcname="duplicates.zip")
+            zip_file.writestr("config", json.dumps({"directory_tree": directory_tree, "file_tree": file_tree}))
+        locked = op.join(self.base, "2020-01-01 backup.zip.locked")
+        encrypt_cbc("password", plain, locked)
+
+        self.assertTrue(same_trees(self.source, self.restore(locked)))
+        self.assertEqual(Restore(locked, "", "password").verify(quiet), [])
+        with self.assertRaises(InvalidPassword):
+            self.restore(locked, "not the password")
+
+
+if __name__ == "__main__":
+    unittest.main()
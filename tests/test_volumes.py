@@ -0,0 +1,96 @@
+import os
+import os.path as op
+import shutil
+import tempfile
+import unittest
+
+from support import quiet, make_tree, same_trees, flip_byte, truncate
+
+from Backup import Backup
+from Restore import Restore, BadBackupFile
+from Volumes import volume_files, archive_size
+
+VOLUME_SIZE = 1024 * 1024
+
+
+class VolumesTest(unittest.TestCase):
+    """
+    archives split into volumes: round trips, partial restores, missing, tampered and truncated volumes
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.TemporaryDirectory()
+        cls.base = cls.folder.name
+        cls.source = make_tree(op.join(cls.base, "source"), big=3 * VOLUME_SIZE)
+        cls.backup_path = Backup(cls.source, op.join(cls.base, "backup"), "password", workers=2,
+                                 volume_size=VOLUME_SIZE).backup(ui_caller=quiet)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.folder.cleanup()
+
+    def copy(self) -> str:
+        """
+        copy of the archive that can be damaged, returns the path of its index volume
+        """
+        folder = tempfile.mkdtemp(dir=self.base)
+        for path in [self.backup_path] + volume_files(self.backup_path):
+            shutil.copy(path, folder)
+        return op.join(folder, op.basename(self.backup_path))
+
+    def restore(self, backup_path: str, **kwargs) -> str:
+        dest = tempfile.mkdtemp(dir=self.base)
+        Restore(backup_path, dest, "password", workers=2).restore(quiet, **kwargs)
+        return dest
+
+    def test_split(self):
+        volumes = volume_files(self.backup_path)
+        self.assertGreaterEqual(len(volumes), 3)
+        self.assertTrue(all(op.getsize(path) <= VOLUME_SIZE for path in volumes))
+        self.assertEqual(archive_size(self.backup_path),
+                         op.getsize(self.backup_path) + sum(op.getsize(path) for path in volumes))
+
+    def test_round_trip(self):
+        self.assertTrue(same_trees(self.source, self.restore(self.backup_path)))
+        self.assertEqual(Restore(self.backup_path, "", "password").verify(quiet), [])
+
+    def test_partial_restore_needs_only_its_volumes(self):
+        backup_path = self.copy()
+        listed = Restore(backup_path, "", "password").list(["/dir1"])
+        restore = Restore(backup_path, "", "password")
+        restore.read_config()
+        needed = {restore.duplicates_zip.volume_file(hash_ + ".duplicate") for _, hash_ in listed}
+        restore.close()
+        self.assertLess(len(needed), len(volume_files(backup_path)))
+        for path in volume_files(backup_path):
+            if op.basename(path) not in needed:
+                os.remove(path)
+
+        dest = self.restore(backup_path, patterns=["/dir1"])
+        self.assertTrue(same_trees(op.join(self.source, "dir1"), op.join(dest, "dir1")))
+
+    def test_missing_volume(self):
+        backup_path = self.copy()
+        os.remove(volume_files(backup_path)[-1])
+        self.assertTrue(Restore(backup_path, "", "password").verify(quiet))
+        with self.assertRaises((BadBackupFile, OSError)):
+            self.restore(backup_path)
+
+    def test_tampered_volume(self):
+        backup_path = self.copy()
+        flip_byte(volume_files(backup_path)[1], VOLUME_SIZE // 2)
+        self.assertTrue(Restore(backup_path, "", "password").verify(quiet))
+        with self.assertRaises(BadBackupFile):
+            self.restore(backup_path)
+
+    def test_truncated_volume(self):
+        backup_path = self.copy()
+        truncate(volume_files(backup_path)[0], -100)
+        self.assertTrue(Restore(backup_path, "", "password").verify(quiet))
+        with self.assertRaises(BadBackupFile):
+            self.restore(backup_path)
+
+
+if __name__ == "__main__":
+    unittest.main()